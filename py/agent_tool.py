@@ -1,6 +1,7 @@
 import json
-from py.get_setting import HOST,PORT
-from openai import AsyncOpenAI
+from py.get_setting import HOST,PORT,load_settings
+from py.client_pool import client_pool
+from py.scheduler import PRIORITY_HEADER, INTERNAL_HEADER, INTERNAL_TOKEN
 async def get_agent_tool(settings):
     tool_agent_list = []
     for agent_id,agent_config in settings['agents'].items():
@@ -33,17 +34,39 @@ async def get_agent_tool(settings):
         agent_tool = None
     return agent_tool
 
+# server.py 注册的进程内调用入口（invoke_agent），未注册时通过 HTTP 调用自身的 /v1/chat/completions
+_agent_runner = None
+
+def set_agent_runner(runner):
+    global _agent_runner
+    _agent_runner = runner
+
 async def agent_tool_call(agent_id, query):
+    if _agent_runner is not None:
+        try:
+            settings = await load_settings()
+            response = await _agent_runner(
+                agent_id,
+                [{"role": "user", "content": query}],
+                # 开启 responseCache.internalCalls 时，相同的智能体调用使用响应缓存
+                cache=True if settings['responseCache'].get('internalCalls') else None,
+            )
+            return str(response["choices"][0]["message"]["content"])
+        except Exception as e:
+            print(f"Error: {e}")
+            return str(e)
     try:
-        client = AsyncOpenAI(
-            api_key="super-secret-key",
-            base_url=f"http://{HOST}:{PORT}/v1"
-        )
+        client = client_pool.get_client("super-secret-key", f"http://{HOST}:{PORT}/v1")
+        settings = await load_settings()
         response = await client.chat.completions.create(
             model=agent_id,
             messages=[
                 {"role": "user", "content": query}
-            ]
+            ],
+            # 开启 responseCache.internalCalls 时，相同的智能体调用使用响应缓存
+            extra_body={"cache": True} if settings['responseCache'].get('internalCalls') else None,
+            # 带内部凭据：在父请求的准入名额内执行，服务端不再为它排队
+            extra_headers={PRIORITY_HEADER: "agent", INTERNAL_HEADER: INTERNAL_TOKEN},
         )
         res = response.choices[0].message.content
         return str(res)
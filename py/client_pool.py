@@ -0,0 +1,163 @@
+"""
+上游 OpenAI 兼容客户端池：按 (base_url, api_key, vendor) 复用 AsyncOpenAI 实例，
+所有实例共享同一个 httpx 连接池，同一上游主机的 TCP/TLS 连接在请求之间保持复用。
+长时间未使用的客户端会被移除，空闲连接由 httpx 的 keepalive_expiry 关闭。
+httpx 的连接绑定在事件循环上，QQ 机器人等运行在独立线程的事件循环各自使用一个连接池。
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+class _LoopPool:
+    """某个事件循环上的共享 httpx 客户端与 AsyncOpenAI 实例"""
+    def __init__(self, config: dict, stats: "ClientPoolStats"):
+        http2 = bool(config.get("http2"))
+        if http2:
+            try:
+                import h2  # noqa: F401  httpx 的 HTTP/2 支持需要 h2
+            except ImportError:
+                logger.warning("clientPool.http2 is enabled but the h2 package is not installed, using HTTP/1.1")
+                http2 = False
+        self.stats = stats
+        self.http = DefaultAsyncHttpxClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=config.get("maxConnections", 100),
+                max_keepalive_connections=config.get("maxKeepaliveConnections", 20),
+                keepalive_expiry=config.get("keepaliveExpiry", 60),
+            ),
+            event_hooks={"request": [self._on_request]},
+        )
+        self.clients = OrderedDict()  # key -> (AsyncOpenAI, 最近使用时间)
+
+    async def _on_request(self, request: httpx.Request):
+        host = request.url.host
+        self.stats.record_request(host)
+        # httpcore 的 trace 回调：请求过程中建立了新的 TCP 连接说明没有复用到空闲连接
+        request.extensions.setdefault("trace", lambda event, info: self._on_trace(host, event))
+
+    async def _on_trace(self, host: str, event: str):
+        if event == "connection.connect_tcp.complete":
+            self.stats.record_connect(host)
+
+    def connections(self) -> dict:
+        try:
+            pool = self.http._transport._pool
+            connections = [conn for conn in pool.connections if not conn.is_closed()]
+        except AttributeError:
+            return {"open": None, "idle": None}
+        return {"open": len(connections), "idle": sum(1 for conn in connections if conn.is_idle())}
+
+class ClientPool:
+    def __init__(self):
+        self.config = {}
+        self._pools = weakref.WeakKeyDictionary()  # 事件循环 -> _LoopPool
+        self.stats = ClientPoolStats()
+
+    def configure(self, config: dict):
+        """启动时从 settings['clientPool'] 读取配置，已经创建的连接池不受影响"""
+        self.config = dict(config or {})
+
+    def _loop_pool(self) -> _LoopPool:
+        loop = asyncio.get_running_loop()
+        pool = self._pools.get(loop)
+        if pool is None:
+            pool = self._pools[loop] = _LoopPool(self.config, self.stats)
+        return pool
+
+    def get_client(self, api_key: str = None, base_url: str = None, vendor: str = None) -> AsyncOpenAI:
+        """返回 (base_url, api_key, vendor) 对应的共享客户端，需要在事件循环中调用"""
+        pool = self._loop_pool()
+        key = (base_url or DEFAULT_BASE_URL, api_key or "", vendor or "")
+        now = time.monotonic()
+        self._evict(pool, now)
+        entry = pool.clients.get(key)
+        if entry is not None:
+            pool.clients.move_to_end(key)
+            pool.clients[key] = (entry[0], now)
+            self.stats.hits += 1
+            return entry[0]
+        self.stats.misses += 1
+        # api_key 为 None 时与直接构造一致，由 SDK 读取环境变量
+        client = AsyncOpenAI(api_key=api_key, base_url=key[0], http_client=pool.http)
+        pool.clients[key] = (client, now)
+        return client
+
+    def _evict(self, pool: _LoopPool, now: float):
+        idle_timeout = self.config.get("idleTimeout", 600)
+        max_clients = self.config.get("maxClients", 64)
+        while pool.clients:
+            key, (_, last_used) = next(iter(pool.clients.items()))
+            if now - last_used <= idle_timeout and len(pool.clients) < max_clients:
+                break
+            # 共享的 http_client 不随客户端关闭，只丢弃引用
+            del pool.clients[key]
+            self.stats.evictions += 1
+
+    async def aclose(self):
+        """关闭当前事件循环上的连接池"""
+        pool = self._pools.pop(asyncio.get_running_loop(), None)
+        if pool is not None:
+            pool.clients.clear()
+            await pool.http.aclose()
+
+    def to_dict(self) -> dict:
+        pools = list(self._pools.values())
+        connections = [pool.connections() for pool in pools]
+        return {
+            "event_loops": len(pools),
+            "clients": sum(len(pool.clients) for pool in pools),
+            "open_connections": sum(c["open"] or 0 for c in connections),
+            "idle_connections": sum(c["idle"] or 0 for c in connections),
+            **self.stats.to_dict(),
+        }
+
+class ClientPoolStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.hosts = {}  # host -> {"requests": n, "connections": n}
+
+    def _host(self, host: str) -> dict:
+        stats = self.hosts.get(host)
+        if stats is None:
+            stats = self.hosts[host] = {"requests": 0, "connections": 0}
+        return stats
+
+    def record_request(self, host: str):
+        self._host(host)["requests"] += 1
+
+    def record_connect(self, host: str):
+        self._host(host)["connections"] += 1
+
+    @staticmethod
+    def _reuse_ratio(requests: int, connections: int) -> float:
+        return max(0.0, 1 - connections / requests) if requests else 0.0
+
+    def to_dict(self) -> dict:
+        requests = sum(stats["requests"] for stats in self.hosts.values())
+        connections = sum(stats["connections"] for stats in self.hosts.values())
+        return {
+            "client_hits": self.hits,
+            "client_misses": self.misses,
+            "client_evictions": self.evictions,
+            "requests": requests,
+            "new_connections": connections,
+            "reuse_ratio": self._reuse_ratio(requests, connections),
+            "hosts": {
+                host: {**stats, "reuse_ratio": self._reuse_ratio(stats["requests"], stats["connections"])}
+                for host, stats in sorted(self.hosts.items())
+            },
+        }
+
+client_pool = ClientPool()
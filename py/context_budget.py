@@ -0,0 +1,311 @@
+"""
+上下文 token 预算：统计发送给模型的每一部分（系统提示、历史轮次、当前轮、工具结果）的 token 数，
+超出模型上下文窗口时按优先级压缩：先截断过长的工具输出（从最早的开始），再删除最早的对话轮次，
+最后截断仍然过长的单条消息；知识库内容在合并进提示词前按排名保留，低排名的片段先被丢弃。
+token 数使用随程序发布的 tiktoken_cache（cl100k_base）计算，无法加载时按字符数估算。
+压缩会丢弃内容，默认关闭，由 contextBudget.enabled 开启。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+
+from py.get_setting import base_path
+from py.message_overlay import MessageOverlay
+
+logger = logging.getLogger(__name__)
+
+# 模型名称前缀 -> 上下文窗口，取匹配到的最长前缀（gpt-4.5 不会落到 gpt-4 上）；
+# 未列出的模型使用 contextBudget.defaultContextTokens，可在 contextBudget.models 中按模型名覆盖
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-5": 400_000,
+    "gpt-4.5": 128_000,
+    "gpt-4.1": 1_047_576,
+    "gpt-4o": 128_000,
+    "gpt-4-turbo": 128_000,
+    "gpt-4-32k": 32_768,
+    "gpt-4": 8_192,
+    "gpt-3.5": 16_385,
+    "o1": 200_000,
+    "o3": 200_000,
+    "o4": 200_000,
+    "claude": 200_000,
+    "gemini": 1_048_576,
+    "deepseek": 65_536,
+    "qwen-long": 10_000_000,
+    "qwen-turbo": 1_000_000,
+    "qwen-plus": 131_072,
+    "qwen-max": 32_768,
+    "qwen2.5": 131_072,
+    "qwen3": 131_072,
+    "qwen": 32_768,
+    "llama-3.1": 131_072,
+    "llama-3.2": 131_072,
+    "llama-3.3": 131_072,
+    "llama3.1": 131_072,
+    "llama3.2": 131_072,
+    "llama3.3": 131_072,
+    "glm": 128_000,
+    "moonshot": 128_000,
+    "kimi": 128_000,
+    "mistral": 32_768,
+}
+DEFAULT_CONTEXT_TOKENS = 32_768
+# 每条消息的格式开销与每张图片按固定值计
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 765
+# 预留给 tokenizer 差异的余量
+SAFETY_MARGIN_RATIO = 0.05
+TRUNCATED_NOTICE = "\n\n[...内容过长，已截断 {tokens} tokens...]"
+
+TOKEN_CACHE_SIZE = 4096
+
+_encoding = None
+_encoding_failed = False
+_token_cache = OrderedDict()  # 文本摘要 -> token 数
+_token_cache_lock = threading.Lock()
+_CJK_PATTERN = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+def get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(base_path, "tiktoken_cache"))
+        try:
+            import tiktoken
+            from tiktoken_ext import openai_public  # noqa: F401  打包时需要显式导入编码注册
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            _encoding_failed = True
+            logger.warning(f"tiktoken is unavailable, token counts are estimated: {e!r}")
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    # 按文本摘要缓存，不持有文本本身（工具输出、知识库内容在每一轮都会重新统计）
+    digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    with _token_cache_lock:
+        tokens = _token_cache.get(digest)
+        if tokens is not None:
+            _token_cache.move_to_end(digest)
+            return tokens
+    tokens = _count_tokens(text)
+    with _token_cache_lock:
+        _token_cache[digest] = tokens
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return tokens
+
+def _count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # 估算：中日韩字符约每字一个 token，其余约每 4 个字符一个 token
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """保留开头的 max_tokens 个 token，并注明截断了多少"""
+    total = count_tokens(text)
+    if total <= max_tokens:
+        return text
+    max_tokens = max(0, max_tokens)
+    encoding = get_encoding()
+    if encoding is not None:
+        head = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    else:
+        head = text[:int(len(text) * max_tokens / total)]
+    return head + TRUNCATED_NOTICE.format(tokens=total - max_tokens)
+
+def message_tokens(message: dict) -> int:
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += count_tokens(content)
+    elif isinstance(content, list):
+        for item in content:
+            if isinstance(item, dict):
+                if item.get("type") == "text":
+                    tokens += count_tokens(item.get("text") or "")
+                elif item.get("type") == "image_url":
+                    tokens += IMAGE_TOKENS
+    for tool_call in message.get("tool_calls") or []:
+        function = (tool_call.get("function") or {}) if isinstance(tool_call, dict) else {}
+        tokens += count_tokens(function.get("name") or "") + count_tokens(function.get("arguments") or "")
+    return tokens
+
+def get_context_window(model: str, settings: dict) -> int:
+    config = settings.get("contextBudget") or {}
+    if model in (config.get("models") or {}):
+        return int(config["models"][model])
+    name = (model or "").lower().rsplit("/", 1)[-1]
+    prefix = max((prefix for prefix in MODEL_CONTEXT_WINDOWS if name.startswith(prefix)), key=len, default=None)
+    if prefix is not None:
+        return MODEL_CONTEXT_WINDOWS[prefix]
+    return int(config.get("defaultContextTokens") or DEFAULT_CONTEXT_TOKENS)
+
+def fit_kb_chunks(chunks: list, settings: dict) -> list:
+    """按排名保留知识库片段，总量不超过 contextBudget.maxKBTokens，低排名的片段先被丢弃"""
+    config = settings.get("contextBudget") or {}
+    max_tokens = config.get("maxKBTokens") or 0
+    if not config.get("enabled", False) or max_tokens <= 0:
+        return chunks
+    kept, used = [], 0
+    for chunk in chunks:
+        tokens = count_tokens(str(chunk.get("content", "")) if isinstance(chunk, dict) else str(chunk))
+        if kept and used + tokens > max_tokens:
+            break
+        kept.append(chunk)
+        used += tokens
+    if len(kept) < len(chunks):
+        context_stats.record_kb(len(chunks) - len(kept))
+        logger.info(f"Knowledge base chunks trimmed: kept {len(kept)}/{len(chunks)} ({used} tokens)")
+    return kept
+
+def _turn_ranges(messages: list):
+    """按 user 消息划分的历史轮次 [(start, end)]，不包含 system 消息和最后一轮"""
+    starts = [i for i, message in enumerate(messages) if message.get("role") == "user"]
+    if not starts:
+        return []
+    ranges = []
+    first = next((i for i, message in enumerate(messages) if message.get("role") != "system"), len(messages))
+    bounds = sorted(set([first] + starts))
+    for start, end in zip(bounds, bounds[1:]):
+        if start < starts[-1]:
+            ranges.append((start, end))
+    return ranges
+
+def compact_messages(messages: list, model: str, settings: dict, reserve_tokens: int = 0, tools: list = None) -> list:
+    """
+    超出预算时返回压缩后的消息列表（与原列表共享未修改的消息），否则原样返回。
+    reserve_tokens 为预留给回复的 token 数，tools 的定义同样占用上下文。
+    优先级：截断工具输出 -> 删除最早的轮次 -> 截断最长的单条消息。
+    system 消息和最后一条 user 消息不会被截断；只剩它们仍然超出时原样发送并记录超出量，由上游决定如何处理。
+    """
+    config = settings.get("contextBudget") or {}
+    if not config.get("enabled", False) or not messages:
+        return messages
+    window = get_context_window(model, settings)
+    tools_tokens = count_tokens(json.dumps(tools, ensure_ascii=False)) if tools else 0
+    # 回复预留和工具定义占满窗口时预算可能为负，这里只限制在 0 以上，受保护的消息不参与截断
+    budget = max(0, int(window * (1 - SAFETY_MARGIN_RATIO)) - (reserve_tokens or 0) - tools_tokens)
+    counts = [message_tokens(message) for message in messages]
+    total = sum(counts)
+    context_stats.record_request(total)
+    if total <= budget:
+        return messages
+    report = {
+        "model": model,
+        "context_window": window,
+        "budget": budget,
+        "before": total,
+        "components": {**_components(messages, counts), "tools": tools_tokens},
+        "trimmed": [],
+    }
+    result = MessageOverlay(messages)
+
+    # 1. 截断过长的工具输出，从最早的开始
+    max_tool_tokens = config.get("maxToolOutputTokens") or 0
+    if max_tool_tokens > 0:
+        for i, message in enumerate(result):
+            if total <= budget:
+                break
+            if message.get("role") == "tool" and isinstance(message.get("content"), str) and counts[i] > max_tool_tokens:
+                result.edit(i)["content"] = truncate_text(message["content"], max_tool_tokens)
+                new_count = message_tokens(result[i])
+                report["trimmed"].append({"action": "truncate_tool_output", "name": message.get("name"), "tokens": counts[i] - new_count})
+                total -= counts[i] - new_count
+                counts[i] = new_count
+
+    # 2. 删除最早的对话轮次（system 消息和当前这一轮保留）
+    drop = set()
+    for start, end in _turn_ranges(result):
+        if total <= budget:
+            break
+        turn_tokens = sum(counts[start:end])
+        drop.update(range(start, end))
+        total -= turn_tokens
+        report["trimmed"].append({"action": "drop_turn", "messages": end - start, "tokens": turn_tokens})
+    if drop:
+        kept = [i for i in range(len(result)) if i not in drop]
+        result, counts = MessageOverlay(result[i] for i in kept), [counts[i] for i in kept]
+
+    # 3. 仍然超出时，截断最长的文本消息（system 消息和当前的用户输入除外）
+    last_user = max((i for i, message in enumerate(result) if message.get("role") == "user"), default=None)
+    while total > budget:
+        longest = max(
+            (i for i, message in enumerate(result)
+             if isinstance(message.get("content"), str) and message.get("role") != "system" and i != last_user),
+            key=lambda i: counts[i],
+            default=None,
+        )
+        if longest is None or counts[longest] <= MESSAGE_OVERHEAD_TOKENS + 1:
+            break
+        content_tokens = counts[longest] - MESSAGE_OVERHEAD_TOKENS
+        keep = max(0, content_tokens - (total - budget))
+        result.edit(longest)["content"] = truncate_text(result[longest]["content"], keep)
+        new_count = message_tokens(result[longest])
+        if new_count >= counts[longest]:
+            break
+        report["trimmed"].append({"action": "truncate_message", "role": result[longest].get("role"), "tokens": counts[longest] - new_count})
+        total -= counts[longest] - new_count
+        counts[longest] = new_count
+
+    report["after"] = total
+    if total > budget:
+        report["overflow"] = total - budget
+        logger.warning(f"Context for {model} still exceeds the budget by {total - budget} tokens after compaction; "
+                       f"system prompt and current user message are kept intact")
+    context_stats.record_compaction(report)
+    logger.info(f"Context compacted for {model}: {report['before']} -> {total} tokens (budget {budget}), trimmed {report['trimmed']}")
+    return result
+
+def _components(messages: list, counts: list) -> dict:
+    last_user = max((i for i, message in enumerate(messages) if message.get("role") == "user"), default=len(messages))
+    components = {"system": 0, "history": 0, "current_turn": 0, "tool_outputs": 0}
+    for i, (message, tokens) in enumerate(zip(messages, counts)):
+        if message.get("role") == "system":
+            components["system"] += tokens
+        elif message.get("role") == "tool":
+            components["tool_outputs"] += tokens
+        elif i < last_user:
+            components["history"] += tokens
+        else:
+            components["current_turn"] += tokens
+    return components
+
+class ContextStats:
+    def __init__(self, max_reports: int = 20):
+        self.requests = 0
+        self.compacted = 0
+        self.prompt_tokens = 0
+        self.trimmed_tokens = 0
+        self.kb_chunks_dropped = 0
+        self.recent = deque(maxlen=max_reports)
+
+    def record_request(self, tokens: int):
+        self.requests += 1
+        self.prompt_tokens += tokens
+
+    def record_compaction(self, report: dict):
+        self.compacted += 1
+        self.trimmed_tokens += report["before"] - report["after"]
+        self.recent.append(report)
+
+    def record_kb(self, dropped: int):
+        self.kb_chunks_dropped += dropped
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "compacted": self.compacted,
+            "avg_prompt_tokens": self.prompt_tokens / self.requests if self.requests else 0.0,
+            "trimmed_tokens": self.trimmed_tokens,
+            "kb_chunks_dropped": self.kb_chunks_dropped,
+            "recent": list(self.recent),
+        }
+
+context_stats = ContextStats()
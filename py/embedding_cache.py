@@ -0,0 +1,330 @@
+"""
+跨知识库共享的持久化嵌入缓存：键为 (提供方, 模型, sha256(文本))，重建知识库、同一文件加入其他知识库、
+重复的查询语句都不再重新请求嵌入。
+每个 (提供方, 模型) 的向量存放在一个内存映射文件中（float16 或 float32，按行存储），
+SQLite 索引记录 哈希 -> 行号 和最近使用时间；总条目数超过上限时淘汰最久未用的条目，空出的行被复用。
+构建在线程池和事件循环中都会调用，所有操作由一把锁保护，嵌入请求本身在锁外执行。
+多个 worker 共享同一个索引和向量文件：行号的分配、扩容和淘汰都在 SQLite 的 BEGIN IMMEDIATE 事务中
+以数据库里的 used/capacity 为准，其他 worker 扩容后按新的行数重新映射。
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from py.get_setting import USER_DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_DIR = os.path.join(USER_DATA_DIR, "embedding_cache")
+INITIAL_ROWS = 1024
+# 超出上限时一次淘汰的比例，避免每次写入都触发淘汰
+EVICT_RATIO = 0.1
+
+class _Space:
+    """一个 (提供方, 模型) 的向量文件"""
+    def __init__(self, space_id: int, dim: int, dtype: str, capacity: int, path: str):
+        self.id = space_id
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.path = path
+        self.array = None
+        self._map()
+
+    def _map(self):
+        size = self.capacity * self.dim * self.dtype.itemsize
+        with open(self.path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.array = np.memmap(self.path, dtype=self.dtype, mode="r+", shape=(self.capacity, self.dim))
+
+    def remap(self, capacity: int):
+        """其他 worker 扩容后（或本进程扩容时）按新的行数重新映射"""
+        if capacity == self.capacity:
+            return
+        self.array.flush()
+        self.array = None
+        self.capacity = capacity
+        self._map()
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+
+class EmbeddingCache:
+    def __init__(self, directory: str = EMBEDDING_CACHE_DIR):
+        self.directory = directory
+        self.config = {}
+        self._db = None
+        self._failed = False
+        self._spaces = {}  # (provider, model) -> _Space
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def configure(self, config: dict):
+        """从 KBSettings['embeddingCache'] 读取配置"""
+        self.config = dict(config or {})
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.config.get("enabled", True)) and not self._failed
+
+    def _open(self):
+        if self._db is None:
+            Path(self.directory).mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.directory, "index.db"), check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS spaces (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    provider TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    dtype TEXT NOT NULL,
+                    capacity INTEGER NOT NULL,
+                    used INTEGER NOT NULL,
+                    UNIQUE (provider, model)
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    space INTEGER NOT NULL,
+                    hash BLOB NOT NULL,
+                    slot INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (space, hash)
+                ) WITHOUT ROWID
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries (last_used)")
+            db.execute("CREATE TABLE IF NOT EXISTS free_slots (space INTEGER NOT NULL, slot INTEGER NOT NULL)")
+            self._db = db
+        return self._db
+
+    def _space(self, provider: str, model: str, dim: int = None):
+        """返回已有的向量空间；dim 不为空且不存在时创建"""
+        key = (provider, model)
+        space = self._spaces.get(key)
+        if space is not None:
+            return space
+        db = self._open()
+        row = db.execute(
+            "SELECT id, dim, dtype, capacity, used FROM spaces WHERE provider = ? AND model = ?", (provider, model)
+        ).fetchone()
+        if row is None:
+            if dim is None:
+                return None
+            dtype = "float16" if self.config.get("dtype", "float16") == "float16" else "float32"
+            # 其他 worker 可能同时创建，以先插入的为准
+            db.execute(
+                "INSERT OR IGNORE INTO spaces (provider, model, dim, dtype, capacity, used) VALUES (?, ?, ?, ?, ?, 0)",
+                (provider, model, dim, dtype, INITIAL_ROWS)
+            )
+            row = db.execute(
+                "SELECT id, dim, dtype, capacity, used FROM spaces WHERE provider = ? AND model = ?", (provider, model)
+            ).fetchone()
+        space_id, dim, dtype, capacity, _ = row
+        space = self._spaces[key] = _Space(space_id, dim, dtype, capacity, os.path.join(self.directory, f"{space_id}.{dtype}"))
+        return space
+
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def get_many(self, provider: str, model: str, texts: list) -> list:
+        """返回与 texts 对应的向量列表，未命中的位置为 None"""
+        if not self.enabled or not texts:
+            return [None] * len(texts)
+        hashes = [self._hash(text) for text in texts]
+        try:
+            with self._lock:
+                space = self._space(provider, model)
+                if space is None:
+                    self.misses += len(texts)
+                    return [None] * len(texts)
+                slots = {}
+                unique = list(dict.fromkeys(hashes))
+                for i in range(0, len(unique), 500):
+                    part = unique[i:i + 500]
+                    rows = self._db.execute(
+                        f"SELECT hash, slot FROM entries WHERE space = ? AND hash IN ({','.join('?' * len(part))})",
+                        (space.id, *part)
+                    ).fetchall()
+                    slots.update(rows)
+                if slots and max(slots.values()) >= space.capacity:
+                    # 其他 worker 扩容过
+                    space.remap(self._db.execute("SELECT capacity FROM spaces WHERE id = ?", (space.id,)).fetchone()[0])
+                if slots:
+                    self._db.executemany(
+                        "UPDATE entries SET last_used = ? WHERE space = ? AND hash = ?",
+                        [(time.time(), space.id, h) for h in slots]
+                    )
+                result = [
+                    space.array[slots[h]].astype(np.float32).tolist() if h in slots else None
+                    for h in hashes
+                ]
+                hits = sum(1 for vector in result if vector is not None)
+                self.hits += hits
+                self.misses += len(texts) - hits
+                return result
+        except Exception as e:
+            self._disable(e)
+            return [None] * len(texts)
+
+    def put_many(self, provider: str, model: str, texts: list, vectors: list):
+        if not self.enabled or not texts:
+            return
+        try:
+            with self._lock:
+                space = self._space(provider, model, len(vectors[0]))
+                # 同一批中重复的文本只占一行
+                items = {}
+                for text, vector in zip(texts, vectors):
+                    if len(vector) == space.dim:
+                        items[self._hash(text)] = vector
+                if not items:
+                    return
+                db = self._db
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    stored = self._store(db, space, items)
+                    evicted = self._evict(db)
+                    db.execute("COMMIT")
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    raise
+                self.stores += stored
+                self.evictions += evicted
+        except Exception as e:
+            self._disable(e)
+
+    def _store(self, db, space: _Space, items: dict) -> int:
+        """在写事务中为新的哈希分配行号并写入向量，返回新写入的条数"""
+        hashes = list(items)
+        existing = set()
+        for i in range(0, len(hashes), 500):
+            part = hashes[i:i + 500]
+            existing.update(h for (h,) in db.execute(
+                f"SELECT hash FROM entries WHERE space = ? AND hash IN ({','.join('?' * len(part))})",
+                (space.id, *part)
+            ))
+        new = [h for h in hashes if h not in existing]
+        if not new:
+            return 0
+        # 先复用淘汰空出的行，不够时从数据库中的 used 往后分配
+        free = db.execute("SELECT rowid, slot FROM free_slots WHERE space = ? LIMIT ?", (space.id, len(new))).fetchall()
+        db.executemany("DELETE FROM free_slots WHERE rowid = ?", [(rowid,) for rowid, _ in free])
+        capacity, used = db.execute("SELECT capacity, used FROM spaces WHERE id = ?", (space.id,)).fetchone()
+        slots = [slot for _, slot in free] + list(range(used, used + len(new) - len(free)))
+        used += len(new) - len(free)
+        while capacity < used:
+            capacity *= 2
+        space.remap(capacity)
+        for h, slot in zip(new, slots):
+            space.array[slot] = items[h]
+        now = time.time()
+        db.executemany(
+            "INSERT INTO entries (space, hash, slot, last_used) VALUES (?, ?, ?, ?)",
+            [(space.id, h, slot, now) for h, slot in zip(new, slots)]
+        )
+        db.execute("UPDATE spaces SET capacity = ?, used = ? WHERE id = ?", (capacity, used, space.id))
+        return len(new)
+
+    def _evict(self, db) -> int:
+        max_entries = self.config.get("maxEntries", 500_000)
+        (count,) = db.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if not max_entries or count <= max_entries:
+            return 0
+        evict = count - max_entries + int(max_entries * EVICT_RATIO)
+        rows = db.execute("SELECT space, hash, slot FROM entries ORDER BY last_used LIMIT ?", (evict,)).fetchall()
+        db.executemany("DELETE FROM entries WHERE space = ? AND hash = ?", [(space, h) for space, h, _ in rows])
+        db.executemany("INSERT INTO free_slots (space, slot) VALUES (?, ?)", [(space, slot) for space, _, slot in rows])
+        return len(rows)
+
+    def _disable(self, error: Exception):
+        self._failed = True
+        logger.warning(f"Embedding cache disabled: {error!r}")
+
+    def close(self):
+        with self._lock:
+            for space in self._spaces.values():
+                space.close()
+            self._spaces = {}
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "max_entries": self.config.get("maxEntries", 500_000),
+            }
+            if self._db is not None:
+                stats["entries"] = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                stats["bytes"] = sum(space.capacity * space.dim * space.dtype.itemsize for space in self._spaces.values())
+            return stats
+
+embedding_cache = EmbeddingCache()
+
+class CachedEmbeddings(Embeddings):
+    """包装 langchain 的嵌入对象：先查缓存，只把未命中的文本交给上游"""
+    def __init__(self, embeddings: Embeddings, provider: str, model: str, cache: EmbeddingCache = embedding_cache):
+        self.embeddings = embeddings
+        self.provider = provider
+        self.model = model
+        self.cache = cache
+
+    def _split(self, texts):
+        vectors = self.cache.get_many(self.provider, self.model, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        return vectors, missing
+
+    def _merge(self, texts, vectors, missing, new_vectors):
+        self.cache.put_many(self.provider, self.model, [texts[i] for i in missing], new_vectors)
+        for i, vector in zip(missing, new_vectors):
+            vectors[i] = vector
+        return vectors
+
+    def embed_documents(self, texts):
+        vectors, missing = self._split(texts)
+        if not missing:
+            return vectors
+        return self._merge(texts, vectors, missing, self.embeddings.embed_documents([texts[i] for i in missing]))
+
+    async def aembed_documents(self, texts):
+        vectors, missing = self._split(texts)
+        if not missing:
+            return vectors
+        return self._merge(texts, vectors, missing, await self.embeddings.aembed_documents([texts[i] for i in missing]))
+
+    def embed_query(self, text):
+        vector = self.cache.get_many(self.provider, self.model, [text])[0]
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put_many(self.provider, self.model, [text], [vector])
+        return vector
+
+    async def aembed_query(self, text):
+        vector = self.cache.get_many(self.provider, self.model, [text])[0]
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            self.cache.put_many(self.provider, self.model, [text], [vector])
+        return vector
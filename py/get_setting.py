@@ -1,7 +1,10 @@
+import asyncio
+import copy
 import json
 import os
 import sys
 import aiosqlite
+from contextlib import asynccontextmanager
 from pathlib import Path
 HOST = None
 PORT = None
@@ -92,44 +95,374 @@ with open(SETTINGS_TEMPLATE_FILE, 'r', encoding='utf-8') as f:
 
 # 修改数据库路径定义
 DATABASE_PATH = os.path.join(USER_DATA_DIR, 'super_agent_party.db')
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA mmap_size=67108864",
+)
+
+async def _create_tables(db):
+    # settings 为旧版整行存储，仅用于迁移
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+    # 按顶层配置项（mcpServers、knowledgeBases、agents……）分行存储
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS settings_sections (
+            name TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+    async with db.execute('SELECT COUNT(*) FROM settings_sections') as cursor:
+        (section_count,) = await cursor.fetchone()
+    if section_count == 0:
+        async with db.execute('SELECT data FROM settings WHERE id = 1') as cursor:
+            row = await cursor.fetchone()
+        if row:
+            legacy = json.loads(row[0])
+            await db.executemany(
+                'INSERT OR REPLACE INTO settings_sections (name, data) VALUES (?, ?)',
+                [(name, json.dumps(value, ensure_ascii=False)) for name, value in legacy.items()]
+            )
+            await db.execute('DELETE FROM settings WHERE id = 1')
+    await db.commit()
+
 # 添加数据库初始化函数
 async def init_db():
     Path(USER_DATA_DIR).mkdir(parents=True, exist_ok=True)
     async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY,
-                data TEXT NOT NULL
-            )
-        ''')
-        await db.commit()
-# 修改 load_settings 函数
-async def load_settings():
+        await _create_tables(db)
+
+class SettingsDB:
+    """
+    长连接的SQLite连接池：WAL模式下多个读连接并发读取，单个写连接串行写入。
+    在 lifespan 中 open()，关闭时 close()；未打开时调用方回退到一次性连接。
+    """
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers = readers
+        self._writer = None
+        self._write_lock = None
+        self._read_pool = None
+        self._read_conns = []
+        self._loop = None
+
+    @property
+    def is_open(self) -> bool:
+        # 连接池绑定在创建它的事件循环上（QQ机器人等线程中的循环不能复用）
+        if self._writer is None:
+            return False
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def _connect(self):
+        db = await aiosqlite.connect(self.path)
+        for pragma in SQLITE_PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        Path(os.path.dirname(self.path)).mkdir(parents=True, exist_ok=True)
+        self._loop = asyncio.get_running_loop()
+        self._writer = await self._connect()
+        await _create_tables(self._writer)
+        self._write_lock = asyncio.Lock()
+        self._read_pool = asyncio.Queue()
+        for _ in range(self.readers):
+            conn = await self._connect()
+            self._read_conns.append(conn)
+            self._read_pool.put_nowait(conn)
+
+    async def close(self):
+        conns = self._read_conns + ([self._writer] if self._writer else [])
+        self._writer = None
+        self._read_conns = []
+        self._read_pool = None
+        for conn in conns:
+            try:
+                await conn.close()
+            except Exception as e:
+                print(f"关闭数据库连接失败: {e}")
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._read_pool.get()
+        try:
+            yield conn
+        finally:
+            if self._read_pool is not None:
+                self._read_pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self._write_lock:
+            yield self._writer
+
+settings_db = SettingsDB(DATABASE_PATH)
+
+async def _fetch_sections(names=None):
+    """读取配置分区，names 为空时读取全部，返回 {name: json字符串}"""
+    sql = 'SELECT name, data FROM settings_sections'
+    params = ()
+    if names:
+        sql += f" WHERE name IN ({','.join('?' * len(names))})"
+        params = tuple(names)
+    if settings_db.is_open:
+        async with settings_db.reader() as db:
+            async with db.execute(sql, params) as cursor:
+                return dict(await cursor.fetchall())
     await init_db()
     async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute('SELECT data FROM settings WHERE id = 1') as cursor:
-            row = await cursor.fetchone()
-            if row:
-                settings = json.loads(row[0])
-                # 合并默认设置（保持原有逻辑）
-                def merge_defaults(default, target):
-                    for key, value in default.items():
-                        if key not in target:
-                            target[key] = value
-                        elif isinstance(value, dict):
-                            merge_defaults(value, target[key])
-                merge_defaults(default_settings, settings)
-                return settings
-            else:
-                # 如果in_docker()返回True，则修改默认配置
-                if in_docker():
-                    default_settings["isdocker"] = True
-                # 插入默认配置
-                await save_settings(default_settings)
-                return default_settings.copy()
+        async with db.execute(sql, params) as cursor:
+            return dict(await cursor.fetchall())
+
+async def _write_sections(db, changed, removed):
+    if changed:
+        await db.executemany(
+            'INSERT OR REPLACE INTO settings_sections (name, data) VALUES (?, ?)',
+            list(changed.items())
+        )
+    if removed:
+        await db.executemany('DELETE FROM settings_sections WHERE name = ?', [(name,) for name in removed])
+    await db.commit()
+
+async def _store_sections(changed, removed=()):
+    """在一个事务中写入变化的分区、删除移除的分区"""
+    if not changed and not removed:
+        return
+    if settings_db.is_open:
+        async with settings_db.writer() as db:
+            await _write_sections(db, changed, removed)
+        return
+    await init_db()
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await _write_sections(db, changed, removed)
+
+# 进程内配置缓存：只在 save_settings / patch_settings 时失效，版本号单调递增
+_settings_cache = None
+_settings_version = 0
+# 数据库中每个分区当前的序列化内容，用于整体保存时只写入变化的分区
+_section_data = {}
+
+def get_settings_version():
+    """当前配置版本号，每次 save_settings / patch_settings 后加一"""
+    return _settings_version
+
+def get_cached_settings():
+    """同步读取已加载的配置快照，尚未加载时返回 None"""
+    return _settings_cache
+
+# 配置保存后的同步回调（多 worker 模式下用于通知其他进程）
+_settings_listeners = []
+
+def add_settings_listener(callback):
+    _settings_listeners.append(callback)
+
+def invalidate_settings_cache():
+    """其他进程修改了数据库中的配置：丢弃缓存并递增版本号，下次 load_settings 时重新读取"""
+    global _settings_cache, _section_data, _settings_version
+    _settings_version += 1
+    _settings_cache = None
+    _section_data = {}
+
+def merge_defaults(default, target):
+    """合并默认设置（保持原有逻辑）；补上的默认值是副本，修改配置不会改动 default_settings"""
+    for key, value in default.items():
+        if key not in target:
+            target[key] = copy.deepcopy(value)
+        elif isinstance(value, dict):
+            merge_defaults(value, target[key])
+
+# 修改 load_settings 函数
+async def load_settings():
+    """
+    返回进程内共享的配置快照，调用方只能读取，不要修改。
+    需要修改后保存时，请先 copy.deepcopy 再调用 save_settings，或使用 patch_settings。
+    """
+    if _settings_cache is not None:
+        return _settings_cache
+    version = _settings_version
+    sections = await _fetch_sections()
+    if sections:
+        settings = {name: json.loads(data) for name, data in sections.items()}
+        merge_defaults(default_settings, settings)
+        _set_cache(settings, sections, version)
+        return settings
+    else:
+        # 如果in_docker()返回True，则修改默认配置
+        if in_docker():
+            default_settings["isdocker"] = True
+        # 插入默认配置
+        await save_settings(default_settings)
+        return await load_settings()
+
+async def load_settings_sections(*names):
+    """只读取需要的配置分区，返回 {name: value}，同样是只读快照"""
+    if _settings_cache is not None:
+        return {name: _settings_cache.get(name) for name in names}
+    sections = await _fetch_sections(names)
+    result = {}
+    for name in names:
+        if name in sections:
+            result[name] = json.loads(sections[name])
+            if isinstance(default_settings.get(name), dict):
+                merge_defaults(default_settings[name], result[name])
+        else:
+            result[name] = copy.deepcopy(default_settings.get(name))
+    return result
+
+def _set_cache(settings, sections, version):
+    # 读取期间若有新的保存，丢弃这次读到的旧数据
+    global _settings_cache, _section_data
+    if version == _settings_version:
+        _settings_cache = settings
+        _section_data = sections
+
+def _publish(settings, sections):
+    global _settings_cache, _section_data, _settings_version
+    merge_defaults(default_settings, settings)
+    _settings_version += 1
+    _settings_cache = settings
+    _section_data = sections
+    for callback in _settings_listeners:
+        callback()
+
 # 修改 save_settings 函数
 async def save_settings(settings):
-    data = json.dumps(settings, ensure_ascii=False, indent=2)
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute('INSERT OR REPLACE INTO settings (id, data) VALUES (1, ?)', (data,))
-        await db.commit()
\ No newline at end of file
+    """整体保存，只有内容发生变化的分区才会写入数据库"""
+    if _settings_cache is None:
+        stored = await _fetch_sections()
+    else:
+        stored = _section_data
+    sections = {name: json.dumps(value, ensure_ascii=False) for name, value in settings.items()}
+    changed = {name: data for name, data in sections.items() if stored.get(name) != data}
+    removed = [name for name in stored if name not in sections]
+    await _store_sections(changed, removed)
+    # 缓存与调用方传入的对象解耦，避免外部修改污染快照；未变化的分区沿用旧对象
+    previous = _settings_cache or {}
+    cached = {}
+    for name, data in sections.items():
+        if name not in changed and name in previous:
+            cached[name] = previous[name]
+        else:
+            cached[name] = json.loads(data)
+    _publish(cached, sections)
+
+def _split_pointer(path: str):
+    if not path.startswith("/"):
+        raise ValueError(f"Invalid patch path: {path}")
+    return [part.replace("~1", "/").replace("~0", "~") for part in path[1:].split("/")]
+
+def _apply_operation(container, key, op, value):
+    if isinstance(container, list):
+        if op == "add" and key == "-":
+            container.append(value)
+            return
+        index = int(key)
+        if op == "add":
+            container.insert(index, value)
+        elif op == "replace":
+            container[index] = value
+        else:
+            del container[index]
+    elif isinstance(container, dict):
+        if op == "remove":
+            del container[key]
+        elif op == "replace" and key not in container:
+            raise KeyError(key)
+        else:
+            container[key] = value
+    else:
+        raise ValueError(f"Cannot apply {op} to a {type(container).__name__}")
+
+_REMOVED = object()
+
+async def patch_settings(operations):
+    """
+    JSON-Patch 风格的局部更新，只重写受影响的顶层分区。
+    operations: [{"op": "add"|"replace"|"remove", "path": "/webSearch/engine", "value": ...}]
+    """
+    current = await load_settings()
+    touched = {}
+    for operation in operations:
+        op = operation.get("op")
+        if op not in ("add", "replace", "remove"):
+            raise ValueError(f"Unsupported patch op: {op}")
+        parts = _split_pointer(operation.get("path", ""))
+        section = parts[0]
+        if len(parts) == 1:
+            touched[section] = _REMOVED if op == "remove" else operation.get("value")
+            continue
+        if section not in touched:
+            touched[section] = copy.deepcopy(current[section]) if section in current else _REMOVED
+        target = touched[section]
+        if target is _REMOVED:
+            raise KeyError(section)
+        for part in parts[1:-1]:
+            target = target[int(part)] if isinstance(target, list) else target[part]
+        _apply_operation(target, parts[-1], op, operation.get("value"))
+
+    changed = {name: json.dumps(value, ensure_ascii=False) for name, value in touched.items() if value is not _REMOVED}
+    removed = [name for name, value in touched.items() if value is _REMOVED]
+    await _store_sections(changed, removed)
+    # 基于最新快照合并，避免覆盖写入期间其他请求的修改
+    latest = _settings_cache if _settings_cache is not None else current
+    settings = {name: value for name, value in latest.items() if name not in removed}
+    sections = {name: data for name, data in _section_data.items() if name not in removed}
+    for name, data in changed.items():
+        settings[name] = touched[name]
+        sections[name] = data
+    _publish(settings, sections)
+    return settings
+
+async def main():
+    """并发读写延迟的微基准：一次性连接 vs 长连接池，整体保存 vs 局部更新"""
+    import statistics
+    import tempfile
+    import time
+    global DATABASE_PATH, settings_db
+    sections = {name: json.dumps(value, ensure_ascii=False) for name, value in default_settings.items()}
+    one_section = {"temperature": json.dumps(0.5)}
+    concurrency, rounds = 32, 20
+
+    async def run(label):
+        async def timed(op):
+            start = time.perf_counter()
+            await op()
+            return (time.perf_counter() - start) * 1000
+        ops = (
+            ("read", _fetch_sections),
+            ("write", lambda: _store_sections(sections)),
+            ("patch", lambda: _store_sections(one_section)),
+        )
+        for kind, op in ops:
+            latencies = []
+            for _ in range(rounds):
+                latencies += await asyncio.gather(*[timed(op) for _ in range(concurrency)])
+            latencies.sort()
+            print(f"{label:8} {kind:5} p50={statistics.median(latencies):.2f}ms "
+                  f"p99={latencies[int(len(latencies) * 0.99) - 1]:.2f}ms n={len(latencies)}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        DATABASE_PATH = os.path.join(tmp, "bench.db")
+        await init_db()
+        await _store_sections(sections)
+        await run("one-shot")
+        settings_db = SettingsDB(DATABASE_PATH)
+        await settings_db.open()
+        await run("pooled")
+        await settings_db.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,248 @@
+"""
+知识库的原生 BM25 倒排索引：
+- 分词对中日韩文字按字二元组（bigram）切分，其余按字母数字单词切分并转小写，不依赖词典；
+- 构建时把词表（排好序的 64 位词哈希）、倒排表（按词排序的文档号和词频）、文档长度和 IDF 写成 numpy 数组，
+  查询时以内存映射方式打开，加载时不需要解析词表；
+- 查询把各个词的倒排表拼接后用 np.bincount 一次算出所有文档的得分，再用 argpartition 取前 k 个。
+
+每次构建写入新的目录并更新 bm25.json 指针，正在被查询的旧索引（Windows 下内存映射的文件无法覆盖）在之后的构建中清理。
+
+基准测试（合成的无空格中文语料，对比 BM25Retriever + bm25_index.json 的加载、查询耗时和召回）：
+    python -m py.kb_bm25 --docs 5000 --queries 200
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, List
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+logger = logging.getLogger(__name__)
+
+POINTER_FILE = "bm25.json"
+FORMAT_VERSION = 1
+ARRAYS = ("terms", "offsets", "doc_ids", "tfs", "doc_lens", "idf")
+
+_CJK = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"  # 假名、汉字、谚文
+# 连续的中日韩字符，或不含中日韩字符的字母数字串（\w 本身包含汉字）
+TOKEN_RE = re.compile(f"[{_CJK}]+|[^\\W_{_CJK}]+")
+CJK_RE = re.compile(f"[{_CJK}]")
+
+def tokenize(text: str) -> List[str]:
+    """中日韩文字切成相邻两字（单独一个字时保留单字），其他单词转小写"""
+    tokens = []
+    for run in TOKEN_RE.findall(text.lower()):
+        if CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+def term_hashes(terms) -> np.ndarray:
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little") for term in terms),
+        dtype=np.uint64, count=len(terms),
+    )
+
+def build_bm25_index(texts: List[str], kb_path, k1: float = 1.5, b: float = 0.75) -> Path:
+    """为 texts（与向量索引同序）构建倒排索引并写入 kb_path，返回索引目录"""
+    vocab = {}
+    term_ids, doc_ids, tfs = [], [], []
+    doc_lens = np.zeros(len(texts), dtype=np.uint32)
+    for doc_id, text in enumerate(texts):
+        tokens = tokenize(text)
+        doc_lens[doc_id] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            doc_ids.append(doc_id)
+            tfs.append(tf)
+    # 词号按词哈希排序重新编号，查询时在哈希数组上二分查找
+    hashes = term_hashes(list(vocab))
+    rank = np.empty(len(vocab), dtype=np.int64)
+    rank[np.argsort(hashes)] = np.arange(len(vocab))
+    term_ids = rank[np.asarray(term_ids, dtype=np.int64)]
+    # 稳定排序：同一个词的倒排表内文档号保持升序
+    order = np.argsort(term_ids, kind="stable")
+    df = np.bincount(term_ids, minlength=len(vocab))
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(df, out=offsets[1:])
+    num_docs = len(texts)
+    arrays = {
+        "terms": np.sort(hashes),
+        "offsets": offsets,
+        "doc_ids": np.asarray(doc_ids, dtype=np.uint32)[order],
+        "tfs": np.minimum(np.asarray(tfs, dtype=np.int64), np.iinfo(np.uint16).max).astype(np.uint16)[order],
+        "doc_lens": doc_lens,
+        # Lucene 的 IDF，始终为正
+        "idf": np.log1p((num_docs - df + 0.5) / (df + 0.5)).astype(np.float32),
+    }
+
+    kb_path = Path(kb_path)
+    index_dir = kb_path / f"bm25-{time.time_ns()}"
+    index_dir.mkdir(parents=True)
+    for name in ARRAYS:
+        np.save(index_dir / f"{name}.npy", arrays[name])
+    meta = {
+        "version": FORMAT_VERSION,
+        "dir": index_dir.name,
+        "tokenizer": "cjk-bigram",
+        "num_docs": num_docs,
+        "avgdl": float(doc_lens.mean()) if num_docs else 0.0,
+        "k1": k1,
+        "b": b,
+    }
+    tmp = kb_path / (POINTER_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, kb_path / POINTER_FILE)
+    _remove_stale(kb_path, index_dir.name)
+    return index_dir
+
+def _remove_stale(kb_path: Path, current: str):
+    for path in kb_path.glob("bm25-*"):
+        if path.name != current:
+            # 仍被查询线程映射的文件在 Windows 上删不掉，下次构建再删
+            shutil.rmtree(path, ignore_errors=True)
+
+class BM25Index:
+    """内存映射的倒排索引"""
+    def __init__(self, kb_path):
+        kb_path = Path(kb_path)
+        with open(kb_path / POINTER_FILE, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported BM25 index version: {meta.get('version')}")
+        index_dir = kb_path / meta["dir"]
+        for name in ARRAYS:
+            setattr(self, name, np.load(index_dir / f"{name}.npy", mmap_mode="r"))
+        self.num_docs = meta["num_docs"]
+        self.avgdl = meta["avgdl"] or 1.0
+        self.k1 = meta["k1"]
+        self.b = meta["b"]
+        # 文档长度归一化项只与文档有关，加载时算一次
+        self.norm = (self.k1 * (1 - self.b + self.b * self.doc_lens / self.avgdl)).astype(np.float32)
+
+    def score(self, query: str) -> np.ndarray:
+        """返回每个文档的 BM25 得分；查询中重复的词按出现次数累加"""
+        tokens = Counter(tokenize(query))
+        hashes = term_hashes(list(tokens))
+        positions = np.minimum(np.searchsorted(self.terms, hashes), len(self.terms) - 1)
+        counts = {int(position): count for position, hash_, count in zip(positions, hashes, tokens.values())
+                  if len(self.terms) and self.terms[position] == hash_}
+        if not counts:
+            return np.zeros(self.num_docs, dtype=np.float32)
+        ids, weights = [], []
+        for term, count in counts.items():
+            start, end = self.offsets[term], self.offsets[term + 1]
+            doc_ids = self.doc_ids[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            ids.append(doc_ids)
+            weights.append(count * self.idf[term] * tfs * (self.k1 + 1) / (tfs + self.norm[doc_ids]))
+        return np.bincount(np.concatenate(ids), weights=np.concatenate(weights), minlength=self.num_docs)
+
+    def top_k(self, query: str, k: int) -> List[int]:
+        """得分最高的 k 个文档号（只包含得分大于 0 的文档）"""
+        scores = self.score(query)
+        k = min(k, self.num_docs)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k] if k < self.num_docs else np.arange(self.num_docs)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [int(i) for i in top if scores[i] > 0]
+
+class NativeBM25Retriever(BaseRetriever):
+    """EnsembleRetriever 中替代 BM25Retriever；docs 与索引中的文档号一一对应"""
+    index: Any
+    docs: List[Document]
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return [self.docs[i] for i in self.index.top_k(query, self.k)]
+
+def _corpus(num_docs: int, seed: int = 0):
+    """无空格的中文段落，夹杂少量英文词，模拟知识库分块"""
+    import random
+    rng = random.Random(seed)
+    words = ["知识库", "检索", "向量", "模型", "智能体", "工具", "调用", "配置", "插件", "记忆", "语音", "对话",
+             "文件", "上传", "部署", "服务器", "接口", "浏览器", "桌面", "机器人", "提示词", "多模态", "翻译", "搜索"]
+    words += [chr(0x4e00 + rng.randrange(0x5000)) + chr(0x4e00 + rng.randrange(0x5000)) for _ in range(3000)]
+    english = ["agent", "party", "LLM", "embedding", "MCP", "API"]
+    texts = []
+    for _ in range(num_docs):
+        sentences = []
+        for _ in range(rng.randint(4, 10)):
+            sentence = "".join(rng.choice(words) for _ in range(rng.randint(6, 14)))
+            if rng.random() < 0.3:
+                sentence += " " + rng.choice(english) + " "
+            sentences.append(sentence + "。")
+        texts.append("".join(sentences))
+    return texts, words[:24] + english
+
+def _benchmark(num_docs: int, num_queries: int, k: int):
+    import random
+    import tempfile
+    from langchain_community.retrievers import BM25Retriever
+    texts, query_words = _corpus(num_docs)
+    docs = [Document(page_content=text, metadata={"doc_id": str(i)}) for i, text in enumerate(texts)]
+    rng = random.Random(1)
+    queries = [rng.choice(query_words) + "的" + rng.choice(query_words) for _ in range(num_queries)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 现有实现：bm25_index.json + BM25Retriever（按空白分词）
+        with open(os.path.join(tmp, "bm25_index.json"), "w", encoding="utf-8") as f:
+            json.dump({"docs": [{"page_content": d.page_content, "metadata": d.metadata} for d in docs]}, f, ensure_ascii=False)
+        start = time.perf_counter()
+        with open(os.path.join(tmp, "bm25_index.json"), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        legacy = BM25Retriever.from_documents([Document(**d) for d in data["docs"]], k=k)
+        legacy_load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        build_bm25_index(texts, tmp)
+        native_build = time.perf_counter() - start
+        start = time.perf_counter()
+        native = NativeBM25Retriever(index=BM25Index(tmp), docs=docs, k=k)
+        native_load = time.perf_counter() - start
+
+        def run(retriever):
+            hits = 0
+            start = time.perf_counter()
+            for query in queries:
+                results = retriever.invoke(query)
+                # 召回：前 k 个结果中包含查询词的比例
+                words = query.split("的")
+                hits += sum(1 for doc in results if any(word in doc.page_content for word in words))
+            return (time.perf_counter() - start) / len(queries) * 1000, hits / (len(queries) * k)
+
+        legacy_ms, legacy_precision = run(legacy)
+        native_ms, native_precision = run(native)
+        print(f"{num_docs} docs, {num_queries} queries, k={k}")
+        print(f"{'':<28}{'load ms':>10}{'query ms':>10}{'precision':>11}")
+        print(f"{'BM25Retriever (json)':<28}{legacy_load * 1000:>10.1f}{legacy_ms:>10.2f}{legacy_precision:>11.2f}")
+        print(f"{'native (mmap, cjk-bigram)':<28}{native_load * 1000:>10.1f}{native_ms:>10.2f}{native_precision:>11.2f}")
+        print(f"native build {native_build * 1000:.1f} ms, "
+              f"index {sum(p.stat().st_size for p in Path(tmp).glob('bm25-*/*')) / 1024:.0f} KiB")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the native BM25 index against BM25Retriever")
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+    _benchmark(args.docs, args.queries, args.k)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+知识库构建时的并发嵌入：文本按 batch_size 分批，同时最多 concurrency 个批次在请求中，
+遇到限流（429）、5xx 或连接错误时按 Retry-After 或指数退避重试，结果按原顺序拼接，
+进度（已完成数量、每秒块数、预计剩余时间）通过回调定期上报。
+
+自检（本地假嵌入服务器，随机返回 429，验证顺序与重试并对比串行批次的吞吐）：
+    python -m py.kb_embedding --chunks 2000
+"""
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+PROGRESS_INTERVAL = 0.5
+
+class EmbeddingProgress:
+    def __init__(self, total: int, callback=None):
+        self.total = total
+        self.done = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self._callback = callback
+        self._reported = 0.0
+
+    def to_dict(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        return {
+            "stage": "embedding",
+            "done": self.done,
+            "total": self.total,
+            "retries": self.retries,
+            "chunks_per_sec": round(rate, 2),
+            "eta_seconds": round((self.total - self.done) / rate, 1) if rate else None,
+        }
+
+    async def advance(self, count: int, force: bool = False):
+        self.done += count
+        now = time.monotonic()
+        # 多 worker 时上报会写入 SQLite，限制频率
+        if self._callback is not None and (force or now - self._reported >= PROGRESS_INTERVAL):
+            self._reported = now
+            await self._callback(self.to_dict())
+
+def retry_delay(error: Exception, attempt: int):
+    """可重试的错误返回等待秒数，否则返回 None"""
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status is None:
+        # openai 的 APIConnectionError / APITimeoutError 没有状态码
+        retryable = isinstance(error, (httpx.TransportError, ConnectionError, asyncio.TimeoutError)) \
+            or type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+        if not retryable:
+            return None
+    elif status not in RETRY_STATUS:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    try:
+        retry_after = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        retry_after = None
+    if retry_after is not None:
+        return min(retry_after, 60.0)
+    return min(2 ** attempt, 30.0) * (0.5 + random.random())
+
+async def embed_batch(embeddings, texts: list, max_retries: int = 5, progress: EmbeddingProgress = None) -> list:
+    attempt = 0
+    while True:
+        try:
+            return await embeddings.aembed_documents(texts)
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt >= max_retries:
+                raise
+            attempt += 1
+            if progress is not None:
+                progress.retries += 1
+            logger.warning(f"Embedding batch failed ({e!r}), retry {attempt}/{max_retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+async def embed_documents(embeddings, texts: list, batch_size: int = 64, concurrency: int = 4,
+                          max_retries: int = 5, on_progress=None) -> list:
+    """并发嵌入 texts，返回与 texts 顺序一致的向量列表；任一批次最终失败时取消其余批次并抛出异常"""
+    batch_size = max(1, batch_size)
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    progress = EmbeddingProgress(len(texts), on_progress)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = [None] * len(batches)
+
+    async def run(index: int):
+        async with semaphore:
+            results[index] = await embed_batch(embeddings, batches[index], max_retries, progress)
+            await progress.advance(len(batches[index]))
+
+    tasks = [asyncio.create_task(run(i)) for i in range(len(batches))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    await progress.advance(0, force=True)
+    logger.info(f"Embedded {len(texts)} chunks: {progress.to_dict()}")
+    return [vector for batch in results for vector in batch]
+
+def _fake_vector(text: str, dim: int = 8) -> list:
+    rng = random.Random(text)
+    return [rng.random() for _ in range(dim)]
+
+async def _fake_server(latency: float, error_rate: float):
+    """OpenAI 兼容的 /v1/embeddings，按 error_rate 随机返回 429"""
+    from aiohttp import web
+    rng = random.Random(0)
+    stats = {"requests": 0, "rate_limited": 0}
+
+    async def embeddings(request):
+        body = await request.json()
+        stats["requests"] += 1
+        await asyncio.sleep(latency)
+        if rng.random() < error_rate:
+            stats["rate_limited"] += 1
+            return web.json_response({"error": {"message": "rate limited"}}, status=429, headers={"Retry-After": "0.05"})
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response({
+            "object": "list",
+            "model": body.get("model"),
+            "data": [{"object": "embedding", "index": i, "embedding": _fake_vector(str(text))} for i, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        })
+
+    app = web.Application()
+    app.router.add_post("/v1/embeddings", embeddings)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v1", stats
+
+async def _selftest(chunks: int, batch_size: int, concurrency: int, latency: float, error_rate: float):
+    from langchain_openai import OpenAIEmbeddings
+    runner, base_url, stats = await _fake_server(latency, error_rate)
+    try:
+        # 关闭 SDK 自带的重试和分词，由 embed_batch 负责重试
+        embeddings = OpenAIEmbeddings(model="fake", openai_api_key="sk-test", openai_api_base=base_url,
+                                      check_embedding_ctx_length=False, max_retries=0)
+        texts = [f"chunk {i} 知识库内容" for i in range(chunks)]
+        reports = []
+        async def on_progress(report):
+            reports.append(report)
+        for name, size, workers in (("sequential batches of 5", 5, 1), ("pipeline", batch_size, concurrency)):
+            stats.update(requests=0, rate_limited=0)
+            reports.clear()
+            start = time.perf_counter()
+            vectors = await embed_documents(embeddings, texts, size, workers, max_retries=10, on_progress=on_progress)
+            elapsed = time.perf_counter() - start
+            assert len(vectors) == len(texts)
+            for text, vector in zip(texts, vectors):
+                assert vector == _fake_vector(text), "vectors are out of order"
+            assert reports and reports[-1]["done"] == len(texts)
+            print(f"{name:<24} {len(texts) / elapsed:>10,.0f} chunks/s  {stats['requests']:>5} requests  "
+                  f"{stats['rate_limited']:>4} rate limited  retries {reports[-1]['retries']}")
+    finally:
+        await runner.cleanup()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Embedding pipeline self-test against a local fake embedding server")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.2, help="fraction of requests answered with 429")
+    args = parser.parse_args()
+    asyncio.run(_selftest(args.chunks, args.batch_size, args.concurrency, args.latency, args.error_rate))
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,24 @@
 import asyncio
+import hashlib
+import logging
 import httpx
 from tiktoken_ext import openai_public
 import tiktoken_ext
 import os
-if __name__ == "__main__":
-    from load_files import get_files_json
+import threading
+import time
+from collections import OrderedDict
+# 直接运行 py/know_base.py 时使用同目录导入，python -m py.know_base 时使用包导入
+if __name__ == "__main__" and not __package__:
+    from load_files import get_file_content_if_changed
     from get_setting import load_settings,base_path
+    from kb_embedding import embed_documents
+    from kb_bm25 import build_bm25_index, BM25Index, NativeBM25Retriever, POINTER_FILE as BM25_POINTER_FILE
 else:
-    from py.load_files import get_files_json
+    from py.load_files import get_file_content_if_changed
     from py.get_setting import load_settings,base_path
+    from py.kb_embedding import embed_documents
+    from py.kb_bm25 import build_bm25_index, BM25Index, NativeBM25Retriever, POINTER_FILE as BM25_POINTER_FILE
 def get_tiktoken_cache_path():
     cache_path = os.path.join(base_path, "tiktoken_cache")
     os.makedirs(cache_path, exist_ok=True)
@@ -30,6 +40,9 @@ from typing import List, Dict
 
 from langchain_core.documents import Document
 from py.get_setting import KB_DIR
+from py.embedding_cache import CachedEmbeddings, embedding_cache
+
+logger = logging.getLogger(__name__)
 
 def chunk_documents(results: List[Dict], cur_kb) -> List[Dict]:
     """为每个文件单独分块并添加元数据"""
@@ -42,100 +55,81 @@ def chunk_documents(results: List[Dict], cur_kb) -> List[Dict]:
     all_docs = []
     for doc in results:
         chunks = text_splitter.split_text(doc["content"])
-        for chunk in chunks:
+        for i, chunk in enumerate(chunks):
             all_docs.append(Document(
                 page_content=chunk,
                 metadata={
                     "file_path": doc["file_path"],
                     "file_name": doc["file_name"],
-                    "doc_id": f"{doc['file_path']}_{len(all_docs)}"  # 唯一标识
+                    "doc_id": f"{doc['file_path']}_{i}"  # 唯一标识（文件内序号，增量更新时其他文件的标识不变）
                 }
             ))
     return all_docs
 
-def build_vector_store(docs: List[Document], kb_id, cur_kb: Dict, cur_vendor: str):
-    """构建并保存双索引（参数修正版）"""
+async def build_vector_store(docs: List[Document], kb_id, cur_kb: Dict, cur_vendor: str, kb_settings: Dict = None,
+                             on_progress=None, known_vectors: Dict = None):
+    """
+    构建并保存双索引。嵌入按 KBSettings 的 embeddingBatchSize / embeddingConcurrency 并发请求，
+    on_progress(dict) 定期收到进度（已完成数量、每秒块数、预计剩余时间）。
+    known_vectors 为 {文本的 sha256: 向量}，其中已有的块不再请求嵌入。
+    """
     # 参数校验
     if not isinstance(docs, list) or not all(isinstance(d, Document) for d in docs):
         raise ValueError("Input must be a list of Document objects")
     
-    # ========== BM25索引构建 ==========
-    try:
-        kb_dir = Path(KB_DIR)  # 根目录
-        if not kb_dir.exists():
-            kb_dir.mkdir(parents=True, exist_ok=True)
-        
-        save_dir = kb_dir / str(kb_id)  # 知识库专属目录
-        save_dir.mkdir(parents=True, exist_ok=True)  # 确保目录存在
-
-        bm25_path = save_dir / "bm25_index.json"
-        
-        # 写入前做空值检查
-        if not docs:
-            raise ValueError("Documents list is empty")
-        # 保存文档数据
-        with open(bm25_path, "w", encoding="utf-8") as f:
-            json.dump({
-                "docs": [
-                    {
-                        "page_content": doc.page_content,
-                        "metadata": doc.metadata
-                    } for doc in docs
-                ]
-            }, f, ensure_ascii=False)
-    except Exception as e:
-        raise RuntimeError(f"Failed to save BM25 index: {str(e)}")
+    if not docs:
+        raise ValueError("Documents list is empty")
+    save_dir = Path(KB_DIR) / str(kb_id)  # 知识库专属目录
+    save_dir.mkdir(parents=True, exist_ok=True)
     # ========== 向量索引构建 ==========
     try:
-        if cur_vendor == "Ollama":
-            embeddings = OllamaEmbeddings(
-                model=cur_kb["model"],
-                base_url=cur_kb["base_url"].rstrip("/v1").rstrip("/v1/")
-            )
-        else:
-            embeddings = OpenAIEmbeddings(
-                model=cur_kb["model"],
-                openai_api_key=cur_kb["api_key"],
-                openai_api_base=cur_kb["base_url"],
+        embeddings = make_embeddings(cur_kb, cur_vendor)
+        kb_settings = kb_settings or {}
+        known_vectors = known_vectors or {}
+        texts = [doc.page_content for doc in docs]
+        hashes = [text_hash(text) for text in texts]
+        # 只嵌入新的块，相同内容的块只嵌入一次
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in known_vectors:
+                missing.setdefault(h, text)
+        new_vectors = await embed_documents(
+            embeddings,
+            list(missing.values()),
+            batch_size=kb_settings.get("embeddingBatchSize", 64),
+            concurrency=kb_settings.get("embeddingConcurrency", 4),
+            max_retries=kb_settings.get("embeddingMaxRetries", 5),
+            on_progress=on_progress,
+        )
+        known_vectors = {**known_vectors, **dict(zip(missing, new_vectors))}
+        vectors = [known_vectors[h] for h in hashes]
+        logger.info(f"Knowledge base {kb_id}: {len(texts)} chunks, {len(missing)} embedded, {len(texts) - len(missing)} reused")
+
+        # 按原顺序写入 FAISS 并保存（CPU 密集，放到线程池中执行）
+        def save():
+            vector_db = FAISS.from_embeddings(
+                list(zip(texts, vectors)),
+                embeddings,
+                metadatas=[doc.metadata for doc in docs],
             )
-        # 批量处理文档
-        batch_size = 5  # 根据显存调整
-        vector_db = None
-        
-        for i in range(0, len(docs), batch_size):
-            batch = docs[i:i+batch_size]
-            
-            if vector_db is None:
-                vector_db = FAISS.from_documents(batch, embeddings)
-            else:
-                vector_db.add_documents(batch)
-            
-            print(f"Processed {min(i+batch_size, len(docs))}/{len(docs)} documents")
-        
-        # 最终保存
-        save_path = Path(KB_DIR) / str(kb_id)
-        vector_db.save_local(folder_path=str(save_path), index_name="index")
+            save_path = Path(KB_DIR) / str(kb_id)
+            vector_db.save_local(folder_path=str(save_path), index_name="index")
+            # 原生倒排索引与向量索引同序（查询时文档从 FAISS 的 docstore 取），在向量索引写入成功后再切换
+            build_bm25_index(texts, save_path)
+            # 旧版本留下的 BM25 文档数据已经不再需要
+            (save_path / LEGACY_BM25_FILE).unlink(missing_ok=True)
+        await asyncio.get_running_loop().run_in_executor(None, save)
         
     except Exception as e:
         raise RuntimeError(f"Vector store build failed: {str(e)}")
+    finally:
+        retriever_cache.invalidate(kb_id)
 
-def load_retrievers(kb_id, cur_kb, cur_vendor):
-    """加载双检索器"""
-    # 加载BM25
-    bm25_path = Path(KB_DIR) / str(kb_id) / "bm25_index.json"
-    with open(bm25_path, "r", encoding="utf-8") as f:
-        bm25_data = json.load(f)
-    
-    bm25_docs = [
-        Document(
-            page_content=doc["page_content"],
-            metadata=doc["metadata"]
-        ) for doc in bm25_data["docs"]
-    ]
-    bm25_retriever = BM25Retriever.from_documents(bm25_docs)
-    bm25_retriever.k = cur_kb["chunk_k"]
-    # 加载向量检索器
-    kb_path = Path(KB_DIR) / str(kb_id)
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def make_embeddings(cur_kb, cur_vendor):
+    """构建和查询共用的嵌入对象，经过跨知识库共享的 embedding_cache"""
     if cur_vendor == "Ollama":
         embeddings = OllamaEmbeddings(
             model=cur_kb["model"],
@@ -147,7 +141,113 @@ def load_retrievers(kb_id, cur_kb, cur_vendor):
             openai_api_key=cur_kb["api_key"],
             openai_api_base=cur_kb["base_url"],
         )
-    
+    return CachedEmbeddings(embeddings, f"{cur_vendor}|{cur_kb['base_url']}", cur_kb["model"])
+
+# 旧版本构建的知识库保存的 BM25 文档数据，只在没有原生索引时读取
+LEGACY_BM25_FILE = "bm25_index.json"
+INDEX_FILES = (BM25_POINTER_FILE, "index.faiss", "index.pkl")
+
+class RetrieverCache:
+    """
+    已加载的知识库检索器 LRU，查询时不再重新映射 BM25 索引和加载 FAISS 索引。
+    条目记录索引文件的修改时间/大小和影响检索的配置（模型、地址、chunk_k），任一变化即重新加载；
+    按索引文件大小估算占用的内存，超出 KBSettings.retrieverCacheMB 时淘汰最久未用的知识库。
+    查询在线程池中执行，因此用锁保护，同一知识库同时只加载一次。
+    """
+    # 反序列化后的 Document 对象和 FAISS 索引大约是文件大小的两倍（BM25 数组是内存映射的，不计入）
+    MEMORY_FACTOR = 2
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # kb_id -> (version, retrievers, 估算字节数)
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_ms = 0.0
+
+    def configure(self, kb_settings: dict):
+        self.max_bytes = int((kb_settings or {}).get("retrieverCacheMB", 512)) * 1024 * 1024
+
+    @staticmethod
+    def _version(kb_id, cur_kb, cur_vendor):
+        kb_path = Path(KB_DIR) / str(kb_id)
+        files = []
+        for name in INDEX_FILES:
+            try:
+                stat = os.stat(kb_path / name)
+                files.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                files.append(None)
+        config = (cur_vendor, cur_kb["model"], cur_kb.get("api_key"), cur_kb["base_url"], cur_kb["chunk_k"])
+        return tuple(files), config
+
+    def get(self, kb_id, cur_kb, cur_vendor):
+        key = str(kb_id)
+        version = self._version(kb_id, cur_kb, cur_vendor)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            # 等锁期间其他线程可能已经加载完成
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self.misses += 1
+            start = time.perf_counter()
+            retrievers = load_retrievers(kb_id, cur_kb, cur_vendor)
+            size = sum(stat[1] for stat in version[0] if stat) * self.MEMORY_FACTOR
+            with self._lock:
+                self.load_ms += (time.perf_counter() - start) * 1000
+                self._entries[key] = (version, retrievers, size)
+                self._entries.move_to_end(key)
+                self._evict(keep=key)
+            return retrievers
+
+    def _evict(self, keep):
+        total = sum(entry[2] for entry in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            del self._entries[key]
+            total -= entry[2]
+            self.evictions += 1
+
+    def invalidate(self, kb_id):
+        """知识库重建或删除后调用"""
+        with self._lock:
+            self._entries.pop(str(kb_id), None)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "estimated_bytes": sum(entry[2] for entry in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "avg_load_ms": self.load_ms / self.misses if self.misses else 0.0,
+            }
+
+retriever_cache = RetrieverCache()
+
+def load_retrievers(kb_id, cur_kb, cur_vendor):
+    """加载双检索器（查询时通过 retriever_cache 复用）"""
+    # 加载向量检索器
+    kb_path = Path(KB_DIR) / str(kb_id)
+    embeddings = make_embeddings(cur_kb, cur_vendor)
     vector_db = FAISS.load_local(
         folder_path=str(kb_path),
         embeddings=embeddings,
@@ -157,17 +257,46 @@ def load_retrievers(kb_id, cur_kb, cur_vendor):
     vector_retriever = vector_db.as_retriever(
         search_kwargs={"k": cur_kb["chunk_k"]}
     )
+    bm25_retriever = load_native_bm25(kb_path, vector_db, cur_kb["chunk_k"])
+    if bm25_retriever is None:
+        # 旧版本构建的知识库没有原生索引，沿用 bm25_index.json
+        bm25_path = kb_path / LEGACY_BM25_FILE
+        with open(bm25_path, "r", encoding="utf-8") as f:
+            bm25_data = json.load(f)
+
+        bm25_docs = [
+            Document(
+                page_content=doc["page_content"],
+                metadata=doc["metadata"]
+            ) for doc in bm25_data["docs"]
+        ]
+        bm25_retriever = BM25Retriever.from_documents(bm25_docs)
+        bm25_retriever.k = cur_kb["chunk_k"]
     return bm25_retriever, vector_retriever
 
+def load_native_bm25(kb_path: Path, vector_db, k: int):
+    """内存映射原生 BM25 索引，文档号即 FAISS 中的位置；索引不存在或与向量索引不一致时返回 None"""
+    if not (kb_path / BM25_POINTER_FILE).exists():
+        return None
+    try:
+        index = BM25Index(kb_path)
+        docs = [vector_db.docstore.search(vector_db.index_to_docstore_id[i]) for i in range(vector_db.index.ntotal)]
+    except Exception as e:
+        logger.warning(f"Native BM25 index in {kb_path} is not usable: {e!r}")
+        return None
+    if index.num_docs != len(docs) or not all(isinstance(doc, Document) for doc in docs):
+        logger.warning(f"Native BM25 index in {kb_path} does not match the vector index")
+        return None
+    return NativeBM25Retriever(index=index, docs=docs, k=k)
+
 def query_vector_store(query: str, kb_id, cur_kb, cur_vendor):
     """使用EnsembleRetriever的混合查询"""
-    bm25_retriever, vector_retriever = load_retrievers(kb_id, cur_kb, cur_vendor)
-    if "weight" not in cur_kb:
-        cur_kb["weight"] = 0.5
+    bm25_retriever, vector_retriever = retriever_cache.get(kb_id, cur_kb, cur_vendor)
+    weight = cur_kb.get("weight", 0.5)
     # 初始化混合检索器
     ensemble_retriever = EnsembleRetriever(
         retrievers=[bm25_retriever, vector_retriever],
-        weights=[1 - cur_kb["weight"], cur_kb["weight"]],  # 权重配置
+        weights=[1 - weight, weight],  # 权重配置
     )
     
     # 获取结果
@@ -179,8 +308,8 @@ def query_vector_store(query: str, kb_id, cur_kb, cur_vendor):
     } for doc in docs]
 
 
-async def process_knowledge_base(kb_id):
-    """异步处理知识库的完整流程"""
+async def process_knowledge_base(kb_id, on_progress=None):
+    """异步处理知识库的完整流程，on_progress 见 build_vector_store"""
     # 加载配置
     settings = await load_settings()
     # 查找对应知识库配置
@@ -199,17 +328,79 @@ async def process_knowledge_base(kb_id):
     
     if not cur_kb:
         raise ValueError(f"Knowledge base {kb_id} not found in settings")
-    # 异步获取文件处理结果
-    processed_results = await get_files_json(cur_kb["files"])
-    
-    # 分块处理文档
-    chunks = chunk_documents(processed_results, cur_kb)
-    
+    # 增量处理：内容未变化的文件沿用上次的分块和向量，只解析、分块、嵌入新增或修改的文件，已删除文件的向量不再写入
+    manifest = load_manifest(kb_id)
+    embedding_config = [cur_vendor, cur_kb["model"], cur_kb["base_url"]]
+    chunking_config = [cur_kb["chunk_size"], cur_kb["chunk_overlap"]]
+    old_docs, known_vectors = {}, {}
+    if manifest.get("embedding") == embedding_config:
+        old_docs, known_vectors = await asyncio.get_running_loop().run_in_executor(None, load_indexed_chunks, kb_id, cur_kb, cur_vendor)
+    # 分块参数变化时所有文件都要重新分块（内容相同的块仍可复用向量）
+    old_files = manifest.get("files", {}) if manifest.get("chunking") == chunking_config else {}
+
+    fetched = await asyncio.gather(*[
+        get_file_content_if_changed(file["path"], old_files.get(file["path"]) if file["path"] in old_docs else None)
+        for file in cur_kb["files"]
+    ])
+    docs, files, changed = [], {}, 0
+    for file, (digest, content) in zip(cur_kb["files"], fetched):
+        if content is None:
+            docs.extend(old_docs[file["path"]])
+        else:
+            changed += 1
+            docs.extend(chunk_documents([{"file_path": file["path"], "file_name": file["name"], "content": content}], cur_kb))
+        if digest:
+            files[file["path"]] = digest
+    removed = len(set(old_files) - set(files))
+    logger.info(f"Knowledge base {kb_id}: {len(cur_kb['files']) - changed} files unchanged, {changed} changed, {removed} removed")
+
     # 构建向量存储
-    build_vector_store(chunks, kb_id, cur_kb,cur_vendor)
+    embedding_cache.configure(settings["KBSettings"].get("embeddingCache"))
+    await build_vector_store(docs, kb_id, cur_kb, cur_vendor, settings["KBSettings"], on_progress, known_vectors)
+    save_manifest(kb_id, {"embedding": embedding_config, "chunking": chunking_config, "files": files})
 
     return "知识库处理完成"
 
+MANIFEST_FILE = "manifest.json"
+
+def load_manifest(kb_id) -> Dict:
+    """上次构建时的配置和每个文件的内容哈希"""
+    try:
+        with open(Path(KB_DIR) / str(kb_id) / MANIFEST_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_manifest(kb_id, manifest: Dict):
+    with open(Path(KB_DIR) / str(kb_id) / MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+def load_indexed_chunks(kb_id, cur_kb, cur_vendor):
+    """
+    读取已有的 FAISS 索引，返回 ({file_path: [Document]}, {文本的 sha256: 向量})。
+    索引不存在或无法读取时返回空结果（退化为完整构建）。
+    """
+    kb_path = Path(KB_DIR) / str(kb_id)
+    try:
+        vector_db = FAISS.load_local(
+            folder_path=str(kb_path),
+            embeddings=make_embeddings(cur_kb, cur_vendor),
+            allow_dangerous_deserialization=True,
+            index_name="index"
+        )
+        vectors = vector_db.index.reconstruct_n(0, vector_db.index.ntotal)
+    except Exception as e:
+        logger.warning(f"Knowledge base {kb_id}: existing index is not reusable, rebuilding: {e!r}")
+        return {}, {}
+    docs, known_vectors = {}, {}
+    for position, docstore_id in vector_db.index_to_docstore_id.items():
+        doc = vector_db.docstore.search(docstore_id)
+        if not isinstance(doc, Document):
+            continue
+        docs.setdefault(doc.metadata.get("file_path"), []).append((position, doc))
+        known_vectors[text_hash(doc.page_content)] = vectors[position].tolist()
+    return {path: [doc for _, doc in sorted(items, key=lambda item: item[0])] for path, items in docs.items()}, known_vectors
+
 async def query_knowledge_base(kb_id, query: str):
     """查询知识库"""
     # 加载配置
@@ -230,8 +421,11 @@ async def query_knowledge_base(kb_id, query: str):
     
     if not cur_kb:
         return f"Knowledge base {kb_id} not found in settings"
-    # 查询知识库
-    results = query_vector_store(query,kb_id, cur_kb,cur_vendor)
+    retriever_cache.configure(settings["KBSettings"])
+    embedding_cache.configure(settings["KBSettings"].get("embeddingCache"))
+    # 查询知识库（嵌入请求和检索是同步调用，放到线程池中执行，多个知识库可以同时查询）
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(None, query_vector_store, query, kb_id, cur_kb, cur_vendor)
     return results
 
 async def rerank_knowledge_base(query: str , docs: List[Dict]) -> List[Dict]:
@@ -336,6 +530,38 @@ kb_tool = {
     },
 }
 
+def _benchmark(num_chunks: int, rounds: int):
+    """合成知识库上对比冷加载和缓存命中时的查询延迟（确定性的假嵌入，不需要联网）"""
+    import random
+    import tempfile
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    global KB_DIR, make_embeddings
+    rng = random.Random(0)
+    words = ["知识库", "检索", "向量", "模型", "智能体", "工具", "agent", "party", "LLM", "embedding", "索引", "文档"]
+    docs = [
+        Document(
+            page_content=" ".join(rng.choice(words) for _ in range(80)),
+            metadata={"file_path": f"doc_{i // 20}.txt", "file_name": f"doc_{i // 20}.txt", "doc_id": f"doc_{i}"},
+        )
+        for i in range(num_chunks)
+    ]
+    cur_kb = {"model": "fake", "api_key": "", "base_url": "", "chunk_k": 5, "weight": 0.5}
+    with tempfile.TemporaryDirectory() as tmp:
+        KB_DIR = tmp
+        make_embeddings = lambda cur_kb, cur_vendor: DeterministicFakeEmbedding(size=256)
+        asyncio.run(build_vector_store(docs, "bench", cur_kb, None))
+        timings = {}
+        for name, cold in (("cold (reload per query)", True), ("warm (retriever_cache)", False)):
+            start = time.perf_counter()
+            for i in range(rounds):
+                if cold:
+                    retriever_cache.invalidate("bench")
+                query_vector_store(f"{words[i % len(words)]} 检索", "bench", cur_kb, None)
+            timings[name] = (time.perf_counter() - start) / rounds * 1000
+        for name, elapsed in timings.items():
+            print(f"{name:<26} {elapsed:>9.2f} ms per query  ({num_chunks} chunks)")
+        print(retriever_cache.to_dict())
+
 async def main():
     """示例用法"""
     try:
@@ -355,4 +581,12 @@ async def main():
         print(f"处理过程中发生错误: {str(e)}")
         raise
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Knowledge base example / retriever cache benchmark")
+    parser.add_argument("--bench", type=int, default=0, help="benchmark warm vs cold queries on a synthetic KB with this many chunks")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    if args.bench:
+        _benchmark(args.bench, args.rounds)
+    else:
+        asyncio.run(main())
\ No newline at end of file
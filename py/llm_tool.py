@@ -3,7 +3,8 @@ import json
 
 import aiohttp
 from py.get_setting import load_settings
-from openai import AsyncOpenAI
+from py.client_pool import client_pool
+from py.response_cache import response_cache,make_key
 from ollama import AsyncClient as OllamaClient
 
 
@@ -83,6 +84,13 @@ async def custom_llm_tool(tool_name, query, image_url=None):
     llmTools = settings['llmTools']
     for llmTool in llmTools:
         if llmTool['enabled'] and llmTool['name'] == tool_name:
+            # 相同工具的相同问题直接返回缓存的回答（需要开启 responseCache.internalCalls）
+            cache_key = None
+            if response_cache.is_cacheable(settings['responseCache'].get('internalCalls') or None):
+                cache_key = make_key({"llm_tool": llmTool, "query": query, "image_url": image_url})
+                cached = await response_cache.get(cache_key)
+                if cached is not None:
+                    return cached[1]
             if llmTool['type'] == 'ollama':
                 client = OllamaClient(host=llmTool['base_url'])
                 try:
@@ -109,11 +117,13 @@ async def custom_llm_tool(tool_name, query, image_url=None):
                         model=llmTool['model'],
                         messages=[{"role": "user", "content": content}],
                     )
+                    if cache_key:
+                        await response_cache.put(cache_key, "text", response.message.content)
                     return response.message.content
                 except Exception as e:
                     return str(e)
             else:
-                client = AsyncOpenAI(api_key=llmTool['api_key'],base_url=llmTool['base_url'])
+                client = client_pool.get_client(llmTool['api_key'], llmTool['base_url'], llmTool.get('type'))
                 try:
                     if image_url:
                         base64_image = await get_image_base64(image_url)
@@ -142,6 +152,8 @@ async def custom_llm_tool(tool_name, query, image_url=None):
                                 {"role": "user", "content": query},
                             ],
                         )
+                    if cache_key:
+                        await response_cache.put(cache_key, "text", response.choices[0].message.content)
                     return response.choices[0].message.content
                 except Exception as e:
                     return str(e)
\ No newline at end of file
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 import sys
@@ -299,6 +300,25 @@ async def get_file_content(file_url):
     except Exception as e:
         return f"文件解析错误: {str(e)}"
 
+async def get_file_content_if_changed(file_url, known_hash=None):
+    """
+    返回 (原始内容的 sha256, 文本)；内容哈希等于 known_hash 时跳过解析，文本为 None。
+    读取失败时哈希为 None，文本为错误信息（与 get_file_content 一致）
+    """
+    try:
+        content, ext = await get_content(file_url)
+    except Exception as e:
+        return None, f"文件解析错误: {str(e)}"
+    digest = hashlib.sha256(content).hexdigest()
+    if digest == known_hash:
+        return digest, None
+    try:
+        if ext in office_extensions:
+            return digest, await handle_office_document(content, ext)
+        return digest, decode_text(content)
+    except Exception as e:
+        return digest, f"文件解析错误: {str(e)}"
+
 async def get_files_content(files_path_list):
     """异步获取所有文件内容并拼接（增加错误隔离）"""
     tasks = [get_file_content(fp) for fp in files_path_list]
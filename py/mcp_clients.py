@@ -9,6 +9,9 @@ from mcp.client.sse import sse_client
 from mcp.client.websocket import websocket_client
 from mcp.client.streamable_http import streamablehttp_client
 from contextlib import AsyncExitStack, asynccontextmanager
+import httpx
+from mcp import types
+from mcp.types import CallToolResult
 import nest_asyncio
 from dotenv import load_dotenv
 
@@ -23,12 +26,44 @@ def get_command_path(command_name, default_command='uv'):
     return path
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, on_tools_changed=None):
         self._exit_stack = AsyncExitStack()
         self.session: ClientSession = None
         self.stdio = None
         self.write = None
-        self.tools = []
+        self.tools = set()
+        self.functions = []  # 转换好的 OpenAI function 定义，只在连接建立和 list_changed 时更新
+        self._on_tools_changed = on_tools_changed
+
+    def _set_tools(self, tools):
+        self.tools = {tool.name for tool in tools}
+        self.functions = [
+            {
+                "type": "function",
+                "function": {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "parameters": tool.inputSchema
+                }
+            }
+            for tool in tools
+        ]
+
+    async def _handle_message(self, message):
+        """服务器发送 tools/list_changed 通知时刷新工具列表"""
+        if isinstance(message, types.ServerNotification) and isinstance(message.root, types.ToolListChangedNotification):
+            # 消息处理运行在会话的接收循环中，在这里等待请求响应会死锁，改为后台刷新
+            asyncio.create_task(self._refresh_tools())
+
+    async def _refresh_tools(self):
+        try:
+            tools = await self.session.list_tools()
+            self._set_tools(tools.tools)
+        except Exception as e:
+            logging.error(f"刷新MCP工具列表失败: {e}")
+            return
+        if self._on_tools_changed:
+            self._on_tools_changed()
 
     @asynccontextmanager
     async def connect(self, config: dict) -> AsyncIterator['ConnectionManager']:
@@ -56,13 +91,15 @@ class ConnectionManager:
                 transport = await self._exit_stack.enter_async_context(client_map[mcptype](config['url']))
 
             self.stdio, self.write = transport
-            self.session = await self._exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
+            self.session = await self._exit_stack.enter_async_context(
+                ClientSession(self.stdio, self.write, message_handler=self._handle_message)
+            )
             
             # 初始化会话
             await self.session.initialize()
             tools = await self.session.list_tools()
-            self.tools = [tool.name for tool in tools.tools]
-            print(f"Connected to server. Available tools: {self.tools}")
+            self._set_tools(tools.tools)
+            print(f"Connected to server. Available tools: {sorted(self.tools)}")
             
             yield self
         finally:
@@ -70,6 +107,41 @@ class ConnectionManager:
             await self._exit_stack.aclose()
             self.session = None
 
+class McpToolIndex:
+    """
+    工具名 -> MCP 客户端的全局索引，客户端工具列表变化时更新。
+    查找时校验客户端仍在当前列表中且仍提供该工具，索引过期时回退线性查找并修正，
+    因此服务器重连、重建或移除后分派结果仍然正确。
+    """
+    def __init__(self):
+        self._tools: Dict[str, Any] = {}
+        self._client_tools: Dict[Any, set] = {}
+
+    def update(self, client, tool_names):
+        for name in self._client_tools.pop(client, ()):
+            if self._tools.get(name) is client:
+                del self._tools[name]
+        tool_names = set(tool_names)
+        if tool_names:
+            self._client_tools[client] = tool_names
+            for name in tool_names:
+                self._tools[name] = client
+
+    def remove(self, client):
+        self.update(client, ())
+
+    def lookup(self, clients: Dict[str, Any], tool_name: str):
+        client = self._tools.get(tool_name)
+        if client is not None and clients.get(client.server_name) is client and client.has_tool(tool_name):
+            return client
+        for client in clients.values():
+            if client.has_tool(tool_name):
+                self._tools[tool_name] = client
+                return client
+        return None
+
+mcp_tool_index = McpToolIndex()
+
 class McpClient:
     def __init__(self):
         self._conn: ConnectionManager = None
@@ -80,12 +152,23 @@ class McpClient:
         self._active = asyncio.Event()
         self._shutdown = False
         self.disabled = False
+        self.server_name = None
+        # 工具列表每次变化（连接、断开、list_changed 通知）时加一，供工具目录缓存判断是否失效
+        self.tools_generation = 0
+        self.on_tools_changed = None
+
+    def _tools_changed(self):
+        self.tools_generation += 1
+        mcp_tool_index.update(self, self._conn.tools if self._conn else ())
+        if self.on_tools_changed:
+            self.on_tools_changed()
 
     async def initialize(self, server_name: str, server_config: dict):
         """非阻塞初始化"""
         if self._monitor_task:
             self._monitor_task.cancel()
 
+        self.server_name = server_name
         self._config = server_config
         self._monitor_task = asyncio.create_task(self._connection_monitor())
 
@@ -101,6 +184,7 @@ class McpClient:
     async def close(self):
         """安全关闭连接"""
         self._shutdown = True
+        mcp_tool_index.remove(self)
         
         # 取消并等待监控任务
         if self._monitor_task and not self._monitor_task.done():
@@ -131,10 +215,11 @@ class McpClient:
                     # 将整个连接周期放入锁保护范围
                     async with self._lock:
                         # 创建新连接
-                        conn = ConnectionManager()
+                        conn = ConnectionManager(on_tools_changed=self._tools_changed)
                         async with conn.connect(self._config) as active_conn:
                             self._conn = active_conn
                             self._active.set()
+                            self._tools_changed()
                             
                             # 将心跳检查放在连接上下文中
                             try:
@@ -145,6 +230,7 @@ class McpClient:
                             finally:
                                 self._active.clear()
                                 self._conn = None
+                                self._tools_changed()
                                 
                     # 连接断开后等待重连
                     await asyncio.sleep(5)
@@ -163,22 +249,13 @@ class McpClient:
                     self._conn = None
 
     async def get_openai_functions(self):
+        """返回连接建立（或 list_changed）时缓存的工具定义，不再每次请求 list_tools"""
         if self.disabled or not self._conn:
             return []
-            
-        response = await self._conn.session.list_tools()
-        tools = []
-        for tool in response.tools:
-            function = {
-                "type": "function",
-                "function": {
-                    "name": tool.name, 
-                    "description": tool.description,
-                    "parameters": tool.inputSchema
-                }
-            }
-            tools.append(function)
-        return tools
+        return self._conn.functions
+
+    def has_tool(self, tool_name: str) -> bool:
+        return self._conn is not None and tool_name in self._conn.tools
 
     async def call_tool(self, tool_name: str, tool_params: Dict[str, Any]) -> Any:
         if self.disabled or not self._conn:
@@ -186,3 +263,60 @@ class McpClient:
         
         response = await self._conn.session.call_tool(tool_name, tool_params)
         return response
+
+class RemoteMcpClient:
+    """
+    多 worker 模式下非主 worker 使用的代理：MCP 连接只由主 worker 持有，
+    这里通过主 worker 的内部接口获取工具列表和调用工具，接口与 McpClient 相同。
+    """
+    def __init__(self, server_name: str, get_owner_url):
+        self.server_name = server_name
+        self._get_owner_url = get_owner_url
+        self._http = httpx.AsyncClient(timeout=None)
+        self.tools = set()
+        self.disabled = False
+        # 主 worker 上对应连接的工具列表变化时，由 shared_store 消息加一
+        self.tools_generation = 0
+
+    async def _url(self, action: str):
+        owner_url = await self._get_owner_url()
+        if not owner_url:
+            return None
+        return f"{owner_url}/_owner/mcp/{self.server_name}/{action}"
+
+    async def get_openai_functions(self):
+        if self.disabled:
+            return []
+        url = await self._url("functions")
+        if not url:
+            return []
+        try:
+            response = await self._http.get(url)
+            response.raise_for_status()
+            functions = response.json()
+        except Exception as e:
+            logging.error(f"获取主 worker 的 MCP 工具失败: {e!r}")
+            # 让工具目录缓存失效，下次请求重新获取
+            self.tools_generation += 1
+            return []
+        self.tools = {function["function"]["name"] for function in functions}
+        mcp_tool_index.update(self, self.tools)
+        return functions
+
+    def has_tool(self, tool_name: str) -> bool:
+        return tool_name in self.tools
+
+    async def call_tool(self, tool_name: str, tool_params: Dict[str, Any]) -> Any:
+        if self.disabled:
+            return None
+        url = await self._url("call")
+        if not url:
+            return None
+        response = await self._http.post(url, json={"name": tool_name, "arguments": tool_params})
+        response.raise_for_status()
+        data = response.json()
+        return CallToolResult.model_validate(data) if data is not None else None
+
+    async def close(self):
+        mcp_tool_index.remove(self)
+        await self._http.aclose()
@@ -0,0 +1,82 @@
+"""
+写时复制的消息列表：推理模型、深度搜索、图片处理等各自需要一份略有不同的消息列表，
+不再整体 deepcopy 对话（包含 base64 图片和长文件内容时代价很高），而是共享原消息字典，只复制被修改的那几条。
+
+分配对比基准（100 轮对话）：
+    python -m py.message_overlay --turns 100
+"""
+
+class MessageOverlay(list):
+    """
+    与源列表共享消息字典；修改某条消息前用 edit(index) 取得它的浅拷贝，源列表中的消息不受影响。
+    append 进来的新消息属于本列表，可以直接修改。
+    """
+    def __init__(self, messages=()):
+        super().__init__(messages)
+        # id -> 消息，保留引用防止 id 被复用
+        self._owned = {}
+
+    def edit(self, index: int) -> dict:
+        message = self[index]
+        if id(message) not in self._owned:
+            message = dict(message)
+            self[index] = message
+            self._owned[id(message)] = message
+        return message
+
+    def append(self, message):
+        super().append(message)
+        self._owned[id(message)] = message
+
+def _sample_history(turns: int):
+    image = "data:image/png;base64," + "A" * 200_000
+    messages = [{"role": "system", "content": "相关文件内容：" + "文" * 100_000}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"问题 {i} " + ("![image](" + image + ")" if i % 10 == 0 else "")})
+        messages.append({"role": "assistant", "content": f"回答 {i} " + "内容" * 500})
+    messages.append({"role": "user", "content": "最后一个问题"})
+    return messages
+
+def _deepcopy_turn(messages):
+    import copy
+    deepsearch_messages = copy.deepcopy(messages)
+    deepsearch_messages[-1]['content'] += "拆分步骤"
+    reasoner_messages = copy.deepcopy(messages)
+    reasoner_messages[-1]['content'] += "可参考的步骤"
+    image_messages = copy.deepcopy(reasoner_messages)
+    main_messages = copy.deepcopy(messages)
+    return deepsearch_messages, reasoner_messages, image_messages, main_messages
+
+def _overlay_turn(messages):
+    deepsearch_messages = MessageOverlay(messages)
+    deepsearch_messages.edit(-1)['content'] += "拆分步骤"
+    reasoner_messages = MessageOverlay(messages)
+    reasoner_messages.edit(-1)['content'] += "可参考的步骤"
+    image_messages = MessageOverlay(reasoner_messages)
+    main_messages = MessageOverlay(messages)
+    return deepsearch_messages, reasoner_messages, image_messages, main_messages
+
+def main():
+    import argparse
+    import time
+    import tracemalloc
+    parser = argparse.ArgumentParser(description="MessageOverlay allocation benchmark")
+    parser.add_argument("--turns", type=int, default=100, help="conversation turns in the sample history")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    messages = _sample_history(args.turns)
+    for name, build in (("deepcopy", _deepcopy_turn), ("overlay", _overlay_turn)):
+        tracemalloc.start()
+        result = build(messages)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            build(messages)
+        elapsed = (time.perf_counter() - start) / args.rounds
+        print(f"{name:<9} {peak / 1024 / 1024:>9.2f} MiB allocated  {elapsed * 1000:>8.2f} ms per turn")
+    assert messages[-1]["content"] == "最后一个问题"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+
+from py.tool_registry import ToolStats
+
+logger = logging.getLogger(__name__)
+
+class PreprocessPipeline:
+    """
+    聊天请求的预处理依赖图：每一步是一个协程函数，依赖的步骤完成后以其结果作为参数调用，
+    互不依赖的步骤在 start() 后同时执行。调用方按固定顺序 await result(name) 取结果写入提示词，
+    合并顺序与各步骤完成的先后无关。
+    """
+    def __init__(self):
+        self._steps = {}  # name -> (func, deps)
+        self._tasks = {}
+        self._started = None
+        self.timings = {}  # name -> {"start_ms": 相对 start() 的开始时间, "duration_ms": 耗时}
+
+    def add(self, name: str, func, *deps: str):
+        """func(*依赖步骤的结果)，依赖的步骤需要先添加"""
+        for dep in deps:
+            if dep not in self._steps:
+                raise ValueError(f"Unknown preprocess step: {dep}")
+        self._steps[name] = (func, deps)
+        return self
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._steps
+
+    def start(self):
+        self._started = time.perf_counter()
+        for name, (func, deps) in self._steps.items():
+            self._tasks[name] = asyncio.create_task(self._run(name, func, [self._tasks[dep] for dep in deps]))
+        return self
+
+    async def _run(self, name: str, func, dep_tasks):
+        dep_results = [await task for task in dep_tasks]
+        start = time.perf_counter()
+        error = False
+        try:
+            return await func(*dep_results)
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.timings[name] = {
+                "start_ms": round((start - self._started) * 1000, 1),
+                "duration_ms": round(elapsed_ms, 1),
+            }
+            preprocess_stats.record(name, elapsed_ms, error)
+
+    async def result(self, name: str, default=None):
+        """等待某一步的结果，没有添加该步骤时返回 default"""
+        task = self._tasks.get(name)
+        if task is None:
+            return default
+        return await task
+
+    async def wait(self):
+        """等待所有步骤结束（忽略异常，异常在 result() 时抛出），记录本次的耗时"""
+        if self._tasks:
+            await asyncio.wait(self._tasks.values())
+        total_ms = sum(timing["duration_ms"] for timing in self.timings.values())
+        wall_ms = max((timing["start_ms"] + timing["duration_ms"] for timing in self.timings.values()), default=0.0)
+        logger.info(f"Preprocess finished in {wall_ms:.1f} ms (sequential {total_ms:.1f} ms): {self.timings}")
+        return self.timings
+
+    def cancel(self):
+        """取消还没有结束的步骤；已经失败的步骤标记异常已读取，避免 "Task exception was never retrieved" """
+        for task in self._tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+class PreprocessStats:
+    def __init__(self):
+        self.steps = {}
+
+    def record(self, name: str, elapsed_ms: float, error: bool):
+        stats = self.steps.get(name)
+        if stats is None:
+            stats = self.steps[name] = ToolStats()
+        stats.record(elapsed_ms, error)
+
+    def to_dict(self) -> dict:
+        return {name: stats.to_dict() for name, stats in sorted(self.steps.items())}
+
+preprocess_stats = PreprocessStats()
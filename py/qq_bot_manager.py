@@ -8,7 +8,8 @@ import weakref
 import aiohttp
 import botpy
 from botpy.message import C2CMessage, GroupMessage
-from openai import AsyncOpenAI
+from py.client_pool import client_pool
+from py.scheduler import PRIORITY_HEADER
 import logging
 import re
 import time
@@ -19,6 +20,7 @@ import io
 import base64
 from py.get_setting import get_port
 from py.image_host import upload_image_host
+from py.qq_bot_status import build_status
 
 class QQBotManager:
     def __init__(self):
@@ -272,16 +274,7 @@ class QQBotManager:
 
     def get_status(self):
         """获取机器人状态"""
-        return {
-            "is_running": self.is_running,
-            "thread_alive": self.bot_thread.is_alive() if self.bot_thread else False,
-            "client_ready": self.bot_client.is_running if self.bot_client else False,
-            "config": self.config.model_dump() if self.config else None,
-            "loop_running": self.loop and not self.loop.is_closed() if self.loop else False,
-            "startup_error": self._startup_error,
-            "connection_established": self._startup_complete.is_set(),
-            "ready_completed": self._ready_complete.is_set()
-        }
+        return build_status(self)
 
 
     def __del__(self):
@@ -352,10 +345,7 @@ class MyClient(botpy.Client):
         if not self.is_running:
             return
         
-        client = AsyncOpenAI(
-            api_key="super-secret-key",
-            base_url=f"http://127.0.0.1:{self.port}/v1"
-        )
+        client = client_pool.get_client("super-secret-key", f"http://127.0.0.1:{self.port}/v1")
         
         user_content = []
         image_url_list = []
@@ -439,7 +429,8 @@ class MyClient(botpy.Client):
             stream = await client.chat.completions.create(
                 model=self.QQAgent,
                 messages=self.memoryList[c_id],
-                stream=True
+                stream=True,
+                extra_headers={PRIORITY_HEADER: "bot"},
             )
             
             full_response = []
@@ -591,10 +582,7 @@ class MyClient(botpy.Client):
     async def on_group_at_message_create(self, message: GroupMessage):
         if not self.is_running:
             return
-        client = AsyncOpenAI(
-            api_key="super-secret-key",
-            base_url=f"http://127.0.0.1:{self.port}/v1"
-        )
+        client = client_pool.get_client("super-secret-key", f"http://127.0.0.1:{self.port}/v1")
         user_content = []
         image_url_list = []
         if message.attachments:
@@ -668,7 +656,8 @@ class MyClient(botpy.Client):
             stream = await client.chat.completions.create(
                 model=self.QQAgent,
                 messages=self.memoryList[g_id],
-                stream=True
+                stream=True,
+                extra_headers={PRIORITY_HEADER: "bot"},
             )
             
             full_response = []
@@ -0,0 +1,26 @@
+# qq_bot_status.py
+# 不依赖 botpy：机器人从未启动时查询状态不需要加载 qq_bot_manager
+
+def build_status(manager=None) -> dict:
+    """机器人状态；manager 为 None（尚未创建 QQBotManager）时返回未启动的状态"""
+    if manager is None:
+        return {
+            "is_running": False,
+            "thread_alive": False,
+            "client_ready": False,
+            "config": None,
+            "loop_running": False,
+            "startup_error": None,
+            "connection_established": False,
+            "ready_completed": False
+        }
+    return {
+        "is_running": manager.is_running,
+        "thread_alive": manager.bot_thread.is_alive() if manager.bot_thread else False,
+        "client_ready": manager.bot_client.is_running if manager.bot_client else False,
+        "config": manager.config.model_dump() if manager.config else None,
+        "loop_running": manager.loop and not manager.loop.is_closed() if manager.loop else False,
+        "startup_error": manager._startup_error,
+        "connection_established": manager._startup_complete.is_set(),
+        "ready_completed": manager._ready_complete.is_set()
+    }
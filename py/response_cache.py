@@ -0,0 +1,210 @@
+"""
+精确匹配的响应缓存：对模型、消息、工具和采样参数的规范化 JSON 取哈希作为键，
+只在请求显式开启缓存（或开启 cacheAll）时使用。内存中保留最近使用的 LRU 条目，
+磁盘上的 SQLite 表在重启和多个 worker 之间共享；流式响应按原始 SSE 数据块保存，命中时原样回放。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import aiosqlite
+
+from py.get_setting import USER_DATA_DIR, SQLITE_PRAGMAS
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_PATH = os.path.join(USER_DATA_DIR, 'response_cache.db')
+# 不影响回复内容、但变化频繁的配置项，不计入配置指纹
+VOLATILE_SETTINGS = ("conversations", "conversationId", "responseCache")
+# 出错的流不写入缓存
+ERROR_MARKERS = ("❌", "\\u274c")
+
+def make_key(payload: dict) -> str:
+    """规范化（键排序、紧凑分隔符）后的 sha256"""
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    def __init__(self, path: str = RESPONSE_CACHE_PATH):
+        self.path = path
+        self.config = {}
+        self._config_source = None
+        self._memory = OrderedDict()  # key -> (kind, payload, created)
+        self._db = None
+        self._db_lock = None
+        self._db_failed = False
+        self._fingerprints = {}  # id(settings) -> (settings, 指纹)
+        self._stores_since_prune = 0
+        self.stats = ResponseCacheStats()
+
+    def configure(self, config: dict):
+        """从 settings['responseCache'] 读取配置，同一个只读配置对象重复传入时直接返回"""
+        if config is not None and config is self._config_source:
+            return
+        self._config_source = config
+        self.config = dict(config or {})
+        max_entries = self.config.get("maxEntries", 256)
+        while len(self._memory) > max_entries:
+            self._memory.popitem(last=False)
+
+    def is_cacheable(self, opt_in=None) -> bool:
+        """opt_in 为 False 时不缓存；为 True 时缓存；其他情况看 cacheAll"""
+        if not self.config.get("enabled", True) or opt_in is False:
+            return False
+        return bool(opt_in) or bool(self.config.get("cacheAll"))
+
+    def settings_fingerprint(self, settings: dict) -> str:
+        """配置快照的指纹，配置变化后旧的缓存条目自然失效；每个只读快照只计算一次"""
+        cached = self._fingerprints.get(id(settings))
+        if cached is not None and cached[0] is settings:
+            return cached[1]
+        fingerprint = make_key({k: v for k, v in settings.items() if k not in VOLATILE_SETTINGS})
+        if len(self._fingerprints) >= 8:
+            self._fingerprints.pop(next(iter(self._fingerprints)))
+        self._fingerprints[id(settings)] = (settings, fingerprint)
+        return fingerprint
+
+    async def _open_db(self):
+        if self._db is not None or self._db_failed or not self.config.get("diskEnabled", True):
+            return self._db
+        if self._db_lock is None:
+            self._db_lock = asyncio.Lock()
+        async with self._db_lock:
+            if self._db is None and not self._db_failed:
+                try:
+                    Path(os.path.dirname(self.path)).mkdir(parents=True, exist_ok=True)
+                    db = await aiosqlite.connect(self.path)
+                    for pragma in SQLITE_PRAGMAS:
+                        await db.execute(pragma)
+                    await db.execute('''
+                        CREATE TABLE IF NOT EXISTS response_cache (
+                            key TEXT PRIMARY KEY,
+                            kind TEXT NOT NULL,
+                            payload TEXT NOT NULL,
+                            created REAL NOT NULL,
+                            last_used REAL NOT NULL
+                        )
+                    ''')
+                    await db.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)')
+                    await db.commit()
+                    self._db = db
+                except Exception as e:
+                    self._db_failed = True
+                    logger.warning(f"Response cache disk tier is unavailable: {e!r}")
+        return self._db
+
+    def _expired(self, created: float) -> bool:
+        ttl = self.config.get("ttl", 86400)
+        return bool(ttl) and time.time() - created > ttl
+
+    async def get(self, key: str):
+        """命中时返回 (kind, payload)，否则返回 None"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            if not self._expired(entry[2]):
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                return entry[0], entry[1]
+            del self._memory[key]
+        db = await self._open_db()
+        if db is not None:
+            try:
+                async with db.execute('SELECT kind, payload, created FROM response_cache WHERE key = ?', (key,)) as cursor:
+                    row = await cursor.fetchone()
+                if row and not self._expired(row[2]):
+                    kind, payload = row[0], json.loads(row[1])
+                    await db.execute('UPDATE response_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+                    await db.commit()
+                    self._remember(key, kind, payload, row[2])
+                    self.stats.disk_hits += 1
+                    return kind, payload
+            except Exception as e:
+                logger.warning(f"Response cache read failed: {e!r}")
+        self.stats.misses += 1
+        return None
+
+    def _remember(self, key: str, kind: str, payload, created: float):
+        self._memory[key] = (kind, payload, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.config.get("maxEntries", 256):
+            self._memory.popitem(last=False)
+
+    async def put(self, key: str, kind: str, payload):
+        now = time.time()
+        self._remember(key, kind, payload, now)
+        self.stats.stores += 1
+        db = await self._open_db()
+        if db is None:
+            return
+        try:
+            await db.execute(
+                'INSERT OR REPLACE INTO response_cache (key, kind, payload, created, last_used) VALUES (?, ?, ?, ?, ?)',
+                (key, kind, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+            self._stores_since_prune += 1
+            if self._stores_since_prune >= 100:
+                self._stores_since_prune = 0
+                await self._prune(db)
+            await db.commit()
+        except Exception as e:
+            logger.warning(f"Response cache write failed: {e!r}")
+
+    async def _prune(self, db):
+        ttl = self.config.get("ttl", 86400)
+        if ttl:
+            await db.execute('DELETE FROM response_cache WHERE created < ?', (time.time() - ttl,))
+        await db.execute(
+            'DELETE FROM response_cache WHERE key NOT IN (SELECT key FROM response_cache ORDER BY last_used DESC LIMIT ?)',
+            (self.config.get("diskMaxEntries", 5000),)
+        )
+
+    async def record_stream(self, key: str, chunks):
+        """转发 SSE 数据块并收集，流正常结束（以 [DONE] 结尾且没有错误）时写入缓存"""
+        collected = []
+        async for chunk in chunks:
+            collected.append(chunk if isinstance(chunk, str) else chunk.decode("utf-8"))
+            yield chunk
+        if collected and collected[-1].strip() == "data: [DONE]" and not any(
+            marker in chunk for chunk in collected for marker in ERROR_MARKERS
+        ):
+            await self.put(key, "stream", collected)
+
+    @staticmethod
+    async def replay(chunks: list):
+        for chunk in chunks:
+            yield chunk
+
+    async def close(self):
+        if self._db is not None:
+            db, self._db = self._db, None
+            await db.close()
+
+    def to_dict(self) -> dict:
+        return {"memory_entries": len(self._memory), "disk_enabled": self._db is not None, **self.stats.to_dict()}
+
+class ResponseCacheStats:
+    def __init__(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.bypassed = 0  # 不满足缓存条件的请求
+
+    def to_dict(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "bypassed": self.bypassed,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+response_cache = ResponseCache()
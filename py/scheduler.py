@@ -0,0 +1,227 @@
+"""
+/v1/chat/completions 的准入控制：按上游（base_url）限制同时进行的请求数和每分钟 token 数，
+超出时请求按优先级排队（interactive > bot > agent > batch），同一优先级先到先得，
+排队超时或队列已满时返回 429。流式响应在整个流结束后才释放名额。
+智能体工具经 HTTP 发起的子调用同时带有内部凭据（INTERNAL_HEADER），在父请求的名额内执行、不再排队，
+避免父子互相等待；凭据由主进程生成并经环境变量传给 worker，客户端只带 agent 优先级时照常按 agent 类排队。
+"""
+import asyncio
+import heapq
+import hmac
+import itertools
+import logging
+import os
+import secrets
+import time
+from collections import deque
+
+from py.tool_registry import ToolStats
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_CLASSES = ("interactive", "bot", "agent", "batch")
+PRIORITY_HEADER = "X-Agent-Party-Priority"
+INTERNAL_HEADER = "X-Agent-Party-Internal"
+# 导入时生成（uvicorn 的 worker 子进程继承主进程的环境变量，得到同一个值）
+INTERNAL_TOKEN = os.environ.setdefault("AGENT_PARTY_INTERNAL_TOKEN", secrets.token_hex(32))
+DEFAULT_QUEUE_TIMEOUTS = {"interactive": 120, "bot": 60, "agent": 300, "batch": 600}
+TPM_WINDOW = 60.0
+
+def is_internal_call(token) -> bool:
+    """请求是否来自本服务内部（智能体工具的子调用）"""
+    return bool(token) and hmac.compare_digest(token.encode("utf-8"), INTERNAL_TOKEN.encode("utf-8"))
+
+class SchedulerRejected(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Ticket:
+    """一次获准的请求，release 可以重复调用"""
+    __slots__ = ("provider", "tokens", "released")
+
+    def __init__(self, provider, tokens: int):
+        self.provider = provider
+        self.tokens = tokens
+        self.released = False
+
+class _Waiter:
+    __slots__ = ("future", "priority_class", "tokens", "enqueued")
+
+    def __init__(self, future, priority_class: str, tokens: int):
+        self.future = future
+        self.priority_class = priority_class
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+
+class _Provider:
+    def __init__(self, name: str):
+        self.name = name
+        self.active = 0
+        self.waiters = []  # 堆：(优先级, 序号, _Waiter)
+        self.window = deque()  # 最近一分钟获准的请求 (时间, token 数)
+        self.window_tokens = 0
+        self.timer = None
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+class RequestScheduler:
+    def __init__(self):
+        self.config = {}
+        self._config_source = None
+        self._providers = {}
+        self._seq = itertools.count()
+        self.wait_stats = {name: ToolStats() for name in PRIORITY_CLASSES}
+
+    def configure(self, config: dict):
+        """从 settings['scheduler'] 读取配置，同一个只读配置对象重复传入时直接返回"""
+        if config is not None and config is self._config_source:
+            return
+        self._config_source = config
+        self.config = dict(config or {})
+        # 放宽限制后排队中的请求可能已经可以执行
+        for provider in self._providers.values():
+            self._dispatch(provider)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.config.get("enabled", True))
+
+    def _limits(self, name: str):
+        overrides = (self.config.get("providers") or {}).get(name) or {}
+        max_concurrency = overrides.get("maxConcurrency", self.config.get("maxConcurrency", 8))
+        tokens_per_minute = overrides.get("tokensPerMinute", self.config.get("tokensPerMinute", 0))
+        return max_concurrency, tokens_per_minute
+
+    def _provider(self, name: str) -> _Provider:
+        provider = self._providers.get(name)
+        if provider is None:
+            provider = self._providers[name] = _Provider(name)
+        return provider
+
+    def _trim(self, provider: _Provider, now: float):
+        while provider.window and now - provider.window[0][0] >= TPM_WINDOW:
+            provider.window_tokens -= provider.window.popleft()[1]
+
+    def _can_admit(self, provider: _Provider, tokens: int) -> bool:
+        max_concurrency, tokens_per_minute = self._limits(provider.name)
+        if max_concurrency and provider.active >= max_concurrency:
+            return False
+        # 单个请求超过整个预算时，等窗口清空后放行，避免永远排不上
+        return not tokens_per_minute or provider.window_tokens == 0 or provider.window_tokens + tokens <= tokens_per_minute
+
+    def _admit(self, provider: _Provider, tokens: int, now: float) -> Ticket:
+        provider.active += 1
+        provider.admitted += 1
+        if tokens:
+            provider.window.append((now, tokens))
+            provider.window_tokens += tokens
+        return Ticket(provider, tokens)
+
+    def _dispatch(self, provider: _Provider):
+        now = time.monotonic()
+        self._trim(provider, now)
+        while provider.waiters:
+            waiter = provider.waiters[0][2]
+            if waiter.future.done():
+                heapq.heappop(provider.waiters)
+                continue
+            # 严格按优先级：队首不能执行时后面的请求也不越过它
+            if not self._can_admit(provider, waiter.tokens):
+                break
+            heapq.heappop(provider.waiters)
+            self.wait_stats[waiter.priority_class].record((now - waiter.enqueued) * 1000, False)
+            waiter.future.set_result(self._admit(provider, waiter.tokens, now))
+        self._schedule_timer(provider)
+
+    def _schedule_timer(self, provider: _Provider):
+        """队首因 token 预算排队时，在最早的窗口记录过期后重新检查"""
+        if provider.timer is not None:
+            provider.timer.cancel()
+            provider.timer = None
+        if provider.waiters and provider.window:
+            delay = max(0.0, provider.window[0][0] + TPM_WINDOW - time.monotonic()) + 0.01
+            provider.timer = asyncio.get_running_loop().call_later(delay, self._dispatch, provider)
+
+    async def acquire(self, name: str, priority_class: str = "interactive", tokens: int = 0):
+        """排队直到获准，返回 Ticket；未启用时返回 None。超时或队列已满时抛出 SchedulerRejected"""
+        if not self.enabled:
+            return None
+        if priority_class not in PRIORITY_CLASSES:
+            priority_class = "interactive"
+        provider = self._provider(name)
+        now = time.monotonic()
+        self._trim(provider, now)
+        if not provider.waiters and self._can_admit(provider, tokens):
+            self.wait_stats[priority_class].record(0.0, False)
+            return self._admit(provider, tokens, now)
+
+        if len(provider.waiters) >= self.config.get("maxQueue", 100):
+            provider.rejected += 1
+            raise SchedulerRejected(f"Too many queued requests for {name}", self._retry_after(provider))
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), priority_class, tokens)
+        heapq.heappush(provider.waiters, (PRIORITY_CLASSES.index(priority_class), next(self._seq), waiter))
+        self._schedule_timer(provider)
+        timeout = {**DEFAULT_QUEUE_TIMEOUTS, **(self.config.get("queueTimeout") or {})}[priority_class]
+        try:
+            return await asyncio.wait_for(waiter.future, timeout)
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 获准的同时被取消：名额交还给下一个请求
+                self.release(waiter.future.result())
+            else:
+                waiter.future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                provider.timeouts += 1
+                self.wait_stats[priority_class].record(timeout * 1000, True)
+                raise SchedulerRejected(f"Queued for more than {timeout}s waiting for {name}", self._retry_after(provider))
+            raise
+
+    def _retry_after(self, provider: _Provider) -> float:
+        if provider.window:
+            return max(1.0, provider.window[0][0] + TPM_WINDOW - time.monotonic())
+        return 1.0
+
+    def release(self, ticket: Ticket):
+        if ticket is None or ticket.released:
+            return
+        ticket.released = True
+        ticket.provider.active -= 1
+        self._dispatch(ticket.provider)
+
+    async def hold(self, ticket: Ticket, chunks):
+        """转发流式响应，流结束或客户端断开时释放名额"""
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self.release(ticket)
+
+    def to_dict(self) -> dict:
+        providers = {}
+        for name, provider in sorted(self._providers.items()):
+            self._trim(provider, time.monotonic())
+            max_concurrency, tokens_per_minute = self._limits(name)
+            queued = {name: 0 for name in PRIORITY_CLASSES}
+            for _, _, waiter in provider.waiters:
+                if not waiter.future.done():
+                    queued[waiter.priority_class] += 1
+            providers[name] = {
+                "active": provider.active,
+                "max_concurrency": max_concurrency,
+                "queue_depth": sum(queued.values()),
+                "queued": queued,
+                "tokens_last_minute": provider.window_tokens,
+                "tokens_per_minute": tokens_per_minute,
+                "admitted": provider.admitted,
+                "rejected": provider.rejected,
+                "timeouts": provider.timeouts,
+            }
+        return {
+            "enabled": self.enabled,
+            "providers": providers,
+            "wait_ms": {name: stats.to_dict() for name, stats in self.wait_stats.items()},
+        }
+
+request_scheduler = RequestScheduler()
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+class SettingsBroadcaster:
+    """
+    配置推送：每个配置分区每个版本只序列化一次，
+    已确认(settings_ack)某个版本的客户端只收到变化的分区(settings_delta)，
+    其余客户端收到完整配置；并发发送，单个客户端超时后断开。
+    """
+    def __init__(self, send_timeout: float = 5.0, history_size: int = 8):
+        self.send_timeout = send_timeout
+        self.history_size = history_size
+        self.connections: Dict[object, int] = {}  # websocket -> 已确认的版本（-1 表示未确认）
+        self._history: "OrderedDict[int, Dict[str, str]]" = OrderedDict()
+        self._section_objects: Dict[str, object] = {}
+        self._section_text: Dict[str, str] = {}
+        self.stats = {
+            "broadcasts": 0,
+            "messages_sent": 0,
+            "full_sent": 0,
+            "delta_sent": 0,
+            "bytes_sent": 0,
+            "dropped": 0,
+            "last_latency_ms": 0.0,
+            "max_latency_ms": 0.0,
+            "total_latency_ms": 0.0,
+        }
+
+    def connect(self, websocket):
+        self.connections[websocket] = -1
+
+    def disconnect(self, websocket):
+        self.connections.pop(websocket, None)
+
+    def ack(self, websocket, version: int):
+        if websocket in self.connections:
+            self.connections[websocket] = version
+
+    def _sections(self, settings: dict, version: int) -> Dict[str, str]:
+        if version in self._history:
+            return self._history[version]
+        sections = {}
+        for name, value in settings.items():
+            # 快照中未变化的分区是同一个对象，直接复用上次的序列化结果
+            if self._section_objects.get(name) is value:
+                sections[name] = self._section_text[name]
+            else:
+                sections[name] = json.dumps(value, ensure_ascii=False)
+        self._section_objects = dict(settings)
+        self._section_text = sections
+        self._history[version] = sections
+        while len(self._history) > self.history_size:
+            self._history.popitem(last=False)
+        return sections
+
+    @staticmethod
+    def _encode(sections: Dict[str, str]) -> str:
+        return "{" + ",".join(f"{json.dumps(name)}:{text}" for name, text in sections.items()) + "}"
+
+    def full_message(self, settings: dict, version: int) -> str:
+        data = self._encode(self._sections(settings, version))
+        return f'{{"type":"settings","version":{version},"data":{data}}}'
+
+    def _delta_message(self, base: Dict[str, str], sections: Dict[str, str], base_version: int, version: int) -> str:
+        changed = {name: text for name, text in sections.items() if base.get(name) != text}
+        removed = [name for name in base if name not in sections]
+        return (f'{{"type":"settings_delta","version":{version},"base_version":{base_version},'
+                f'"data":{self._encode(changed)},"removed":{json.dumps(removed)}}}')
+
+    async def send_snapshot(self, websocket, settings: dict, version: int):
+        """向单个客户端发送完整配置（连接建立或 get_settings 时）"""
+        text = self.full_message(settings, version)
+        await websocket.send_text(text)
+        self._count(text, full=True)
+
+    async def broadcast(self, settings: dict, version: int):
+        """向所有客户端并发推送配置更新"""
+        start = time.perf_counter()
+        sections = self._sections(settings, version)
+        full_text = None
+        deltas: Dict[int, str] = {}
+        targets = []
+        for websocket, acked in list(self.connections.items()):
+            if acked == version:
+                continue
+            if acked in self._history and acked != version:
+                if acked not in deltas:
+                    deltas[acked] = self._delta_message(self._history[acked], sections, acked, version)
+                targets.append((websocket, deltas[acked], False))
+            else:
+                if full_text is None:
+                    full_text = self.full_message(settings, version)
+                targets.append((websocket, full_text, True))
+        await asyncio.gather(*[self._send(websocket, text, full) for websocket, text, full in targets])
+        latency = (time.perf_counter() - start) * 1000
+        self.stats["broadcasts"] += 1
+        self.stats["last_latency_ms"] = latency
+        self.stats["max_latency_ms"] = max(self.stats["max_latency_ms"], latency)
+        self.stats["total_latency_ms"] += latency
+
+    async def _send(self, websocket, text: str, full: bool):
+        try:
+            await asyncio.wait_for(websocket.send_text(text), timeout=self.send_timeout)
+            self._count(text, full)
+        except Exception as e:
+            logger.error(f"Broadcast failed, dropping connection: {e!r}")
+            self.disconnect(websocket)
+            self.stats["dropped"] += 1
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+    def _count(self, text: str, full: bool):
+        self.stats["messages_sent"] += 1
+        self.stats["bytes_sent"] += len(text.encode("utf-8"))
+        self.stats["full_sent" if full else "delta_sent"] += 1
+
+    def get_stats(self) -> dict:
+        broadcasts = self.stats["broadcasts"]
+        return {
+            **self.stats,
+            "avg_latency_ms": self.stats["total_latency_ms"] / broadcasts if broadcasts else 0.0,
+            "connections": len(self.connections),
+        }
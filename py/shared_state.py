@@ -0,0 +1,313 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+import time
+from pathlib import Path
+
+import aiosqlite
+import httpx
+
+from py.get_setting import USER_DATA_DIR, SQLITE_PRAGMAS
+
+logger = logging.getLogger(__name__)
+
+SHARED_STATE_PATH = os.path.join(USER_DATA_DIR, 'shared_state.db')
+OWNER_LOCK_PATH = os.path.join(USER_DATA_DIR, 'worker_owner.lock')
+# server.py --workers N 会设置该环境变量，uvicorn 启动的子进程据此进入多进程模式
+WORKERS_ENV = "AGENT_PARTY_WORKERS"
+# 只能由主 worker 处理的请求（持有 MCP 连接、QQ 机器人线程）
+OWNER_PATH_PREFIXES = (
+    "/_owner/",
+    "/create_mcp",
+    "/remove_mcp",
+    "/start_qq_bot",
+    "/stop_qq_bot",
+    "/reload_qq_bot",
+    "/qq_bot_status",
+)
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "content-encoding", "host"}
+
+def get_worker_count() -> int:
+    try:
+        return max(1, int(os.environ.get(WORKERS_ENV, "1")))
+    except ValueError:
+        return 1
+
+class SharedStore:
+    """
+    多进程共享状态：单进程时直接使用内存字典，--workers N 时使用 SQLite(WAL) 文件，
+    任务状态、异步工具结果和会话状态对所有 worker 可见；
+    publish/subscribe 通过轮询消息表把事件转发给其他 worker。
+    MCP 连接、QQ 机器人等单例由持有文件锁的主 worker 负责，其他 worker 将相关请求转发给它。
+    """
+    def __init__(self, path: str = SHARED_STATE_PATH, lock_path: str = OWNER_LOCK_PATH,
+                 poll_interval: float = 0.05, message_ttl: float = 60.0):
+        self.path = path
+        self.lock_path = lock_path
+        self.poll_interval = poll_interval
+        self.message_ttl = message_ttl
+        self.workers = 1
+        self.is_owner = True
+        self._data = {}  # 单进程模式：namespace -> {key: value}
+        self._db = None
+        self._lock = None
+        self._loop = None
+        self._handlers = {}  # channel -> [async handler]
+        self._poll_task = None
+        self._last_message_id = 0
+        self._lock_file = None
+        self._internal_server = None
+        self._internal_task = None
+        self._http = None
+
+    @property
+    def multi_worker(self) -> bool:
+        return self.workers > 1
+
+    async def open(self):
+        self._loop = asyncio.get_running_loop()
+        self.workers = get_worker_count()
+        if not self.multi_worker:
+            return
+        self.is_owner = False
+        Path(os.path.dirname(self.path)).mkdir(parents=True, exist_ok=True)
+        # isolation_level=None：单条语句自动提交，pop 等复合操作显式开启事务
+        self._db = await aiosqlite.connect(self.path, isolation_level=None)
+        for pragma in SQLITE_PRAGMAS:
+            await self._db.execute(pragma)
+        await self._db.execute('''
+            CREATE TABLE IF NOT EXISTS shared_state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+        await self._db.execute('''
+            CREATE TABLE IF NOT EXISTS shared_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                sender INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+        ''')
+        async with self._db.execute('SELECT COALESCE(MAX(id), 0) FROM shared_messages') as cursor:
+            (self._last_message_id,) = await cursor.fetchone()
+        self._lock = asyncio.Lock()
+        self._http = httpx.AsyncClient(timeout=None)
+        self._poll_task = asyncio.create_task(self._poll_messages())
+
+    async def close(self):
+        if self._poll_task:
+            self._poll_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._poll_task
+            self._poll_task = None
+        if self._internal_server:
+            self._internal_server.should_exit = True
+            with contextlib.suppress(Exception):
+                await self._internal_task
+            self._internal_server = None
+        if self._http:
+            await self._http.aclose()
+            self._http = None
+        if self._db:
+            await self._db.close()
+            self._db = None
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # ---------- 键值存储 ----------
+
+    async def get(self, namespace: str, key: str, default=None):
+        if not self.multi_worker:
+            return self._data.get(namespace, {}).get(key, default)
+        async with self._lock:
+            async with self._db.execute(
+                'SELECT value FROM shared_state WHERE namespace = ? AND key = ?', (namespace, key)
+            ) as cursor:
+                row = await cursor.fetchone()
+        return json.loads(row[0]) if row else default
+
+    async def get_many(self, namespace: str, keys) -> dict:
+        """按 keys 的顺序返回存在的条目"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        if not self.multi_worker:
+            data = self._data.get(namespace, {})
+            return {key: data[key] for key in keys if key in data}
+        async with self._lock:
+            async with self._db.execute(
+                f"SELECT key, value FROM shared_state WHERE namespace = ? AND key IN ({','.join('?' * len(keys))})",
+                (namespace, *keys)
+            ) as cursor:
+                rows = dict(await cursor.fetchall())
+        return {key: json.loads(rows[key]) for key in keys if key in rows}
+
+    async def set(self, namespace: str, key: str, value):
+        if not self.multi_worker:
+            self._data.setdefault(namespace, {})[key] = value
+            return
+        async with self._lock:
+            await self._db.execute(
+                'INSERT OR REPLACE INTO shared_state (namespace, key, value, updated) VALUES (?, ?, ?, ?)',
+                (namespace, key, json.dumps(value, ensure_ascii=False), time.time())
+            )
+
+    async def pop(self, namespace: str, key: str, default=None):
+        """取出并删除，多个 worker 同时取同一条目时只有一个能拿到"""
+        if not self.multi_worker:
+            return self._data.get(namespace, {}).pop(key, default)
+        async with self._lock:
+            await self._db.execute('BEGIN IMMEDIATE')
+            try:
+                async with self._db.execute(
+                    'SELECT value FROM shared_state WHERE namespace = ? AND key = ?', (namespace, key)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                if row:
+                    await self._db.execute(
+                        'DELETE FROM shared_state WHERE namespace = ? AND key = ?', (namespace, key)
+                    )
+                await self._db.execute('COMMIT')
+            except Exception:
+                await self._db.execute('ROLLBACK')
+                raise
+        return json.loads(row[0]) if row else default
+
+    # ---------- 跨 worker 消息 ----------
+
+    def subscribe(self, channel: str, handler):
+        """handler(data) 为协程函数，只接收其他 worker 发布的消息"""
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def publish(self, channel: str, data=None):
+        """发布给其他 worker；单进程模式下没有其他 worker，直接返回"""
+        if not self.multi_worker or self._db is None:
+            return
+        async with self._lock:
+            await self._db.execute(
+                'INSERT INTO shared_messages (channel, sender, data, created) VALUES (?, ?, ?, ?)',
+                (channel, os.getpid(), json.dumps(data, ensure_ascii=False), time.time())
+            )
+
+    def publish_nowait(self, channel: str, data=None):
+        """同步代码中发布（例如配置保存回调），可在其他线程的事件循环中调用"""
+        if not self.multi_worker or self._loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._loop.create_task(self.publish(channel, data))
+        else:
+            asyncio.run_coroutine_threadsafe(self.publish(channel, data), self._loop)
+
+    async def _poll_messages(self):
+        next_prune = 0.0
+        pid = os.getpid()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                async with self._lock:
+                    async with self._db.execute(
+                        'SELECT id, channel, sender, data FROM shared_messages WHERE id > ? ORDER BY id',
+                        (self._last_message_id,)
+                    ) as cursor:
+                        rows = await cursor.fetchall()
+                    now = time.time()
+                    if now >= next_prune:
+                        await self._db.execute('DELETE FROM shared_messages WHERE created < ?', (now - self.message_ttl,))
+                        next_prune = now + self.message_ttl / 2
+                for message_id, channel, sender, data in rows:
+                    self._last_message_id = message_id
+                    if sender == pid:
+                        continue
+                    for handler in self._handlers.get(channel, ()):
+                        try:
+                            await handler(json.loads(data))
+                        except Exception as e:
+                            logger.error(f"Shared message handler for {channel} failed: {e!r}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Polling shared messages failed: {e!r}")
+
+    # ---------- 主 worker ----------
+
+    def try_acquire_owner(self) -> bool:
+        """用文件锁选出主 worker，进程退出时锁自动释放，其他 worker 可以接管"""
+        if self.is_owner:
+            return True
+        lock_file = open(self.lock_path, 'a+')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.is_owner = True
+        return True
+
+    async def serve_owner(self, app):
+        """主 worker 在回环地址的随机端口上额外提供同一个 app，供其他 worker 转发请求"""
+        import uvicorn
+
+        class InternalServer(uvicorn.Server):
+            # 信号仍由对外的主服务器处理
+            def install_signal_handlers(self):
+                pass
+
+            @contextlib.contextmanager
+            def capture_signals(self):
+                yield
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        self._internal_server = InternalServer(uvicorn.Config(app, lifespan="off", log_level="warning"))
+        self._internal_task = asyncio.create_task(self._internal_server.serve(sockets=[sock]))
+        await self.set("workers", "owner_url", f"http://127.0.0.1:{port}")
+        await self.set("workers", "owner_pid", os.getpid())
+
+    async def get_owner_url(self):
+        return await self.get("workers", "owner_url")
+
+    def is_owner_path(self, path: str) -> bool:
+        return self.multi_worker and not self.is_owner and path.startswith(OWNER_PATH_PREFIXES)
+
+    async def forward_to_owner(self, request):
+        """把只能由主 worker 处理的 HTTP 请求原样转发过去"""
+        from fastapi.responses import JSONResponse, Response
+        owner_url = await self.get_owner_url()
+        if not owner_url:
+            return JSONResponse(status_code=503, content={"success": False, "message": "owner worker not ready"})
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        try:
+            response = await self._http.request(
+                request.method,
+                owner_url + request.url.path,
+                params=request.query_params,
+                headers=headers,
+                content=await request.body(),
+            )
+        except httpx.HTTPError as e:
+            return JSONResponse(status_code=503, content={"success": False, "message": f"owner worker unreachable: {e!r}"})
+        response_headers = {k: v for k, v in response.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        return Response(content=response.content, status_code=response.status_code, headers=response_headers)
+
+shared_store = SharedStore()
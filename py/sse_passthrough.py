@@ -0,0 +1,107 @@
+"""
+上游聊天流的 SSE 直通：按原始 SSE 行读取上游响应，只做一次 json.loads；
+不需要改写的数据块（没有思考标签、没有工具调用、推理内容已由服务商拆分）原样转发，
+需要改写时再构造 ChatCompletionChunk 走完整处理流程。
+
+吞吐基准（单核，tokens/s）：
+    python -m py.sse_passthrough --chunks 20000
+"""
+import json
+
+from openai import APIError
+from openai._models import construct_type
+from openai.types.chat import ChatCompletionChunk
+
+async def stream_chat_chunks(client, **kwargs):
+    """调用 chat.completions 流式接口，逐块产出 (原始 JSON 字符串, 解析后的 dict)"""
+    kwargs["stream"] = True
+    async with client.chat.completions.with_streaming_response.create(**kwargs) as response:
+        async for line in response.iter_lines():
+            if not line.startswith("data:"):
+                continue
+            raw = line[5:].strip()
+            if raw == "[DONE]":
+                break
+            if not raw:
+                continue
+            data = json.loads(raw)
+            if "error" in data:
+                error = data["error"]
+                message = error.get("message") if isinstance(error, dict) else str(error)
+                raise APIError(message or "An error occurred during streaming", response.http_response.request, body=error)
+            yield raw, data
+
+def to_chunk(data: dict) -> ChatCompletionChunk:
+    """与 SDK 相同的宽松构造（不做校验），用于需要改写的慢路径"""
+    return construct_type(type_=ChatCompletionChunk, value=data)
+
+def passthrough_delta(data: dict):
+    """数据块可以原样转发时返回其 delta，否则返回 None"""
+    delta = data["choices"][0].get("delta") or {}
+    if delta.get("tool_calls"):
+        return None
+    content = delta.get("content")
+    # 可能包含 <think> 标签，交给完整流程处理
+    if content and "<" in content:
+        return None
+    return delta
+
+def _sample_chunks(count: int):
+    chunks = []
+    for i in range(count):
+        chunks.append(json.dumps({
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "benchmark-model",
+            "system_fingerprint": None,
+            "choices": [{
+                "index": 0,
+                "delta": {"role": "assistant", "content": f"token{i % 100} "},
+                "logprobs": None,
+                "finish_reason": None,
+            }],
+        }))
+    return chunks
+
+def _full_path(raw_chunks):
+    out = []
+    for raw in raw_chunks:
+        chunk = to_chunk(json.loads(raw))
+        chunk_dict = chunk.model_dump()
+        delta = chunk_dict["choices"][0]["delta"]
+        delta.setdefault("content", "")
+        delta.setdefault("reasoning_content", "")
+        out.append(f"data: {json.dumps(chunk_dict)}\n\n")
+    return out
+
+def _fast_path(raw_chunks):
+    out = []
+    full_content = ""
+    for raw in raw_chunks:
+        data = json.loads(raw)
+        delta = passthrough_delta(data)
+        if delta is None:
+            continue
+        out.append(f"data: {raw}\n\n")
+        full_content += delta.get("content") or ""
+    return out
+
+def main():
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="SSE passthrough throughput benchmark")
+    parser.add_argument("--chunks", type=int, default=20000, help="number of single-token chunks")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    raw_chunks = _sample_chunks(args.chunks)
+    for name, path in (("full path", _full_path), ("passthrough", _fast_path)):
+        best = float("inf")
+        for _ in range(args.rounds):
+            start = time.process_time()
+            path(raw_chunks)
+            best = min(best, time.process_time() - start)
+        print(f"{name:<12} {args.chunks / best:>12,.0f} tokens/s per core  ({best * 1e6 / args.chunks:.1f} us/chunk)")
+
+if __name__ == "__main__":
+    main()
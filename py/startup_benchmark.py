@@ -0,0 +1,150 @@
+"""
+启动性能基准：各模块导入耗时、启动到 /health 可用的时间、启动后的常驻内存。
+
+用法（在项目根目录执行）：
+    python -m py.startup_benchmark --runs 3
+    python -m py.startup_benchmark --max-ready-ms 4000 --max-rss-mb 400   # 超出阈值时退出码为 1
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def measure_imports(python: str = sys.executable):
+    """用 -X importtime 导入 server，返回 (总耗时ms, {顶层包: 累计耗时ms})"""
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", "import server"],
+        cwd=ROOT_DIR, capture_output=True, text=True, encoding="utf-8", errors="replace",
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import server failed:\n{result.stderr[-2000:]}")
+    packages = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        cumulative, indent, name = int(match.group(2)) / 1000, match.group(3), match.group(4)
+        if name == "server":
+            total = cumulative
+        elif len(indent) == 3:
+            # 只统计 server 直接导入的模块，嵌套导入已包含在累计时间中
+            top = name.split(".")[0]
+            packages[top] = packages.get(top, 0.0) + cumulative
+    return total, packages
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / 1024 / 1024
+    except Exception:
+        return None
+
+def measure_ready(python: str = sys.executable, timeout: float = 120.0, settle: float = 1.0):
+    """启动 server.py，返回 (到 /health 可用的耗时ms, 启动后的 RSS MB)"""
+    port = _free_port()
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [python, "server.py", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        url = f"http://127.0.0.1:{port}/health"
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server.py exited with code {proc.returncode}")
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError(f"/health not ready after {timeout}s")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        break
+            except OSError:
+                time.sleep(0.05)
+        ready_ms = (time.perf_counter() - start) * 1000
+        # 等待 lifespan 中的后台任务完成后再读取内存
+        time.sleep(settle)
+        return ready_ms, _rss_mb(proc.pid)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+def run(runs: int = 3, top: int = 15):
+    import_totals, ready_times, rss_values = [], [], []
+    packages = {}
+    for _ in range(runs):
+        total, pkgs = measure_imports()
+        import_totals.append(total)
+        for name, ms in pkgs.items():
+            packages.setdefault(name, []).append(ms)
+        ready_ms, rss = measure_ready()
+        ready_times.append(ready_ms)
+        if rss is not None:
+            rss_values.append(rss)
+    slowest = sorted(((name, statistics.median(v)) for name, v in packages.items()), key=lambda x: -x[1])[:top]
+    return {
+        "runs": runs,
+        "import_server_ms": statistics.median(import_totals),
+        "ready_ms": statistics.median(ready_times),
+        "rss_mb": statistics.median(rss_values) if rss_values else None,
+        "slowest_imports_ms": dict(slowest),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark for server.py")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to report")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-import-ms", type=float)
+    parser.add_argument("--max-ready-ms", type=float)
+    parser.add_argument("--max-rss-mb", type=float)
+    args = parser.parse_args()
+
+    report = run(args.runs, args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"import server : {report['import_server_ms']:.0f} ms")
+        print(f"/health ready : {report['ready_ms']:.0f} ms")
+        print(f"RSS after boot: {report['rss_mb']:.1f} MB" if report["rss_mb"] is not None else "RSS after boot: n/a")
+        print("slowest imports:")
+        for name, ms in report["slowest_imports_ms"].items():
+            print(f"  {name:<30} {ms:8.1f} ms")
+
+    failures = []
+    if args.max_import_ms is not None and report["import_server_ms"] > args.max_import_ms:
+        failures.append(f"import {report['import_server_ms']:.0f} ms > {args.max_import_ms:.0f} ms")
+    if args.max_ready_ms is not None and report["ready_ms"] > args.max_ready_ms:
+        failures.append(f"ready {report['ready_ms']:.0f} ms > {args.max_ready_ms:.0f} ms")
+    if args.max_rss_mb is not None and report["rss_mb"] is not None and report["rss_mb"] > args.max_rss_mb:
+        failures.append(f"rss {report['rss_mb']:.1f} MB > {args.max_rss_mb:.1f} MB")
+    if failures:
+        print("REGRESSION: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
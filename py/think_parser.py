@@ -0,0 +1,165 @@
+"""
+<think>...</think> 标签的增量解析：流式输出时把每个数据块拆成正文和思考内容。
+跨数据块被截断的标签会暂存到下一块再判断，不会泄漏到输出中；整体复杂度 O(n)。
+
+自检（随机切分的模糊测试）与长推理输出基准：
+    python -m py.think_parser --fuzz 2000 --tokens 50000
+"""
+
+class ThinkTagParser:
+    def __init__(self, open_tag: str = "<think>", close_tag: str = "</think>"):
+        self.open_tag = open_tag
+        self.close_tag = close_tag
+        self.in_reasoning = False
+        self._pending = ""  # 末尾可能是标签开头的部分，等下一块再判断
+
+    @property
+    def busy(self) -> bool:
+        """处于思考标签内或有暂存内容时为 True，此时数据块不能原样转发"""
+        return self.in_reasoning or bool(self._pending)
+
+    @staticmethod
+    def _partial_tag(buffer: str, start: int, tag: str) -> int:
+        """buffer[start:] 的末尾与 tag 开头重合的最大长度"""
+        pos = buffer.find(tag[0], max(start, len(buffer) - len(tag) + 1))
+        while pos != -1:
+            if tag.startswith(buffer[pos:]):
+                return len(buffer) - pos
+            pos = buffer.find(tag[0], pos + 1)
+        return 0
+
+    def feed(self, text: str):
+        """输入一块文本，返回 (正文, 思考内容)"""
+        if not text:
+            return "", ""
+        buffer = self._pending + text if self._pending else text
+        self._pending = ""
+        tag = self.close_tag if self.in_reasoning else self.open_tag
+        if tag[0] not in buffer:
+            # 绝大多数数据块不含标签字符，直接返回
+            return ("", buffer) if self.in_reasoning else (buffer, "")
+        content, reasoning = [], []
+        start = 0
+        while True:
+            tag = self.close_tag if self.in_reasoning else self.open_tag
+            output = reasoning if self.in_reasoning else content
+            pos = buffer.find(tag, start)
+            if pos == -1:
+                keep = self._partial_tag(buffer, start, tag)
+                end = len(buffer) - keep
+                output.append(buffer[start:end])
+                self._pending = buffer[end:]
+                break
+            output.append(buffer[start:pos])
+            start = pos + len(tag)
+            self.in_reasoning = not self.in_reasoning
+        return "".join(content), "".join(reasoning)
+
+    def flush(self):
+        """流结束时输出暂存的内容并回到初始状态，返回 (正文, 思考内容)"""
+        pending, self._pending = self._pending, ""
+        in_reasoning, self.in_reasoning = self.in_reasoning, False
+        if in_reasoning:
+            return "", pending
+        return pending, ""
+
+    @classmethod
+    def split(cls, text: str, open_tag: str = "<think>", close_tag: str = "</think>"):
+        """一次性拆分完整文本，返回 (正文, 思考内容)"""
+        parser = cls(open_tag, close_tag)
+        content, reasoning = parser.feed(text or "")
+        tail_content, tail_reasoning = parser.flush()
+        return content + tail_content, reasoning + tail_reasoning
+
+def _reference_split(text: str, open_tag: str = "<think>", close_tag: str = "</think>"):
+    content, reasoning = [], []
+    in_reasoning = False
+    start = 0
+    while True:
+        tag = close_tag if in_reasoning else open_tag
+        pos = text.find(tag, start)
+        if pos == -1:
+            (reasoning if in_reasoning else content).append(text[start:])
+            return "".join(content), "".join(reasoning)
+        (reasoning if in_reasoning else content).append(text[start:pos])
+        start = pos + len(tag)
+        in_reasoning = not in_reasoning
+
+def _fuzz(rounds: int, seed: int = 0):
+    import random
+    rng = random.Random(seed)
+    pieces = ["<think>", "</think>", "<", "</", "<th", "think>", "k>", ">", "a", "bc", "思考", "\n", " "]
+    for _ in range(rounds):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 60)))
+        cuts = sorted(rng.sample(range(len(text) + 1), rng.randint(0, min(len(text), 12))))
+        chunks = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+        parser = ThinkTagParser()
+        content, reasoning = [], []
+        for chunk in chunks:
+            c, r = parser.feed(chunk)
+            content.append(c)
+            reasoning.append(r)
+        c, r = parser.flush()
+        content.append(c)
+        reasoning.append(r)
+        result = ("".join(content), "".join(reasoning))
+        expected = _reference_split(text)
+        assert result == expected, (chunks, result, expected)
+
+def _legacy_reasoner_loop(chunks, open_tag="<think>", close_tag="</think>"):
+    # 旧实现：正文一直累积在 buffer 中并反复 find，长输出时为平方复杂度
+    buffer = ""
+    in_reasoning = False
+    reasoning = []
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            if not in_reasoning:
+                start_pos = buffer.find(open_tag)
+                if start_pos == -1:
+                    break
+                buffer = buffer[start_pos + len(open_tag):]
+                in_reasoning = True
+            else:
+                end_pos = buffer.find(close_tag)
+                if end_pos != -1:
+                    reasoning.append(buffer[:end_pos])
+                    buffer = buffer[end_pos + len(close_tag):]
+                    in_reasoning = False
+                else:
+                    reasoning.append(buffer)
+                    buffer = ""
+                    break
+    return "".join(reasoning)
+
+def main():
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="ThinkTagParser fuzz test and benchmark")
+    parser.add_argument("--fuzz", type=int, default=2000, help="number of random fuzz cases")
+    parser.add_argument("--tokens", type=int, default=50000, help="chunks in the benchmark stream")
+    args = parser.parse_args()
+
+    _fuzz(args.fuzz)
+    print(f"fuzz: {args.fuzz} cases ok")
+
+    # 长推理输出：思考内容之后是同样长的正文
+    half = args.tokens // 2
+    chunks = ["<think>"] + ["step "] * half + ["</think>"] + ["word "] * half
+    def run_parser():
+        parser = ThinkTagParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.flush()
+
+    for name, run in (
+        ("ThinkTagParser", run_parser),
+        ("legacy reasoner loop", lambda: _legacy_reasoner_loop(chunks)),
+    ):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<22} {len(chunks) / elapsed:>14,.0f} chunks/s  ({elapsed * 1000:.1f} ms)")
+
+if __name__ == "__main__":
+    main()
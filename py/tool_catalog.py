@@ -0,0 +1,130 @@
+import json
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+COMFYUI_TEXT_DESCRIPTIONS = {
+    "text_input": "第一个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
+    "text_input_2": "第二个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
+}
+COMFYUI_IMAGE_DESCRIPTIONS = {
+    "image_input": "第一个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
+    "image_input_2": "第二个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
+}
+
+def comfyui_tool(workflow: dict) -> dict:
+    comfyui_properties = {}
+    comfyui_required = []
+    for name, description in {**COMFYUI_TEXT_DESCRIPTIONS, **COMFYUI_IMAGE_DESCRIPTIONS}.items():
+        if workflow[name] is not None:
+            comfyui_properties[name] = {
+                "description": description,
+                "type": "string"
+            }
+            comfyui_required.append(name)
+    return {
+        "type": "function",
+        "function": {
+            "name": f"comfyui_{workflow['unique_filename']}",
+            "description": f"{workflow['description']}+\n如果要输入图片提示词或者修改提示词，尽可能使用英语。\n返回的图片结果，请将图片的URL放入![image]()这样的markdown语法中，用户才能看到图片。如果是视频，请将视频的URL放入<video controls> <source src=''></video>的中src中，用户才能看到视频。如果有多个结果，则请用换行符分隔开这几个图片或者视频，用户才能看到多个结果。",
+            "parameters": {
+                "type": "object",
+                "properties": comfyui_properties,
+                "required": comfyui_required
+            },
+        },
+    }
+
+async def build_tools(settings: dict, mcp_clients: dict) -> list:
+    """根据配置生成工具列表（MCP、自定义LLM/Agent/A2A、绘图、文件、代码、自定义HTTP、ComfyUI）"""
+    from py.load_files import file_tool,image_tool
+    from py.agent_tool import get_agent_tool
+    from py.a2a_tool import get_a2a_tool
+    from py.llm_tool import get_llm_tool
+    from py.pollinations import pollinations_image_tool,openai_image_tool,siliconflow_image_tool
+    from py.code_interpreter import e2b_code_tool,local_run_code_tool
+    tools = []
+    for server_name, mcp_client in mcp_clients.items():
+        if server_name in settings['mcpServers']:
+            if settings['mcpServers'][server_name].get('disabled', False) == False and settings['mcpServers'][server_name]['processingStatus'] == 'ready':
+                function = await mcp_client.get_openai_functions()
+                if function:
+                    tools.extend(function)
+    get_llm_tool_fuction = await get_llm_tool(settings)
+    if get_llm_tool_fuction:
+        tools.append(get_llm_tool_fuction)
+    get_agent_tool_fuction = await get_agent_tool(settings)
+    if get_agent_tool_fuction:
+        tools.append(get_agent_tool_fuction)
+    get_a2a_tool_fuction = await get_a2a_tool(settings)
+    if get_a2a_tool_fuction:
+        tools.append(get_a2a_tool_fuction)
+    if settings['text2imgSettings']['enabled']:
+        if settings['text2imgSettings']['engine'] == 'pollinations':
+            tools.append(pollinations_image_tool)
+        elif settings['text2imgSettings']['engine'] == 'openai':
+            if settings['text2imgSettings']['vendor'] == 'siliconflow':
+                tools.append(siliconflow_image_tool)
+            else:
+                tools.append(openai_image_tool)
+    if settings['tools']['getFile']['enabled']:
+        tools.append(file_tool)
+        tools.append(image_tool)
+    if settings["codeSettings"]['enabled']:
+        if settings["codeSettings"]["engine"] == "e2b":
+            tools.append(e2b_code_tool)
+        elif settings["codeSettings"]["engine"] == "sandbox":
+            tools.append(local_run_code_tool)
+    for custom_http in settings["custom_http"] or []:
+        if custom_http["enabled"]:
+            tools.append({
+                "type": "function",
+                "function": {
+                    "name": f"custom_http_{custom_http['name']}",
+                    "description": f"{custom_http['description']}",
+                    "parameters": json.loads(custom_http['body'] or "{}"),
+                },
+            })
+    for workflow in settings["workflows"] or []:
+        if workflow["enabled"]:
+            tools.append(comfyui_tool(workflow))
+    return tools
+
+class ToolCatalog:
+    """
+    工具目录缓存：配置快照是只读的，同一个快照对象（同一配置版本）生成的工具列表可以直接复用；
+    MCP 连接的工具列表变化（连接、断开、list_changed 通知）时 tools_generation 改变，缓存随之失效。
+    返回的列表和其中的工具定义是共享的，调用方需要追加工具时先复制列表。
+    """
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        # id(settings) -> (settings, mcp_state, tools)，保留 settings 引用防止 id 被复用
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def _mcp_state(mcp_clients: dict) -> tuple:
+        return tuple((name, client.tools_generation, client.disabled) for name, client in mcp_clients.items())
+
+    async def get_tools(self, settings: dict, mcp_clients: dict) -> list:
+        key = id(settings)
+        mcp_state = self._mcp_state(mcp_clients)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is settings and entry[1] == mcp_state:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[2]
+        self.stats["misses"] += 1
+        tools = await build_tools(settings, mcp_clients)
+        self._entries[key] = (settings, mcp_state, tools)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        logger.info(f"Tool catalog rebuilt: {[tool['function']['name'] for tool in tools]}")
+        return tools
+
+    def clear(self):
+        self._entries.clear()
+
+tool_catalog = ToolCatalog()
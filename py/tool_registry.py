@@ -0,0 +1,225 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import OrderedDict
+from py.mcp_clients import mcp_tool_index
+
+logger = logging.getLogger(__name__)
+
+# 延迟直方图的桶上界（毫秒），最后一个桶收集更慢的调用
+LATENCY_BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+def _builtin_hooks() -> dict:
+    from py.web_search import (
+        DDGsearch_async,
+        searxng_async,
+        Tavily_search_async,
+        Bing_search_async,
+        Google_search_async,
+        Brave_search_async,
+        Exa_search_async,
+        Serper_search_async,
+        bochaai_search_async,
+        jina_crawler_async,
+        Crawl4Ai_search_async,
+    )
+    from py.know_base import query_knowledge_base
+    from py.agent_tool import agent_tool_call
+    from py.a2a_tool import a2a_tool_call
+    from py.llm_tool import custom_llm_tool
+    from py.pollinations import pollinations_image,openai_image,siliconflow_image
+    from py.load_files import get_file_content
+    from py.code_interpreter import e2b_code_async,local_run_code_async
+    from py.comfyui_tool import comfyui_tool_call
+    return {
+        "DDGsearch_async": DDGsearch_async,
+        "searxng_async": searxng_async,
+        "Tavily_search_async": Tavily_search_async,
+        "query_knowledge_base": query_knowledge_base,
+        "jina_crawler_async": jina_crawler_async,
+        "Crawl4Ai_search_async": Crawl4Ai_search_async,
+        "agent_tool_call": agent_tool_call,
+        "a2a_tool_call": a2a_tool_call,
+        "custom_llm_tool": custom_llm_tool,
+        "pollinations_image":pollinations_image,
+        "get_file_content":get_file_content,
+        "e2b_code_async": e2b_code_async,
+        "local_run_code_async": local_run_code_async,
+        "openai_image": openai_image,
+        "siliconflow_image": siliconflow_image,
+        "Bing_search_async": Bing_search_async,
+        "Google_search_async": Google_search_async,
+        "Brave_search_async": Brave_search_async,
+        "Exa_search_async": Exa_search_async,
+        "Serper_search_async": Serper_search_async,
+        "bochaai_search_async": bochaai_search_async,
+        "comfyui_tool_call": comfyui_tool_call,
+    }
+
+class ToolStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, elapsed_ms: float, error: bool):
+        self.calls += 1
+        self.errors += error
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": self.total_ms / self.calls if self.calls else 0.0,
+            "max_ms": self.max_ms,
+            "histogram_ms": {
+                **{f"<={bound}": count for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets)},
+                f">{LATENCY_BUCKETS_MS[-1]}": self.buckets[-1],
+            },
+        }
+
+class ToolRegistry:
+    """
+    工具分派表：内置工具的处理函数在第一次调用时导入并建表，之后不再重复；
+    自定义HTTP和ComfyUI工具按配置快照预先整理成 名称 -> 描述 的字典（配置快照只读，快照对象变化即配置变化）；
+    每个工具记录调用次数、错误数和延迟直方图。
+    """
+    CUSTOM_HTTP_PREFIX = "custom_http_"
+    COMFYUI_PREFIX = "comfyui_"
+    MULTI_TOOL_PREFIX = "multi_tool_use."
+
+    def __init__(self, max_descriptor_entries: int = 16):
+        self._hooks = None
+        self._extra_hooks = {}
+        # id(settings) -> (settings, {custom_http名称: (method, url, headers)})
+        self._descriptors: "OrderedDict[int, tuple]" = OrderedDict()
+        self.max_descriptor_entries = max_descriptor_entries
+        self.stats = {}
+
+    def register(self, name: str, handler):
+        """注册 server.py 中定义的工具处理函数"""
+        self._extra_hooks[name] = handler
+        if self._hooks is not None:
+            self._hooks[name] = handler
+
+    @property
+    def hooks(self) -> dict:
+        if self._hooks is None:
+            self._hooks = {**_builtin_hooks(), **self._extra_hooks}
+        return self._hooks
+
+    def custom_http_descriptors(self, settings: dict) -> dict:
+        key = id(settings)
+        entry = self._descriptors.get(key)
+        if entry is not None and entry[0] is settings:
+            self._descriptors.move_to_end(key)
+            return entry[1]
+        descriptors = {}
+        for custom in settings.get('custom_http') or []:
+            # 与原先的线性查找一致，同名时取第一个
+            descriptors.setdefault(custom['name'], (custom['method'], custom['url'], custom['headers']))
+        self._descriptors[key] = (settings, descriptors)
+        while len(self._descriptors) > self.max_descriptor_entries:
+            self._descriptors.popitem(last=False)
+        return descriptors
+
+    def _record(self, name: str, start: float, error: bool):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = ToolStats()
+        stats.record((time.perf_counter() - start) * 1000, error)
+
+    async def dispatch(self, tool_name: str, tool_params: dict, settings: dict, mcp_clients: dict):
+        if tool_name.startswith(self.MULTI_TOOL_PREFIX):
+            tool_name = tool_name[len(self.MULTI_TOOL_PREFIX):]
+        start = time.perf_counter()
+        if tool_name.startswith(self.CUSTOM_HTTP_PREFIX):
+            from py.custom_http import fetch_custom_http
+            descriptor = self.custom_http_descriptors(settings).get(tool_name[len(self.CUSTOM_HTTP_PREFIX):])
+            if descriptor is None:
+                return None
+            method, url, headers = descriptor
+            try:
+                result = await fetch_custom_http(method, url, headers, tool_params)
+            except Exception:
+                self._record(tool_name, start, True)
+                raise
+            self._record(tool_name, start, False)
+            return str(result)
+        if tool_name.startswith(self.COMFYUI_PREFIX):
+            comfyui_tool_call = self.hooks["comfyui_tool_call"]
+            try:
+                result = await comfyui_tool_call(
+                    tool_name[len(self.COMFYUI_PREFIX):],
+                    tool_params.get('text_input', None),
+                    tool_params.get('image_input', None),
+                    tool_params.get('text_input_2', None),
+                    tool_params.get('image_input_2', None),
+                )
+            except Exception:
+                self._record(tool_name, start, True)
+                raise
+            self._record(tool_name, start, False)
+            return str(result)
+        tool_call = self.hooks.get(tool_name)
+        if tool_call is None:
+            mcp_client = mcp_tool_index.lookup(mcp_clients, tool_name)
+            if mcp_client is None:
+                return None
+            try:
+                result = await mcp_client.call_tool(tool_name, tool_params)
+                ret_out = str(result.model_dump())
+            except Exception:
+                self._record(tool_name, start, True)
+                raise
+            self._record(tool_name, start, False)
+            return ret_out
+        try:
+            ret_out = await tool_call(**tool_params)
+        except Exception as e:
+            self._record(tool_name, start, True)
+            logger.error(f"Error calling tool {tool_name}: {e}")
+            return f"Error calling tool {tool_name}: {e}"
+        self._record(tool_name, start, False)
+        return ret_out
+
+    async def dispatch_many(self, calls, settings: dict, mcp_clients: dict,
+                            max_concurrency: int = 4, timeout: float = None, timeouts: dict = None) -> list:
+        """
+        并发执行同一轮的多个工具调用，calls 为 [(tool_name, tool_params)]，结果按 calls 的顺序返回。
+        同时执行的调用数不超过 max_concurrency；超时（timeouts 中按工具名配置，否则用 timeout，0 表示不限）的调用返回错误信息；
+        其他异常在所有调用结束后抛出第一个。
+        """
+        semaphore = asyncio.Semaphore(max(1, max_concurrency or 1))
+        timeouts = timeouts or {}
+
+        async def run(tool_name, tool_params):
+            limit = timeouts.get(tool_name, timeout) or None
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    return await asyncio.wait_for(self.dispatch(tool_name, tool_params, settings, mcp_clients), limit)
+                except asyncio.TimeoutError:
+                    self._record(tool_name, start, True)
+                    logger.error(f"Error calling tool {tool_name}: timed out after {limit}s")
+                    return f"Error calling tool {tool_name}: timed out after {limit}s"
+
+        results = await asyncio.gather(*(run(name, params) for name, params in calls), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def get_stats(self) -> dict:
+        return {
+            "buckets_ms": list(LATENCY_BUCKETS_MS),
+            "tools": {name: stats.to_dict() for name, stats in sorted(self.stats.items())},
+        }
+
+tool_registry = ToolRegistry()
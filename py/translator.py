@@ -0,0 +1,39 @@
+import json
+import os
+from py.get_setting import CONFIG_BASE_PATH, get_cached_settings, get_settings_version
+
+class Translator:
+    """
+    预加载的多语言表：当前语言保存在内存中，只有配置版本变化时才重新读取语言设置，
+    翻译是同步的纯内存查表，流式输出状态信息时无需 I/O 或 await。
+    """
+    def __init__(self, default_language: str = "zh-CN"):
+        self.locales = {}
+        self.language = default_language
+        self._table = {}
+        self._version = None
+
+    def load(self, path: str = os.path.join(CONFIG_BASE_PATH, "locales.json")):
+        with open(path, "r", encoding="utf-8") as f:
+            self.locales = json.load(f)
+        self._table = self.locales.get(self.language, {})
+        self._version = None
+
+    def _refresh(self):
+        version = get_settings_version()
+        if version == self._version:
+            return
+        settings = get_cached_settings()
+        if settings is None:
+            return
+        self._version = version
+        language = settings.get("systemSettings", {}).get("language", self.language)
+        if language != self.language or not self._table:
+            self.language = language
+            self._table = self.locales.get(language, {})
+
+    def __call__(self, text: str) -> str:
+        self._refresh()
+        return self._table.get(text, text)
+
+translator = Translator()
@@ -7,18 +7,16 @@ import sys
 import tempfile
 import wave
 import httpx
-from scipy.io import wavfile
-import numpy as np
-import websockets
 # 在程序最开始设置
 if hasattr(sys, '_MEIPASS'):
     # 打包后的程序
     os.environ['PYTHONPATH'] = sys._MEIPASS
     os.environ['PATH'] = sys._MEIPASS + os.pathsep + os.environ.get('PATH', '')
-import edge_tts
 import asyncio
+import contextvars
 import copy
 from functools import partial
+from itertools import zip_longest
 import json
 import random
 import re
@@ -30,42 +28,57 @@ from fastapi_mcp import FastApiMCP
 import logging
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from openai import AsyncOpenAI
 from pydantic import BaseModel
 from fastapi import status
 from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 import uuid
 import time
 from typing import Any, List, Dict,Optional
 import shortuuid
-from py.mcp_clients import McpClient
+from py.mcp_clients import McpClient,RemoteMcpClient,mcp_tool_index
+from py.shared_state import shared_store,WORKERS_ENV
+from py.settings_broadcaster import SettingsBroadcaster
+from py.translator import translator
+from py.tool_catalog import tool_catalog
+from py.tool_registry import tool_registry
+from py.agent_tool import set_agent_runner
+from py.sse_passthrough import stream_chat_chunks,passthrough_delta,to_chunk
+from py.think_parser import ThinkTagParser
+from py.preprocess import PreprocessPipeline,preprocess_stats
+from py.message_overlay import MessageOverlay
+from py.context_budget import compact_messages,fit_kb_chunks,context_stats
+from py.client_pool import client_pool
+from py.response_cache import response_cache,make_key
+from py.scheduler import request_scheduler,SchedulerRejected,PRIORITY_HEADER,INTERNAL_HEADER,is_internal_call
+from py.context_budget import message_tokens
 from contextlib import asynccontextmanager,suppress
 import requests
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
 import argparse
-from mem0 import Memory
-from py.qq_bot_manager import QQBotManager
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 parser = argparse.ArgumentParser(description="Run the ASGI application server.")
 parser.add_argument("--host", default="127.0.0.1", help="Host for the ASGI server, default is 127.0.0.1")
 parser.add_argument("--port", type=int, default=3456, help="Port for the ASGI server, default is 3456")
+parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, default is 1")
 args = parser.parse_args()
 HOST = args.host
 PORT = args.port
+if args.workers > 1:
+    # uvicorn 启动的子进程通过环境变量进入共享状态模式
+    os.environ[WORKERS_ENV] = str(args.workers)
 
 os.environ["no_proxy"] = "localhost,127.0.0.1"
 local_timezone = None
 settings = None
+settings_version = -1
 client = None
 reasoner_client = None
 mcp_client_list = {}
-locales = {}
-_TOOL_HOOKS = {}
-cur_random = []
 ALLOWED_EXTENSIONS = [
   # 办公文档
   'doc', 'docx', 'ppt', 'pptx', 'xls', 'xlsx', 'pdf', 'pages', 
@@ -84,33 +97,19 @@ ALLOWED_IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp']
 
 ALLOWED_VIDEO_EXTENSIONS = ['mp4', 'avi', 'mov', 'wmv', 'flv', 'mkv', 'webm', '3gp', 'm4v']
 
-from py.get_setting import load_settings,save_settings,base_path,configure_host_port,UPLOAD_FILES_DIR,AGENT_DIR,MEMORY_CACHE_DIR,KB_DIR,DEFAULT_VRM_DIR
-from py.llm_tool import get_image_base64,get_image_media_type
+from py.get_setting import load_settings,save_settings,patch_settings,get_settings_version,add_settings_listener,invalidate_settings_cache,base_path,configure_host_port,UPLOAD_FILES_DIR,AGENT_DIR,MEMORY_CACHE_DIR,KB_DIR,DEFAULT_VRM_DIR
 
 
 configure_host_port(args.host, args.port)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI): 
-    from py.get_setting import init_db
-    await init_db()
-    global settings, client, reasoner_client, mcp_client_list,local_timezone,logger,locales
-    with open(base_path + "/config/locales.json", "r", encoding="utf-8") as f:
-        locales = json.load(f)
-    from tzlocal import get_localzone
-    local_timezone = get_localzone()
-    settings = await load_settings()
-    if settings:
-        client = AsyncOpenAI(api_key=settings['api_key'], base_url=settings['base_url'])
-        reasoner_client = AsyncOpenAI(api_key=settings['reasoner']['api_key'],base_url=settings['reasoner']['base_url'])
-    else:
-        client = AsyncOpenAI()
-        reasoner_client = AsyncOpenAI()
+async def init_mcp_clients(cur_settings):
+    """主 worker 建立全部 MCP 连接，初始化失败的服务器标记为禁用后统一保存"""
     mcp_init_tasks = []
     async def init_mcp_with_timeout(server_name, server_config):
         """带超时处理的异步初始化函数"""
         try:
             mcp_client = McpClient()
+            mcp_client.on_tools_changed = partial(shared_store.publish_nowait, "mcp.tools_changed", server_name)
             if not server_config['disabled']:
                 await asyncio.wait_for(
                     mcp_client.initialize(server_name, server_config),
@@ -123,45 +122,126 @@ async def lifespan(app: FastAPI):
         except Exception as e:
             logger.error(f"MCP client {server_name} initialization failed: {str(e)}")
             return server_name, None, "error"
+    # 创建所有初始化任务
+    for server_name, server_config in cur_settings['mcpServers'].items():
+        task = asyncio.create_task(init_mcp_with_timeout(server_name, server_config))
+        mcp_init_tasks.append(task)
+    # 立即继续执行不等待
+    # 通过回调处理结果
+    async def check_results():
+        """后台收集任务结果"""
+        for task in asyncio.as_completed(mcp_init_tasks):
+            server_name, mcp_client, error = await task
+            if error:
+                cur_settings['mcpServers'][server_name]['disabled'] = True
+                cur_settings['mcpServers'][server_name]['processingStatus'] = 'server_error'
+                mcp_client_list[server_name] = McpClient()
+                mcp_client_list[server_name].disabled = True
+            else:
+                mcp_client_list[server_name] = mcp_client
+        await save_settings(cur_settings)  # 所有任务完成后统一保存
+        await broadcast_settings_update(await load_settings())  # 所有任务完成后统一广播
+    # 在后台运行结果收集
+    asyncio.create_task(check_results())
+
+async def sync_remote_mcp_clients(cur_settings):
+    """非主 worker：MCP 连接由主 worker 持有，这里只保留与配置一致的代理对象"""
+    for server_name in list(mcp_client_list):
+        if server_name not in cur_settings['mcpServers']:
+            await mcp_client_list.pop(server_name).close()
+    for server_name, server_config in cur_settings['mcpServers'].items():
+        if server_name not in mcp_client_list:
+            mcp_client_list[server_name] = RemoteMcpClient(server_name, shared_store.get_owner_url)
+        mcp_client_list[server_name].disabled = server_config.get('disabled', False)
+
+async def become_owner(cur_settings):
+    """成为主 worker：持有 MCP 连接，多进程模式下再开放内部端口接收其他 worker 的转发"""
+    # 之前作为非主 worker 时持有的代理对象，关闭其 HTTP 连接
+    for mcp_client in mcp_client_list.values():
+        if isinstance(mcp_client, RemoteMcpClient):
+            await mcp_client.close()
+        else:
+            mcp_tool_index.remove(mcp_client)
+    mcp_client_list.clear()
+    if cur_settings:
+        await init_mcp_clients(cur_settings)
+    if shared_store.multi_worker:
+        await shared_store.serve_owner(app)
+        logger.info(f"Worker {os.getpid()} is the owner worker")
+
+async def claim_ownership():
+    """主 worker 退出后文件锁被释放，由其他 worker 接管"""
+    while not shared_store.try_acquire_owner():
+        await asyncio.sleep(2)
+    await become_owner(copy.deepcopy(await load_settings()))
+
+async def on_remote_mcp_tools_change(server_name):
+    """主 worker 上某个 MCP 服务器的工具列表变化：让本进程的工具目录缓存失效"""
+    if server_name in mcp_client_list:
+        mcp_client_list[server_name].tools_generation += 1
+
+async def on_remote_settings_change(_):
+    """其他 worker 保存了配置：丢弃本进程缓存并推送给本进程的客户端"""
+    invalidate_settings_cache()
+    await broadcast_settings_update(await load_settings())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI): 
+    from py.get_setting import settings_db
+    await settings_db.open()
+    await shared_store.open()
+    global settings, settings_version, client, reasoner_client, mcp_client_list,local_timezone,logger
+    translator.load(base_path + "/config/locales.json")
+    from tzlocal import get_localzone
+    local_timezone = get_localzone()
+    # 启动时会修改MCP状态后保存，因此使用独立副本
+    settings = copy.deepcopy(await load_settings())
+    settings_version = get_settings_version()
     if settings:
-        # 创建所有初始化任务
-        for server_name, server_config in settings['mcpServers'].items():
-            task = asyncio.create_task(init_mcp_with_timeout(server_name, server_config))
-            mcp_init_tasks.append(task)
-        # 立即继续执行不等待
-        # 通过回调处理结果
-        async def check_results():
-            """后台收集任务结果"""
-            for task in asyncio.as_completed(mcp_init_tasks):
-                server_name, mcp_client, error = await task
-                if error:
-                    settings['mcpServers'][server_name]['disabled'] = True
-                    settings['mcpServers'][server_name]['processingStatus'] = 'server_error'
-                    mcp_client_list[server_name] = McpClient()
-                    mcp_client_list[server_name].disabled = True
-                else:
-                    mcp_client_list[server_name] = mcp_client
-            await save_settings(settings)  # 所有任务完成后统一保存
-            await broadcast_settings_update(settings)  # 所有任务完成后统一广播
-        # 在后台运行结果收集
-        asyncio.create_task(check_results())
+        client_pool.configure(settings.get('clientPool'))
+        response_cache.configure(settings.get('responseCache'))
+        request_scheduler.configure(settings.get('scheduler'))
+        client = client_pool.get_client(settings['api_key'], settings['base_url'])
+        reasoner_client = client_pool.get_client(settings['reasoner']['api_key'], settings['reasoner']['base_url'])
+    else:
+        client = client_pool.get_client()
+        reasoner_client = client_pool.get_client()
+    ownership_task = None
+    if shared_store.multi_worker:
+        add_settings_listener(lambda: shared_store.publish_nowait("settings"))
+        shared_store.subscribe("settings", on_remote_settings_change)
+        shared_store.subscribe("mcp.tools_changed", on_remote_mcp_tools_change)
+        shared_store.subscribe("tts.vrm", lambda message: tts_manager.broadcast_to_vrm(message, relay=False))
+        shared_store.subscribe("tts.main", lambda message: tts_manager.send_to_main(message, relay=False))
+    if shared_store.try_acquire_owner():
+        await become_owner(settings)
+    else:
+        if settings:
+            await sync_remote_mcp_clients(settings)
+        ownership_task = asyncio.create_task(claim_ownership())
     yield
+    if ownership_task:
+        ownership_task.cancel()
+    await shared_store.close()
+    await settings_db.close()
+    await client_pool.aclose()
+    await response_cache.close()
 # WebSocket端点增加连接管理
-active_connections = []
+settings_broadcaster = SettingsBroadcaster()
 # 新增广播函数
 async def broadcast_settings_update(settings):
-    """向所有WebSocket连接推送配置更新"""
-    for connection in active_connections:  # 需要维护全局连接列表
-        try:
-            await connection.send_json({
-                "type": "settings",
-                "data": settings  # 直接使用内存中的最新配置
-            })
-        except Exception as e:
-            logger.error(f"Broadcast failed: {e}")
+    """向所有WebSocket连接并发推送配置更新，已确认版本的客户端只收到变化的分区"""
+    await settings_broadcaster.broadcast(settings, get_settings_version())
 
 app = FastAPI(lifespan=lifespan)
 
+@app.middleware("http")
+async def owner_worker_middleware(request: Request, call_next):
+    """多进程模式下，MCP 管理和 QQ 机器人请求转发给主 worker"""
+    if shared_store.is_owner_path(request.url.path):
+        return await shared_store.forward_to_owner(request)
+    return await call_next(request)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -170,16 +250,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-async def t(text: str) -> str:
-    global locales
-    settings = await load_settings()
-    target_language = settings["systemSettings"]["language"]
-    return locales[target_language].get(text, text)
+def t(text: str) -> str:
+    """同步翻译，语言只在配置变化后才重新读取"""
+    return translator(text)
 
 
-# 全局存储异步工具状态
-async_tools = {}
-async_tools_lock = asyncio.Lock()
+# 异步工具状态保存在共享存储的 async_tools 命名空间中，多进程时各 worker 都能取到结果
 
 async def execute_async_tool(tool_id: str, tool_name: str, args: dict, settings: dict,user_prompt: str):
     try:
@@ -189,24 +265,23 @@ async def execute_async_tool(tool_id: str, tool_name: str, args: dict, settings:
             if settings["KBSettings"]["is_rerank"]:
                 results = await rerank_knowledge_base(user_prompt,results)
             results = json.dumps(results, ensure_ascii=False, indent=4)
-        async with async_tools_lock:
-            async_tools[tool_id] = {
-                "status": "completed",
-                "result": results,
-                "name": tool_name,
-                "parameters": args,
-            }
+        await shared_store.set("async_tools", tool_id, {
+            "status": "completed",
+            "result": results,
+            "name": tool_name,
+            "parameters": args,
+        })
     except Exception as e:
-        async with async_tools_lock:
-            async_tools[tool_id] = {
-                "status": "error",
-                "result": str(e),
-                "name": tool_name,
-                "parameters": args,
-            }
+        await shared_store.set("async_tools", tool_id, {
+            "status": "error",
+            "result": str(e),
+            "name": tool_name,
+            "parameters": args,
+        })
 
 async def get_image_content(image_url: str) -> str:
     import hashlib
+    from py.llm_tool import get_image_base64,get_image_media_type
     settings = await load_settings()
     base64_image = await get_image_base64(image_url)
     media_type = await get_image_media_type(image_url)
@@ -220,7 +295,7 @@ async def get_image_content(image_url: str) -> str:
                 content += f"\n\n图片(URL:{image_url} 哈希值：{image_hash})信息如下：\n\n"+str(f.read())+"\n\n"
         else:
             images_content = [{"type": "text", "text": "请仔细描述图片中的内容，包含图片中可能存在的文字、数字、颜色、形状、大小、位置、人物、物体、场景等信息。"},{"type": "image_url", "image_url": {"url": url}}]
-            client = AsyncOpenAI(api_key=settings['vision']['api_key'],base_url=settings['vision']['base_url'])
+            client = client_pool.get_client(settings['vision']['api_key'], settings['vision']['base_url'])
             response = await client.chat.completions.create(
                 model=settings['vision']['model'],
                 messages = [{"role": "user", "content": images_content}],
@@ -236,7 +311,7 @@ async def get_image_content(image_url: str) -> str:
                 content += f"\n\nn图片(URL:{image_url} 哈希值：{image_hash})信息如下：\n\n"+str(f.read())+"\n\n"
         else:
             images_content = [{"type": "text", "text": "请仔细描述图片中的内容，包含图片中可能存在的文字、数字、颜色、形状、大小、位置、人物、物体、场景等信息。"},{"type": "image_url", "image_url": {"url": url}}]
-            client = AsyncOpenAI(api_key=settings['api_key'],base_url=settings['base_url'])
+            client = client_pool.get_client(settings['api_key'], settings['base_url'])
             response = await client.chat.completions.create(
                 model=settings['model'],
                 messages = [{"role": "user", "content": images_content}],
@@ -248,91 +323,9 @@ async def get_image_content(image_url: str) -> str:
     return content
 
 async def dispatch_tool(tool_name: str, tool_params: dict,settings: dict) -> str | List | None:
-    global mcp_client_list,_TOOL_HOOKS
-    from py.web_search import (
-        DDGsearch_async, 
-        searxng_async, 
-        Tavily_search_async,
-        Bing_search_async,
-        Google_search_async,
-        Brave_search_async,
-        Exa_search_async,
-        Serper_search_async,
-        bochaai_search_async,
-        jina_crawler_async,
-        Crawl4Ai_search_async, 
-    )
-    from py.know_base import query_knowledge_base
-    from py.agent_tool import agent_tool_call
-    from py.a2a_tool import a2a_tool_call
-    from py.llm_tool import custom_llm_tool
-    from py.pollinations import pollinations_image,openai_image,siliconflow_image
-    from py.load_files import get_file_content
-    from py.code_interpreter import e2b_code_async,local_run_code_async
-    from py.custom_http import fetch_custom_http
-    from py.comfyui_tool import comfyui_tool_call
-    _TOOL_HOOKS = {
-        "DDGsearch_async": DDGsearch_async,
-        "searxng_async": searxng_async,
-        "Tavily_search_async": Tavily_search_async,
-        "query_knowledge_base": query_knowledge_base,
-        "jina_crawler_async": jina_crawler_async,
-        "Crawl4Ai_search_async": Crawl4Ai_search_async,
-        "agent_tool_call": agent_tool_call,
-        "a2a_tool_call": a2a_tool_call,
-        "custom_llm_tool": custom_llm_tool,
-        "pollinations_image":pollinations_image,
-        "get_file_content":get_file_content,
-        "get_image_content": get_image_content,
-        "e2b_code_async": e2b_code_async,
-        "local_run_code_async": local_run_code_async,
-        "openai_image": openai_image,
-        "siliconflow_image": siliconflow_image,
-        "Bing_search_async": Bing_search_async,
-        "Google_search_async": Google_search_async,
-        "Brave_search_async": Brave_search_async,
-        "Exa_search_async": Exa_search_async,
-        "Serper_search_async": Serper_search_async,
-        "bochaai_search_async": bochaai_search_async,
-        "comfyui_tool_call": comfyui_tool_call,
-    }
-    if "multi_tool_use." in tool_name:
-        tool_name = tool_name.replace("multi_tool_use.", "")
-    if "custom_http_" in tool_name:
-        tool_name = tool_name.replace("custom_http_", "")
-        print(tool_name)
-        settings_custom_http = settings['custom_http']
-        for custom in settings_custom_http:
-            if custom['name'] == tool_name:
-                tool_custom_http = custom
-                break
-        method = tool_custom_http['method']
-        url = tool_custom_http['url']
-        headers = tool_custom_http['headers']
-        result = await fetch_custom_http(method, url, headers, tool_params)
-        return str(result)
-    if "comfyui_" in tool_name:
-        tool_name = tool_name.replace("comfyui_", "")
-        text_input = tool_params.get('text_input', None)
-        text_input_2 = tool_params.get('text_input_2', None)
-        image_input = tool_params.get('image_input', None)
-        image_input_2 = tool_params.get('image_input_2', None)
-        print(tool_name)
-        result = await comfyui_tool_call(tool_name, text_input, image_input,text_input_2,image_input_2)
-        return str(result)
-    if tool_name not in _TOOL_HOOKS:
-        for server_name, mcp_client in mcp_client_list.items():
-            if tool_name in mcp_client._conn.tools:
-                result = await mcp_client.call_tool(tool_name, tool_params)
-                return str(result.model_dump())
-        return None
-    tool_call = _TOOL_HOOKS[tool_name]
-    try:
-        ret_out = await tool_call(**tool_params)
-        return ret_out
-    except Exception as e:
-        logger.error(f"Error calling tool {tool_name}: {e}")
-        return f"Error calling tool {tool_name}: {e}"
+    return await tool_registry.dispatch(tool_name, tool_params, settings, mcp_client_list)
+
+tool_registry.register("get_image_content", get_image_content)
 
 
 class ChatRequest(BaseModel):
@@ -350,6 +343,7 @@ class ChatRequest(BaseModel):
     enable_deep_research: bool = False
     enable_web_search: bool = False
     asyncToolsID: List[str] = None
+    cache: bool = None  # True：temperature 不为 0 时也使用响应缓存；False：不使用
 
 async def message_without_images(messages: List[Dict]) -> List[Dict]:
     if messages:
@@ -365,6 +359,7 @@ async def message_without_images(messages: List[Dict]) -> List[Dict]:
 
 async def images_in_messages(messages: List[Dict],fastapi_base_url: str) -> List[Dict]:
     import hashlib
+    from py.llm_tool import get_image_base64,get_image_media_type
     images = []
     index = 0
     for message in messages:
@@ -394,7 +389,8 @@ async def images_in_messages(messages: List[Dict],fastapi_base_url: str) -> List
     return images
 
 async def images_add_in_messages(request_messages: List[Dict], images: List[Dict], settings: dict) -> List[Dict]:
-    messages=copy.deepcopy(request_messages)
+    # 只复制需要加入图片内容的消息，其余消息与 request_messages 共享
+    messages = MessageOverlay(request_messages)
     if settings['vision']['enabled']:
         for image in images:
             index = image['index']
@@ -404,16 +400,16 @@ async def images_add_in_messages(request_messages: List[Dict], images: List[Dict
                         # 如果uploaded_files/{item['image_url']['hash']}.txt存在，则读取文件内容，否则调用vision api
                         if os.path.exists(os.path.join(UPLOAD_FILES_DIR, f"{item['image_url']['hash']}.txt")):
                             with open(os.path.join(UPLOAD_FILES_DIR, f"{item['image_url']['hash']}.txt"), "r", encoding='utf-8') as f:
-                                messages[index]['content'] += f"\n\nsystem: 用户发送的图片(哈希值：{item['image_url']['hash']})信息如下：\n\n"+str(f.read())+"\n\n"
+                                messages.edit(index)['content'] += f"\n\nsystem: 用户发送的图片(哈希值：{item['image_url']['hash']})信息如下：\n\n"+str(f.read())+"\n\n"
                         else:
                             images_content = [{"type": "text", "text": "请仔细描述图片中的内容，包含图片中可能存在的文字、数字、颜色、形状、大小、位置、人物、物体、场景等信息。"},{"type": "image_url", "image_url": {"url": item['image_url']['url']}}]
-                            client = AsyncOpenAI(api_key=settings['vision']['api_key'],base_url=settings['vision']['base_url'])
+                            client = client_pool.get_client(settings['vision']['api_key'], settings['vision']['base_url'])
                             response = await client.chat.completions.create(
                                 model=settings['vision']['model'],
                                 messages = [{"role": "user", "content": images_content}],
                                 temperature=settings['vision']['temperature'],
                             )
-                            messages[index]['content'] += f"\n\nsystem: 用户发送的图片(哈希值：{item['image_url']['hash']})信息如下：\n\n"+str(response.choices[0].message.content)+"\n\n"
+                            messages.edit(index)['content'] += f"\n\nsystem: 用户发送的图片(哈希值：{item['image_url']['hash']})信息如下：\n\n"+str(response.choices[0].message.content)+"\n\n"
                             with open(os.path.join(UPLOAD_FILES_DIR, f"{item['image_url']['hash']}.txt"), "w", encoding='utf-8') as f:
                                 f.write(str(response.choices[0].message.content))
     else:           
@@ -425,10 +421,14 @@ async def images_add_in_messages(request_messages: List[Dict], images: List[Dict
                         # 如果uploaded_files/{item['image_url']['hash']}.txt存在，则读取文件内容，否则调用vision api
                         if os.path.exists(os.path.join(UPLOAD_FILES_DIR, f"{item['image_url']['hash']}.txt")):
                             with open(os.path.join(UPLOAD_FILES_DIR, f"{item['image_url']['hash']}.txt"), "r", encoding='utf-8') as f:
-                                messages[index]['content'] += f"\n\nsystem: 用户发送的图片(哈希值：{item['image_url']['hash']})信息如下：\n\n"+str(f.read())+"\n\n"
+                                messages.edit(index)['content'] += f"\n\nsystem: 用户发送的图片(哈希值：{item['image_url']['hash']})信息如下：\n\n"+str(f.read())+"\n\n"
                         else:
-                            messages[index]['content'] = [{"type": "text", "text": messages[index]['content']}]
-                            messages[index]['content'].append({"type": "image_url", "image_url": {"url": item['image_url']['url']}})
+                            message = messages.edit(index)
+                            if not isinstance(message['content'], list):
+                                message['content'] = [{"type": "text", "text": message['content']}]
+                            else:
+                                message['content'] = list(message['content'])
+                            message['content'].append({"type": "image_url", "image_url": {"url": item['image_url']['url']}})
     return messages
 
 async def tools_change_messages(request: ChatRequest, settings: dict):
@@ -467,6 +467,81 @@ async def tools_change_messages(request: ChatRequest, settings: dict):
             request.messages.insert(0, {'role': 'system', 'content': Expression_messages})
     return request
 
+def start_preprocess(request: ChatRequest, settings: dict, fastapi_base_url, user_prompt, image_messages,
+                     memory_config=None, memoryId=None, kb_list=(), enable_web_search=False):
+    """
+    请求预处理：图片下载编码、工具列表、文件内容、长期记忆检索、知识库查询和联网搜索互不依赖，按依赖图并发执行；
+    调用方按原来的顺序取结果写入提示词，首个token前的等待取决于最慢的一步而不是所有步骤之和。
+    """
+    from py.load_files import get_files_content
+    from py.know_base import query_knowledge_base,rerank_knowledge_base
+    preprocess = PreprocessPipeline()
+    preprocess.add("images", partial(images_in_messages, image_messages, fastapi_base_url))
+    preprocess.add("tools", partial(tool_catalog.get_tools, settings, mcp_client_list))
+    if request.fileLinks:
+        preprocess.add("files", partial(get_files_content, request.fileLinks))
+    if memory_config:
+        async def load_memory():
+            from mem0 import Memory
+            return await asyncio.get_running_loop().run_in_executor(None, Memory.from_config, memory_config)
+
+        async def search_memory(m0):
+            memoryLimit = settings["memorySettings"]["memoryLimit"]
+            try:
+                relevant_memories = await asyncio.get_running_loop().run_in_executor(
+                    None, partial(m0.search, query=user_prompt, user_id=memoryId, limit=memoryLimit)
+                )
+                return json.dumps(relevant_memories, ensure_ascii=False)
+            except Exception as e:
+                print("m0.search error:",e)
+                return ""
+        preprocess.add("memory", load_memory)
+        preprocess.add("memory_search", search_memory, "memory")
+    if kb_list and (settings["KBSettings"]["when"] == "before_thinking" or settings["KBSettings"]["when"] == "both"):
+        async def search_knowledge_bases():
+            kb_results = await asyncio.gather(*(query_knowledge_base(kb["kb_id"], user_prompt) for kb in kb_list))
+            # 按排名交替合并各知识库的结果（与查询完成的先后无关），超出预算时先丢弃排名靠后的片段
+            kb_results = [kb_content for kb_content in kb_results if isinstance(kb_content, list)]
+            all_kb_content = [item for items in zip_longest(*kb_results) for item in items if item is not None]
+            if all_kb_content and settings["KBSettings"]["is_rerank"]:
+                all_kb_content = await rerank_knowledge_base(user_prompt,all_kb_content)
+            return fit_kb_chunks(all_kb_content, settings)
+        preprocess.add("knowledge_base", search_knowledge_bases)
+    if (settings['webSearch']['enabled'] or enable_web_search) and (settings['webSearch']['when'] == 'before_thinking' or settings['webSearch']['when'] == 'both'):
+        from py.web_search import (
+            DDGsearch_async,
+            searxng_async,
+            Tavily_search_async,
+            Bing_search_async,
+            Google_search_async,
+            Brave_search_async,
+            Exa_search_async,
+            Serper_search_async,
+            bochaai_search_async,
+        )
+        search = {
+            "duckduckgo": DDGsearch_async,
+            "searxng": searxng_async,
+            "tavily": Tavily_search_async,
+            "bing": Bing_search_async,
+            "google": Google_search_async,
+            "brave": Brave_search_async,
+            "exa": Exa_search_async,
+            "serper": Serper_search_async,
+            "bochaai": bochaai_search_async,
+        }.get(settings['webSearch']['engine'])
+        if search:
+            preprocess.add("web_search", partial(search, user_prompt))
+    return preprocess.start()
+
+def get_kb_list(settings: dict) -> list:
+    kb_list = []
+    if settings["knowledgeBases"]:
+        for kb in settings["knowledgeBases"]:
+            if kb["enabled"] and kb["processingStatus"] == "completed":
+                kb_list.append({"kb_id":kb["id"],"name": kb["name"],"introduction":kb["introduction"]})
+    return kb_list
+
 def get_drs_stage(DRS_STAGE):
     if DRS_STAGE == 1:
         drs_msg = "当前阶段为明确用户需求阶段，你需要分析用户的需求，并给出明确的需求描述。如果用户的需求描述不明确，你可以暂时不完成任务，而是分析需要让用户进一步明确哪些需求。"
@@ -585,19 +660,10 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
     DRS_STAGE = 1 # 1: 明确用户需求阶段 2: 查询搜索阶段 3: 生成结果阶段
     if len(request.messages) > 2:
         DRS_STAGE = 2
-    images = await images_in_messages(request.messages,fastapi_base_url)
+    # 图片步骤读取原始的内容列表，message_without_images 会把它替换成文本
+    image_messages = [dict(message) for message in request.messages]
     request.messages = await message_without_images(request.messages)
-    from py.load_files import get_files_content,file_tool,image_tool
     from py.web_search import (
-        DDGsearch_async, 
-        searxng_async, 
-        Tavily_search_async,
-        Bing_search_async,
-        Google_search_async,
-        Brave_search_async,
-        Exa_search_async,
-        Serper_search_async,
-        bochaai_search_async,
         duckduckgo_tool, 
         searxng_tool, 
         tavily_tool, 
@@ -610,13 +676,9 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
         jina_crawler_tool, 
         Crawl4Ai_tool
     )
-    from py.know_base import kb_tool,query_knowledge_base,rerank_knowledge_base
-    from py.agent_tool import get_agent_tool
-    from py.a2a_tool import get_a2a_tool
-    from py.llm_tool import get_llm_tool
-    from py.pollinations import pollinations_image_tool,openai_image_tool,siliconflow_image_tool
-    from py.code_interpreter import e2b_code_tool,local_run_code_tool
+    from py.know_base import kb_tool,rerank_knowledge_base
     m0 = None
+    memory_config = None
     memoryId = None
     if settings["memorySettings"]["is_memory"]:
         memoryId = settings["memorySettings"]["selectedMemory"]
@@ -655,108 +717,21 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                     }
                 }
             }
-            m0 = Memory.from_config(config)
+            memory_config = config
     open_tag = "<think>"
     close_tag = "</think>"
+    preprocess = None
     try:
-        tools = request.tools or []
-        if mcp_client_list:
-            for server_name, mcp_client in mcp_client_list.items():
-                if server_name in settings['mcpServers']:
-                    if 'disabled' not in settings['mcpServers'][server_name]:
-                        settings['mcpServers'][server_name]['disabled'] = False
-                    if settings['mcpServers'][server_name]['disabled'] == False and settings['mcpServers'][server_name]['processingStatus'] == 'ready':
-                        function = await mcp_client.get_openai_functions()
-                        if function:
-                            tools.extend(function)
-        get_llm_tool_fuction = await get_llm_tool(settings)
-        if get_llm_tool_fuction:
-            tools.append(get_llm_tool_fuction)
-        get_agent_tool_fuction = await get_agent_tool(settings)
-        if get_agent_tool_fuction:
-            tools.append(get_agent_tool_fuction)
-        get_a2a_tool_fuction = await get_a2a_tool(settings)
-        if get_a2a_tool_fuction:
-            tools.append(get_a2a_tool_fuction)
-        if settings['text2imgSettings']['enabled']:
-            if settings['text2imgSettings']['engine'] == 'pollinations':
-                tools.append(pollinations_image_tool)
-            elif settings['text2imgSettings']['engine'] == 'openai':
-                if settings['text2imgSettings']['vendor'] == 'siliconflow':
-                    tools.append(siliconflow_image_tool)
-                else:
-                    tools.append(openai_image_tool)
-        if settings['tools']['getFile']['enabled']:
-            tools.append(file_tool)
-            tools.append(image_tool)
-        if settings["codeSettings"]['enabled']:
-            if settings["codeSettings"]["engine"] == "e2b":
-                tools.append(e2b_code_tool)
-            elif settings["codeSettings"]["engine"] == "sandbox":
-                tools.append(local_run_code_tool)
-        if settings["custom_http"]:
-            for custom_http in settings["custom_http"]:
-                if custom_http["enabled"]:
-                    if custom_http['body'] == "":
-                        custom_http['body'] = "{}"
-                    custom_http_tool = {
-                        "type": "function",
-                        "function": {
-                            "name": f"custom_http_{custom_http['name']}",
-                            "description": f"{custom_http['description']}",
-                            "parameters": json.loads(custom_http['body']),
-                        },
-                    }
-                    tools.append(custom_http_tool)
-        if settings["workflows"]:
-            for workflow in settings["workflows"]:
-                if workflow["enabled"]:
-                    comfyui_properties = {}
-                    comfyui_required = []
-                    if workflow["text_input"] is not None:
-                        comfyui_properties["text_input"] = {
-                            "description": "第一个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
-                            "type": "string"
-                        }
-                        comfyui_required.append("text_input")
-                    if workflow["text_input_2"] is not None:
-                        comfyui_properties["text_input_2"] = {
-                            "description": "第二个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
-                            "type": "string"
-                        }
-                        comfyui_required.append("text_input_2")
-                    if workflow["image_input"] is not None:
-                        comfyui_properties["image_input"] = {
-                            "description": "第一个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
-                            "type": "string"
-                        }
-                        comfyui_required.append("image_input")
-                    if workflow["image_input_2"] is not None:
-                        comfyui_properties["image_input_2"] = {
-                            "description": "第二个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
-                            "type": "string"
-                        }
-                        comfyui_required.append("image_input_2")
-                    comfyui_parameters = {
-                        "type": "object",
-                        "properties": comfyui_properties,
-                        "required": comfyui_required
-                    }
-                    comfyui_tool = {
-                        "type": "function",
-                        "function": {
-                            "name": f"comfyui_{workflow['unique_filename']}",
-                            "description": f"{workflow['description']}+\n如果要输入图片提示词或者修改提示词，尽可能使用英语。\n返回的图片结果，请将图片的URL放入![image]()这样的markdown语法中，用户才能看到图片。如果是视频，请将视频的URL放入<video controls> <source src=''></video>的中src中，用户才能看到视频。如果有多个结果，则请用换行符分隔开这几个图片或者视频，用户才能看到多个结果。",
-                            "parameters": comfyui_parameters,
-                        },
-                    }
-                    tools.append(comfyui_tool)
-        print(tools)
+        user_prompt = request.messages[-1]['content']
+        # 图片、工具、文件、记忆、知识库和联网搜索同时开始，下面按原来的顺序取结果
+        preprocess = start_preprocess(request, settings, fastapi_base_url, user_prompt, image_messages,
+                                      memory_config, memoryId, get_kb_list(settings), enable_web_search)
+        # 配置相关的工具由工具目录按配置版本缓存，这里复制一份再追加请求自带的工具
+        tools = [*(request.tools or []), *await preprocess.result("tools")]
         source_prompt = ""
         if request.fileLinks:
             print("fileLinks",request.fileLinks)
-            # 异步获取文件内容
-            files_content = await get_files_content(request.fileLinks)
+            files_content = await preprocess.result("files")
             fileLinks_message = f"\n\n相关文件内容：{files_content}"
             
             # 修复字符串拼接错误
@@ -765,7 +740,6 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
             else:
                 request.messages.insert(0, {'role': 'system', 'content': fileLinks_message})
             source_prompt += fileLinks_message
-        user_prompt = request.messages[-1]['content']
         if settings["memorySettings"]["is_memory"]:
             lore_content = ""
             assistant_reply = ""
@@ -778,7 +752,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                 for lore in cur_memory["lorebook"]:
                     if lore["name"] != "" and (lore["name"] in user_prompt or lore["name"] in assistant_reply):
                         lore_content = lore_content + "\n\n" + f"{lore['name']}：{lore['value']}"
-            global cur_random 
+            # 每个记忆当前的随机设定保存在共享存储中，多进程时后续对话同样能沿用
             # 如果request.messages中不包含assistant回复，说明是首次提问，触发随机设定
             if not assistant_reply:
                 # 如果 cur_memory 中有 random 条目
@@ -787,14 +761,13 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                     random_entry = random.choice(cur_memory["random"])
                     if random_entry.get("value"):
                         lore_content = lore_content + "\n\n" + f"{random_entry['value']}"
-                        cur_random.append({"id":memoryId,"value":random_entry["value"]})
+                        await shared_store.set("cur_random", memoryId, random_entry["value"])
                         print("新随机设定：",{"id":memoryId,"value":random_entry["value"]})
             else:
-                for item in cur_random:
-                    if item["id"] == memoryId:
-                        lore_content = lore_content + "\n\n" + f"{item['value']}"
-                        print("沿用随机设定：",{"id":memoryId,"value":item['value']})  
-                        break 
+                random_value = await shared_store.get("cur_random", memoryId)
+                if random_value is not None:
+                    lore_content = lore_content + "\n\n" + f"{random_value}"
+                    print("沿用随机设定：",{"id":memoryId,"value":random_value})
             if cur_memory["basic_character"]:
                 print("添加角色设定：\n\n" + cur_memory["basic_character"] + "\n\n角色设定结束\n\n")
                 if request.messages and request.messages[0]['role'] == 'system':
@@ -807,14 +780,9 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                     request.messages[0]['content'] += "世界观设定：\n\n" + lore_content + "\n\n世界观设定结束\n\n"
                 else:
                     request.messages.insert(0, {'role': 'system', 'content': "世界观设定：\n\n" + lore_content + "\n\n世界观设定结束\n\n"})
+            m0 = await preprocess.result("memory")
             if m0:
-                memoryLimit = settings["memorySettings"]["memoryLimit"]
-                try:
-                    relevant_memories = m0.search(query=user_prompt, user_id=memoryId, limit=memoryLimit)
-                    relevant_memories = json.dumps(relevant_memories, ensure_ascii=False)
-                except Exception as e:
-                    print("m0.search error:",e)
-                    relevant_memories = ""
+                relevant_memories = await preprocess.result("memory_search")
                 if request.messages and request.messages[0]['role'] == 'system':
                     print("添加相关记忆：\n\n" + relevant_memories + "\n\n相关结束\n\n")
                     request.messages[0]['content'] += "之前的相关记忆：\n\n" + relevant_memories + "\n\n相关结束\n\n"
@@ -823,13 +791,9 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
         request = await tools_change_messages(request, settings)
         model = settings['model']
         extra_params = settings['extra_params']
-        # 移除extra_params这个list中"name"不包含非空白符的键值对
+        # 跳过extra_params这个list中"name"不包含非空白符的键值对，并转换为字典
         if extra_params:
-            for extra_param in extra_params:
-                if not extra_param['name'].strip():
-                    extra_params.remove(extra_param)
-            # 列表转换为字典
-            extra_params = {item['name']: item['value'] for item in extra_params}
+            extra_params = {item['name']: item['value'] for item in extra_params if item['name'].strip()}
         else:
             extra_params = {}
         async def stream_generator(user_prompt,DRS_STAGE):
@@ -838,21 +802,21 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                 if async_tools_id:
                     responses_to_send = []
                     responses_to_wait = []
-                    async with async_tools_lock:
-                        # 收集已完成的结果并删除条目
-                        for tid in list(async_tools.keys()):  # 转成list避免字典修改异常
-                            if tid in async_tools_id:
-                                if async_tools[tid]["status"] in ("completed", "error"):
-                                    responses_to_send.append({
-                                        "tool_id": tid,
-                                        **async_tools.pop(tid)  # 移除已处理的条目
-                                    })
-                                elif async_tools[tid]["status"] == "pending":
-                                    responses_to_wait.append({
-                                        "tool_id": tid,
-                                        "name":async_tools[tid]["name"],
-                                        "parameters": async_tools[tid]["parameters"]
-                                    })
+                    # 收集已完成的结果并删除条目
+                    for tid, tool_state in (await shared_store.get_many("async_tools", async_tools_id)).items():
+                        if tool_state["status"] in ("completed", "error"):
+                            tool_state = await shared_store.pop("async_tools", tid)  # 移除已处理的条目
+                            if tool_state:
+                                responses_to_send.append({
+                                    "tool_id": tid,
+                                    **tool_state
+                                })
+                        elif tool_state["status"] == "pending":
+                            responses_to_wait.append({
+                                "tool_id": tid,
+                                "name":tool_state["name"],
+                                "parameters": tool_state["parameters"]
+                            })
                     for response in responses_to_send:
                         tid = response["tool_id"]
                         if response["status"] == "completed":
@@ -866,7 +830,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             tool_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n[{tid}{await t("tool_result")}]({fileLink})\n\n",
+                                        "tool_content": f"\n\n[{tid}{t("tool_result")}]({fileLink})\n\n",
                                         "async_tool_id": tid
                                     }
                                 }]
@@ -907,7 +871,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             tool_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n[{tid}{await t("tool_result")}]({fileLink})\n\n",
+                                        "tool_content": f"\n\n[{tid}{t("tool_result")}]({fileLink})\n\n",
                                         "async_tool_id": tid
                                     }
                                 }]
@@ -944,11 +908,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                                 "content": str(results),
                             }
                         )
-                kb_list = []
-                if settings["knowledgeBases"]:
-                    for kb in settings["knowledgeBases"]:
-                        if kb["enabled"] and kb["processingStatus"] == "completed":
-                            kb_list.append({"kb_id":kb["id"],"name": kb["name"],"introduction":kb["introduction"]})
+                kb_list = get_kb_list(settings)
                 if settings["KBSettings"]["when"] == "before_thinking" or settings["KBSettings"]["when"] == "both":
                     if kb_list:
                         chunk_dict = {
@@ -960,19 +920,14 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                                     "delta": {
                                         "role":"assistant",
                                         "content": "",
-                                        "tool_content": f"{await t("KB_search")}\n\n"
+                                        "tool_content": f"{t("KB_search")}\n\n"
                                     }
                                 }
                             ]
                         }
                         yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        all_kb_content = []
-                        # 用query_knowledge_base函数查询kb_list中所有的知识库
-                        for kb in kb_list:
-                            kb_content = await query_knowledge_base(kb["kb_id"],user_prompt)
-                            all_kb_content.extend(kb_content)
-                            if settings["KBSettings"]["is_rerank"]:
-                                all_kb_content = await rerank_knowledge_base(user_prompt,all_kb_content)
+                        # 知识库查询在预处理阶段已与其他步骤并发开始
+                        all_kb_content = await preprocess.result("knowledge_base", [])
                         if all_kb_content:
                             all_kb_content = json.dumps(all_kb_content, ensure_ascii=False, indent=4)
                             kb_message = f"\n\n可参考的知识库内容：{all_kb_content}"
@@ -990,7 +945,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             tool_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n[{await t("search_result")}]({fileLink})\n\n",
+                                        "tool_content": f"\n\n[{t("search_result")}]({fileLink})\n\n",
                                     }
                                 }]
                             }
@@ -1015,30 +970,14 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                                     "delta": {
                                         "role":"assistant",
                                         "content": "",
-                                        "tool_content": f"{await t("web_search")}\n\n"
+                                        "tool_content": f"{t("web_search")}\n\n"
                                     }
                                 }
                             ]
                         }
                         yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        if settings['webSearch']['engine'] == 'duckduckgo':
-                            results = await DDGsearch_async(user_prompt)
-                        elif settings['webSearch']['engine'] == 'searxng':
-                            results = await searxng_async(user_prompt)
-                        elif settings['webSearch']['engine'] == 'tavily':
-                            results = await Tavily_search_async(user_prompt)
-                        elif settings['webSearch']['engine'] == 'bing':
-                            results = await Bing_search_async(user_prompt)
-                        elif settings['webSearch']['engine'] == 'google':
-                            results = await Google_search_async(user_prompt)
-                        elif settings['webSearch']['engine'] == 'brave':
-                            results = await Brave_search_async(user_prompt)
-                        elif settings['webSearch']['engine'] == 'exa':
-                            results = await Exa_search_async(user_prompt)
-                        elif settings['webSearch']['engine'] == 'serper':
-                            results = await Serper_search_async(user_prompt)
-                        elif settings['webSearch']['engine'] == 'bochaai':
-                            results = await bochaai_search_async(user_prompt)
+                        # 联网搜索在预处理阶段已与其他步骤并发开始
+                        results = await preprocess.result("web_search")
                         if results:
                             request.messages[-1]['content'] += f"\n\n联网搜索结果：{results}\n\n请根据联网搜索结果组织你的回答，并确保你的回答是准确的。"
                             # 获取时间戳和uuid
@@ -1054,7 +993,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             tool_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n[{await t("search_result")}]({fileLink})\n\n",
+                                        "tool_content": f"\n\n[{t("search_result")}]({fileLink})\n\n",
                                     }
                                 }]
                             }
@@ -1085,9 +1024,11 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             tools.append(Crawl4Ai_tool)
                 if kb_list:
                     tools.append(kb_tool)
+                images = await preprocess.result("images")
+                await preprocess.wait()
                 if settings['tools']['deepsearch']['enabled'] or enable_deep_research: 
-                    deepsearch_messages = copy.deepcopy(request.messages)
-                    deepsearch_messages[-1]['content'] += "\n\n将用户提出的问题或给出的当前任务拆分成多个步骤，每一个步骤用一句简短的话概括即可，无需回答或执行这些内容，直接返回总结即可，但不能省略问题或任务的细节。如果用户输入的只是闲聊或者不包含任务和问题，直接把用户输入重复输出一遍即可。如果是非常简单的问题，也可以只给出一个步骤即可。一般情况下都是需要拆分成多个步骤的。"
+                    deepsearch_messages = MessageOverlay(request.messages)
+                    deepsearch_messages.edit(-1)['content'] += "\n\n将用户提出的问题或给出的当前任务拆分成多个步骤，每一个步骤用一句简短的话概括即可，无需回答或执行这些内容，直接返回总结即可，但不能省略问题或任务的细节。如果用户输入的只是闲聊或者不包含任务和问题，直接把用户输入重复输出一遍即可。如果是非常简单的问题，也可以只给出一个步骤即可。一般情况下都是需要拆分成多个步骤的。"
                     response = await client.chat.completions.create(
                         model=model,
                         messages=deepsearch_messages,
@@ -1098,7 +1039,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                     deepsearch_chunk = {
                         "choices": [{
                             "delta": {
-                                "tool_content": f"\n\n💖{await t("start_task")}{user_prompt}\n\n",
+                                "tool_content": f"\n\n💖{t("start_task")}{user_prompt}\n\n",
                             }
                         }]
                     }
@@ -1106,19 +1047,20 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                     request.messages[-1]['content'] += f"\n\n如果用户没有提出问题或者任务，直接闲聊即可，如果用户提出了问题或者任务，任务描述不清晰或者你需要进一步了解用户的真实需求，你可以暂时不完成任务，而是分析需要让用户进一步明确哪些需求。"
                 # 如果启用推理模型
                 if settings['reasoner']['enabled'] or enable_thinking:
-                    reasoner_messages = copy.deepcopy(request.messages)
+                    reasoner_messages = MessageOverlay(request.messages)
                     if settings['tools']['deepsearch']['enabled'] or enable_deep_research: 
-                        reasoner_messages[-1]['content'] += f"\n\n可参考的步骤：{user_prompt}\n\n"
+                        reasoner_messages.edit(-1)['content'] += f"\n\n可参考的步骤：{user_prompt}\n\n"
                         drs_msg = get_drs_stage(DRS_STAGE)
                         if drs_msg:
-                            reasoner_messages[-1]['content'] += f"\n\n{drs_msg}\n\n"
+                            reasoner_messages.edit(-1)['content'] += f"\n\n{drs_msg}\n\n"
                     if tools:
-                        reasoner_messages[-1]['content'] += f"可用工具：{json.dumps(tools)}"
+                        reasoner_messages.edit(-1)['content'] += f"可用工具：{json.dumps(tools)}"
                     for modelProvider in settings['modelProviders']: 
                         if modelProvider['id'] == settings['reasoner']['selectedProvider']:
                             vendor = modelProvider['vendor']
                             break
                     msg = await images_add_in_messages(reasoner_messages, images,settings)
+                    msg = compact_messages(msg, settings['reasoner']['model'], settings, settings['max_tokens'])
                     if vendor == 'Ollama':
                         # 流式调用推理模型
                         reasoner_stream = await reasoner_client.chat.completions.create(
@@ -1128,55 +1070,23 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             temperature=settings['reasoner']['temperature']
                         )
                         full_reasoning = ""
-                        buffer = ""  # 跨chunk的内容缓冲区
-                        in_reasoning = False  # 是否在标签内
-                        
+                        reasoner_parser = ThinkTagParser(open_tag, close_tag)
+
                         async for chunk in reasoner_stream:
                             if not chunk.choices:
                                 continue
                             chunk_dict = chunk.model_dump()
                             delta = chunk_dict["choices"][0].get("delta", {})
                             if delta:
-                                current_content = delta.get("content", "")
-                                buffer += current_content  # 累积到缓冲区
-                                
-                                # 实时处理缓冲区内容
-                                while True:
-                                    if not in_reasoning:
-                                        # 寻找开放标签
-                                        start_pos = buffer.find(open_tag)
-                                        if start_pos != -1:
-                                            # 开放标签前的内容（非思考内容）
-                                            non_reasoning = buffer[:start_pos]
-                                            buffer = buffer[start_pos+len(open_tag):]
-                                            in_reasoning = True
-                                        else:
-                                            break  # 无开放标签，保留后续处理
-                                    else:
-                                        # 寻找闭合标签
-                                        end_pos = buffer.find(close_tag)
-                                        if end_pos != -1:
-                                            # 提取思考内容并构造响应
-                                            reasoning_part = buffer[:end_pos]
-                                            chunk_dict["choices"][0]["delta"] = {
-                                                "reasoning_content": reasoning_part,
-                                                "content": ""  # 清除非思考内容
-                                            }
-                                            yield f"data: {json.dumps(chunk_dict)}\n\n"
-                                            full_reasoning += reasoning_part
-                                            buffer = buffer[end_pos+len(close_tag):]
-                                            in_reasoning = False
-                                        else:
-                                            # 发送未闭合的中间内容
-                                            if buffer:
-                                                chunk_dict["choices"][0]["delta"] = {
-                                                    "reasoning_content": buffer,
-                                                    "content": ""
-                                                }
-                                                yield f"data: {json.dumps(chunk_dict)}\n\n"
-                                                full_reasoning += buffer
-                                                buffer = ""
-                                            break  # 等待更多内容
+                                # 只转发标签内的思考内容，标签外的内容丢弃
+                                _, reasoning_part = reasoner_parser.feed(delta.get("content") or "")
+                                if reasoning_part:
+                                    chunk_dict["choices"][0]["delta"] = {
+                                        "reasoning_content": reasoning_part,
+                                        "content": ""
+                                    }
+                                    yield f"data: {json.dumps(chunk_dict)}\n\n"
+                                    full_reasoning += reasoning_part
                     else:
                         # 流式调用推理模型
                         reasoner_stream = await reasoner_client.chat.completions.create(
@@ -1203,22 +1113,23 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                     # 在推理结束后添加完整推理内容到消息
                     request.messages[-1]['content'] += f"\n\n可参考的推理过程：{full_reasoning}"
                 # 状态跟踪变量
-                in_reasoning = False
-                reasoning_buffer = []
-                content_buffer = []
+                think_parser = ThinkTagParser(open_tag, close_tag)
                 if settings['tools']['deepsearch']['enabled'] or enable_deep_research: 
                     request.messages[-1]['content'] += f"\n\n可参考的步骤：{user_prompt}\n\n"
                     drs_msg = get_drs_stage(DRS_STAGE)
                     if drs_msg:
                         request.messages[-1]['content'] += f"\n\n{drs_msg}\n\n"
                 msg = await images_add_in_messages(request.messages, images,settings)
+                # 超出模型上下文窗口时按优先级压缩
+                msg = compact_messages(msg, model, settings, request.max_tokens or settings['max_tokens'], tools)
                 if tools:
-                    response = await client.chat.completions.create(
+                    # 以原始 SSE 行读取上游流，不需要改写的数据块直接转发
+                    response = stream_chat_chunks(
+                        client,
                         model=model,
                         messages=msg,  # 添加图片信息到消息
                         temperature=request.temperature,
                         tools=tools,
-                        stream=True,
                         max_tokens=request.max_tokens or settings['max_tokens'],
                         top_p=request.top_p or settings['top_p'],
                         frequency_penalty=request.frequency_penalty,
@@ -1226,11 +1137,12 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         extra_body = extra_params, # 其他参数
                     )
                 else:
-                    response = await client.chat.completions.create(
+                    # 以原始 SSE 行读取上游流，不需要改写的数据块直接转发
+                    response = stream_chat_chunks(
+                        client,
                         model=model,
                         messages=msg,  # 添加图片信息到消息
                         temperature=request.temperature,
-                        stream=True,
                         max_tokens=request.max_tokens or settings['max_tokens'],
                         top_p=request.top_p or settings['top_p'],
                         frequency_penalty=request.frequency_penalty,
@@ -1241,13 +1153,22 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                 full_content = ""
                 search_not_done = False
                 search_task = ""
-                async for chunk in response:
-                    if not chunk.choices:
+                async for raw_chunk, chunk_data in response:
+                    if not chunk_data.get("choices"):
                         continue
+                    if not (tool_calls or think_parser.busy):
+                        fast_delta = passthrough_delta(chunk_data)
+                        if fast_delta is not None:
+                            yield f"data: {raw_chunk}\n\n"
+                            if not fast_delta.get("reasoning_content"):
+                                full_content += fast_delta.get("content") or ""
+                            continue
+                    chunk = to_chunk(chunk_data)
                     choice = chunk.choices[0]
                     if choice.delta.tool_calls:  # function_calling
-                        for idx, tool_call in enumerate(choice.delta.tool_calls):
-                            tool = choice.delta.tool_calls[idx]
+                        for position, tool in enumerate(choice.delta.tool_calls):
+                            # 同一轮的多个工具调用按 index 区分，各自的参数分多块流式返回
+                            idx = tool.index if tool.index is not None else position
                             if len(tool_calls) <= idx:
                                 tool_calls.append(tool)
                                 continue
@@ -1271,58 +1192,21 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             yield f"data: {json.dumps(chunk_dict)}\n\n"
                             continue
 
-                        # 处理内容
-                        current_content = delta["content"]
-                        buffer = current_content
-                        
-                        while buffer:
-                            if not in_reasoning:
-                                # 寻找开始标签
-                                start_pos = buffer.find(open_tag)
-                                if start_pos != -1:
-                                    # 处理开始标签前的内容
-                                    content_buffer.append(buffer[:start_pos])
-                                    buffer = buffer[start_pos+len(open_tag):]
-                                    in_reasoning = True
-                                else:
-                                    content_buffer.append(buffer)
-                                    buffer = ""
-                            else:
-                                # 寻找结束标签
-                                end_pos = buffer.find(close_tag)
-                                if end_pos != -1:
-                                    # 处理思考内容
-                                    reasoning_buffer.append(buffer[:end_pos])
-                                    buffer = buffer[end_pos+len(close_tag):]
-                                    in_reasoning = False
-                                else:
-                                    reasoning_buffer.append(buffer)
-                                    buffer = ""
-                        
-                        # 构造新的delta内容
-                        new_content = "".join(content_buffer)
-                        new_reasoning = "".join(reasoning_buffer)
-                        
-                        # 更新chunk内容
-                        delta["content"] = new_content.strip("\x00")  # 保留未完成内容
-                        delta["reasoning_content"] = new_reasoning.strip("\x00") or None
-                        
-                        # 重置缓冲区但保留未完成部分
-                        if in_reasoning:
-                            content_buffer = [new_content.split(open_tag)[-1]] 
-                        else:
-                            content_buffer = []
-                        reasoning_buffer = []
-                        
+                        # 拆分 <think> 标签内外的内容，跨数据块的半截标签由解析器暂存
+                        new_content, new_reasoning = think_parser.feed(delta["content"])
+                        delta["content"] = new_content
+                        delta["reasoning_content"] = new_reasoning or None
+
                         yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        full_content += delta.get("content", "")
+                        full_content += new_content
                 # 最终flush未完成内容
-                if content_buffer or reasoning_buffer:
+                tail_content, tail_reasoning = think_parser.flush()
+                if tail_content or tail_reasoning:
                     final_chunk = {
                         "choices": [{
                             "delta": {
-                                "content": "".join(content_buffer),
-                                "reasoning_content": "".join(reasoning_buffer)
+                                "content": tail_content,
+                                "reasoning_content": tail_reasoning
                             }
                         }]
                     }
@@ -1361,7 +1245,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         search_chunk = {
                             "choices": [{
                                 "delta": {
-                                    "tool_content": f"\n\n❌{await t("task_error")}\n\n",
+                                    "tool_content": f"\n\n❌{t("task_error")}\n\n",
                                 }
                             }]
                         }
@@ -1370,7 +1254,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         search_chunk = {
                             "choices": [{
                                 "delta": {
-                                    "tool_content": f"\n\n✅{await t("task_done")}\n\n",
+                                    "tool_content": f"\n\n✅{t("task_done")}\n\n",
                                 }
                             }]
                         }
@@ -1380,7 +1264,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         search_chunk = {
                             "choices": [{
                                 "delta": {
-                                    "tool_content": f"\n\n❎{await t("task_not_done")}\n\n",
+                                    "tool_content": f"\n\n❎{t("task_not_done")}\n\n",
                                 }
                             }]
                         }
@@ -1405,7 +1289,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         search_chunk = {
                             "choices": [{
                                 "delta": {
-                                    "tool_content": f"\n\n❓{await t("task_need_more_info")}\n\n"
+                                    "tool_content": f"\n\n❓{t("task_need_more_info")}\n\n"
                                 }
                             }]
                         }
@@ -1416,7 +1300,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         search_chunk = {
                             "choices": [{
                                 "delta": {
-                                    "tool_content": f"\n\n🔍{await t("enter_search_stage")}\n\n"
+                                    "tool_content": f"\n\n🔍{t("enter_search_stage")}\n\n"
                                 }
                             }]
                         }
@@ -1440,7 +1324,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         search_chunk = {
                             "choices": [{
                                 "delta": {
-                                    "tool_content": f"\n\n🔍{await t("need_more_search")}\n\n"
+                                    "tool_content": f"\n\n🔍{t("need_more_search")}\n\n"
                                 }
                             }]
                         }
@@ -1465,7 +1349,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         search_chunk = {
                             "choices": [{
                                 "delta": {
-                                    "tool_content": f"\n\n⭐{await t("enter_answer_stage")}\n\n"
+                                    "tool_content": f"\n\n⭐{t("enter_answer_stage")}\n\n"
                                 }
                             }]
                         }
@@ -1484,60 +1368,22 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                                 "content": drs_msg,
                             }
                         )
-                reasoner_messages = copy.deepcopy(request.messages)
+                reasoner_messages = MessageOverlay(request.messages)
                 while tool_calls or search_not_done:
                     full_content = ""
                     if tool_calls:
-                        response_content = tool_calls[0].function
-                        if response_content.name in  ["DDGsearch_async","searxng_async", "Bing_search_async", "Google_search_async", "Brave_search_async", "Exa_search_async", "Serper_search_async","bochaai_search_async"]:
-                            chunk_dict = {
-                                "id": "agentParty",
-                                "choices": [
-                                    {
-                                        "finish_reason": None,
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "tool_content": f"\n\n{await t("web_search")}\n\n"
-                                        }
-                                    }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        elif response_content.name in  ["jina_crawler_async","Crawl4Ai_search_async"]:
-                            chunk_dict = {
-                                "id": "agentParty",
-                                "choices": [
-                                    {
-                                        "finish_reason": None,
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "tool_content": f"\n\n{await t("web_search_more")}\n\n"
-                                        }
-                                    }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        elif response_content.name in ["query_knowledge_base"]:
-                            chunk_dict = {
-                                "id": "agentParty",
-                                "choices": [
-                                    {
-                                        "finish_reason": None,
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "tool_content": f"\n\n{await t("knowledge_base")}\n\n"
-                                        }
-                                    }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        else:
+                        # 同一轮的所有工具调用：先逐个提示，再并发执行，结果按顺序写回
+                        calls = []
+                        for tool_call in tool_calls:
+                            response_content = tool_call.function
+                            if response_content.name in  ["DDGsearch_async","searxng_async", "Bing_search_async", "Google_search_async", "Brave_search_async", "Exa_search_async", "Serper_search_async","bochaai_search_async"]:
+                                tool_content = f"\n\n{t("web_search")}\n\n"
+                            elif response_content.name in  ["jina_crawler_async","Crawl4Ai_search_async"]:
+                                tool_content = f"\n\n{t("web_search_more")}\n\n"
+                            elif response_content.name in ["query_knowledge_base"]:
+                                tool_content = f"\n\n{t("knowledge_base")}\n\n"
+                            else:
+                                tool_content = f"\n\n{t("call")}{response_content.name}{t("tool")}\n\n"
                             chunk_dict = {
                                 "id": "agentParty",
                                 "choices": [
@@ -1547,153 +1393,172 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                                         "delta": {
                                             "role":"assistant",
                                             "content": "",
-                                            "tool_content": f"\n\n{await t("call")}{response_content.name}{await t("tool")}\n\n"
+                                            "tool_content": tool_content
                                         }
                                     }
                                 ]
                             }
                             yield f"data: {json.dumps(chunk_dict)}\n\n"
-                        modified_data = '[' + response_content.arguments.replace('}{', '},{') + ']'
-                        # 使用json.loads来解析修改后的字符串为列表
-                        data_list = json.loads(modified_data)
+                            modified_data = '[' + (response_content.arguments or '{}').replace('}{', '},{') + ']'
+                            # 使用json.loads来解析修改后的字符串为列表
+                            data_list = json.loads(modified_data)
+                            calls.append((tool_call, modified_data, data_list[0]))
                         if settings['tools']['asyncTools']['enabled']:
-                            tool_id = uuid.uuid4()
-                            async_tool_id = f"{response_content.name}_{tool_id}"
-                            chunk_dict = {
-                                "id": "agentParty",
-                                "choices": [
-                                    {
-                                        "finish_reason": None,
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "async_tool_id": async_tool_id
+                            results_list = []
+                            for tool_call, modified_data, tool_params in calls:
+                                tool_name = tool_call.function.name
+                                tool_id = uuid.uuid4()
+                                async_tool_id = f"{tool_name}_{tool_id}"
+                                chunk_dict = {
+                                    "id": "agentParty",
+                                    "choices": [
+                                        {
+                                            "finish_reason": None,
+                                            "index": 0,
+                                            "delta": {
+                                                "role":"assistant",
+                                                "content": "",
+                                                "async_tool_id": async_tool_id
+                                            }
                                         }
-                                    }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk_dict)}\n\n"
-                            # 启动异步任务并记录状态
-                            asyncio.create_task(
-                                execute_async_tool(
-                                    async_tool_id,
-                                    response_content.name,
-                                    data_list[0],
-                                    settings,
-                                    user_prompt
-                                )
-                            )
-                            
-                            async with async_tools_lock:
-                                async_tools[async_tool_id] = {
+                                    ]
+                                }
+                                yield f"data: {json.dumps(chunk_dict)}\n\n"
+                                # 先记录状态再启动异步任务，避免任务结果被 pending 覆盖
+                                await shared_store.set("async_tools", async_tool_id, {
                                     "status": "pending",
                                     "result": None,
-                                    "name":response_content.name,
-                                    "parameters":data_list[0]
-                                }
-                            results = f"{response_content.name}工具已成功启动，获取结果需要花费很久的时间。请不要再次调用该工具，因为工具结果将生成后自动发送，再次调用也不能更快的获取到结果。请直接告诉用户，你会在获得结果后回答他的问题。"
+                                    "name":tool_name,
+                                    "parameters":tool_params
+                                })
+                                asyncio.create_task(
+                                    execute_async_tool(
+                                        async_tool_id,
+                                        tool_name,
+                                        tool_params,
+                                        settings,
+                                        user_prompt
+                                    )
+                                )
+                                results_list.append(f"{tool_name}工具已成功启动，获取结果需要花费很久的时间。请不要再次调用该工具，因为工具结果将生成后自动发送，再次调用也不能更快的获取到结果。请直接告诉用户，你会在获得结果后回答他的问题。")
                         else:
-                            results = await dispatch_tool(response_content.name, data_list[0],settings)
-                        if results is None:
-                            chunk = {
-                                "id": "extra_tools",
-                                "choices": [
-                                    {
-                                        "index": 0,
-                                        "delta": {
-                                            "role":"assistant",
-                                            "content": "",
-                                            "tool_calls":modified_data,
-                                        }
-                                    }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                            break
-                        if response_content.name in ["query_knowledge_base"] and type(results) == list:
-                            if settings["KBSettings"]["is_rerank"]:
-                                results = await rerank_knowledge_base(user_prompt,results)
-                            results = json.dumps(results, ensure_ascii=False, indent=4)
-                        request.messages.append(
-                            {
-                                "tool_calls": [
-                                    {
-                                        "id": tool_calls[0].id,
-                                        "function": {
-                                            "arguments": json.dumps(data_list[0]),
-                                            "name": response_content.name,
-                                        },
-                                        "type": tool_calls[0].type,
-                                    }
-                                ],
-                                "role": "assistant",
-                                "content": str(response_content),
-                            }
-                        )
-                        request.messages.append(
-                            {
-                                "role": "tool",
-                                "tool_call_id": tool_calls[0].id,
-                                "name": response_content.name,
-                                "content": str(results),
-                            }
-                        )
-                        if (settings['webSearch']['when'] == 'after_thinking' or settings['webSearch']['when'] == 'both') and settings['tools']['asyncTools']['enabled'] is False:
-                            request.messages[-1]['content'] += f"\n对于联网搜索的结果，如果联网搜索的信息不足以回答问题时，你可以进一步使用联网搜索查询还未给出的必要信息。如果已经足够回答问题，请直接回答问题。"
-                        if settings['tools']['asyncTools']['enabled']:
-                            reasoner_messages.append(
-                                {
-                                    "role": "assistant",
-                                    "content": str(response_content),
-                                }
-                            )
-                            reasoner_messages.append(
-                                {
-                                    "role": "system",
-                                    "content": f"{response_content.name}工具已成功启动，获取结果需要花费很久的时间。请不要再次调用该工具，因为工具结果将生成后自动发送，再次调用也不能更快的获取到结果。请直接告诉用户，你会在获得结果后回答他的问题。",
-                                }
+                            parallel_settings = settings['tools'].get('parallelTools') or {}
+                            results_list = await tool_registry.dispatch_many(
+                                [(tool_call.function.name, tool_params) for tool_call, _, tool_params in calls],
+                                settings,
+                                mcp_client_list,
+                                max_concurrency=parallel_settings.get('maxConcurrency', 4),
+                                timeout=parallel_settings.get('timeout', 300),
+                                timeouts=parallel_settings.get('timeouts'),
                             )
-                        else:
-                            reasoner_messages.append(
+                        # 服务端没有处理的工具交给前端执行；已经执行过的工具结果照常写入上下文，避免模型重复调用
+                        client_tools = [modified_data for (_, modified_data, _), results in zip(calls, results_list) if results is None]
+                        resolved = [(call, results) for call, results in zip(calls, results_list) if results is not None]
+                        if resolved:
+                            request.messages.append(
                                 {
+                                    "tool_calls": [
+                                        {
+                                            "id": tool_call.id,
+                                            "function": {
+                                                "arguments": json.dumps(tool_params),
+                                                "name": tool_call.function.name,
+                                            },
+                                            "type": tool_call.type,
+                                        }
+                                        for (tool_call, _, tool_params), _ in resolved
+                                    ],
                                     "role": "assistant",
-                                    "content": str(response_content),
+                                    "content": "".join(str(tool_call.function) for (tool_call, _, _), _ in resolved),
                                 }
                             )
-                            reasoner_messages.append(
+                        for (tool_call, _, _), results in resolved:
+                            response_content = tool_call.function
+                            if response_content.name in ["query_knowledge_base"] and type(results) == list:
+                                if settings["KBSettings"]["is_rerank"]:
+                                    results = await rerank_knowledge_base(user_prompt,results)
+                                results = json.dumps(results, ensure_ascii=False, indent=4)
+                            request.messages.append(
                                 {
-                                    "role": "system",
-                                    "content": f"{response_content.name}工具结果："+str(results),
+                                    "role": "tool",
+                                    "tool_call_id": tool_call.id,
+                                    "name": response_content.name,
+                                    "content": str(results),
                                 }
                             )
-                            # 获取时间戳和uuid
-                            timestamp = time.time()
-                            uid = str(uuid.uuid4())
-                            # 构造文件名
-                            filename = f"{timestamp}_{uid}.txt"
-                            # 将搜索结果写入uploaded_file文件夹下的filename文件
-                            with open(os.path.join(UPLOAD_FILES_DIR, filename), "w", encoding='utf-8') as f:
-                                f.write(str(results))            
-                            # 将文件链接更新为新的链接
-                            fileLink=f"{fastapi_base_url}uploaded_files/{filename}"
-                            tool_chunk = {
-                                "choices": [{
-                                    "delta": {
-                                        "tool_content": f"\n\n[{response_content.name}{await t("tool_result")}]({fileLink})\n\n",
+                            if (settings['webSearch']['when'] == 'after_thinking' or settings['webSearch']['when'] == 'both') and settings['tools']['asyncTools']['enabled'] is False:
+                                request.messages[-1]['content'] += f"\n对于联网搜索的结果，如果联网搜索的信息不足以回答问题时，你可以进一步使用联网搜索查询还未给出的必要信息。如果已经足够回答问题，请直接回答问题。"
+                            if settings['tools']['asyncTools']['enabled']:
+                                reasoner_messages.append(
+                                    {
+                                        "role": "assistant",
+                                        "content": str(response_content),
                                     }
-                                }]
-                            }
-                            yield f"data: {json.dumps(tool_chunk)}\n\n"
+                                )
+                                reasoner_messages.append(
+                                    {
+                                        "role": "system",
+                                        "content": f"{response_content.name}工具已成功启动，获取结果需要花费很久的时间。请不要再次调用该工具，因为工具结果将生成后自动发送，再次调用也不能更快的获取到结果。请直接告诉用户，你会在获得结果后回答他的问题。",
+                                    }
+                                )
+                            else:
+                                reasoner_messages.append(
+                                    {
+                                        "role": "assistant",
+                                        "content": str(response_content),
+                                    }
+                                )
+                                reasoner_messages.append(
+                                    {
+                                        "role": "system",
+                                        "content": f"{response_content.name}工具结果："+str(results),
+                                    }
+                                )
+                                # 获取时间戳和uuid
+                                timestamp = time.time()
+                                uid = str(uuid.uuid4())
+                                # 构造文件名
+                                filename = f"{timestamp}_{uid}.txt"
+                                # 将搜索结果写入uploaded_file文件夹下的filename文件
+                                with open(os.path.join(UPLOAD_FILES_DIR, filename), "w", encoding='utf-8') as f:
+                                    f.write(str(results))            
+                                # 将文件链接更新为新的链接
+                                fileLink=f"{fastapi_base_url}uploaded_files/{filename}"
+                                tool_chunk = {
+                                    "choices": [{
+                                        "delta": {
+                                            "tool_content": f"\n\n[{response_content.name}{t("tool_result")}]({fileLink})\n\n",
+                                        }
+                                    }]
+                                }
+                                yield f"data: {json.dumps(tool_chunk)}\n\n"
+                        if client_tools:
+                            for modified_data in client_tools:
+                                chunk = {
+                                    "id": "extra_tools",
+                                    "choices": [
+                                        {
+                                            "index": 0,
+                                            "delta": {
+                                                "role":"assistant",
+                                                "content": "",
+                                                "tool_calls":modified_data,
+                                            }
+                                        }
+                                    ]
+                                }
+                                yield f"data: {json.dumps(chunk)}\n\n"
+                            break
                     # 如果启用推理模型
                     if settings['reasoner']['enabled'] or enable_thinking:
                         if tools:
-                            reasoner_messages[-1]['content'] += f"可用工具：{json.dumps(tools)}"
+                            reasoner_messages.edit(-1)['content'] += f"可用工具：{json.dumps(tools)}"
                         for modelProvider in settings['modelProviders']: 
                             if modelProvider['id'] == settings['reasoner']['selectedProvider']:
                                 vendor = modelProvider['vendor']
                                 break
                         msg = await images_add_in_messages(reasoner_messages, images,settings)
+                        msg = compact_messages(msg, settings['reasoner']['model'], settings, settings['max_tokens'])
                         if vendor == 'Ollama':
                             # 流式调用推理模型
                             reasoner_stream = await reasoner_client.chat.completions.create(
@@ -1703,55 +1568,23 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                                 temperature=settings['reasoner']['temperature']
                             )
                             full_reasoning = ""
-                            buffer = ""  # 跨chunk的内容缓冲区
-                            in_reasoning = False  # 是否在标签内
-                            
+                            reasoner_parser = ThinkTagParser(open_tag, close_tag)
+
                             async for chunk in reasoner_stream:
                                 if not chunk.choices:
                                     continue
                                 chunk_dict = chunk.model_dump()
                                 delta = chunk_dict["choices"][0].get("delta", {})
                                 if delta:
-                                    current_content = delta.get("content", "")
-                                    buffer += current_content  # 累积到缓冲区
-                                    
-                                    # 实时处理缓冲区内容
-                                    while True:
-                                        if not in_reasoning:
-                                            # 寻找开放标签
-                                            start_pos = buffer.find(open_tag)
-                                            if start_pos != -1:
-                                                # 开放标签前的内容（非思考内容）
-                                                non_reasoning = buffer[:start_pos]
-                                                buffer = buffer[start_pos+len(open_tag):]
-                                                in_reasoning = True
-                                            else:
-                                                break  # 无开放标签，保留后续处理
-                                        else:
-                                            # 寻找闭合标签
-                                            end_pos = buffer.find(close_tag)
-                                            if end_pos != -1:
-                                                # 提取思考内容并构造响应
-                                                reasoning_part = buffer[:end_pos]
-                                                chunk_dict["choices"][0]["delta"] = {
-                                                    "reasoning_content": reasoning_part,
-                                                    "content": ""  # 清除非思考内容
-                                                }
-                                                yield f"data: {json.dumps(chunk_dict)}\n\n"
-                                                full_reasoning += reasoning_part
-                                                buffer = buffer[end_pos+len(close_tag):]
-                                                in_reasoning = False
-                                            else:
-                                                # 发送未闭合的中间内容
-                                                if buffer:
-                                                    chunk_dict["choices"][0]["delta"] = {
-                                                        "reasoning_content": buffer,
-                                                        "content": ""
-                                                    }
-                                                    yield f"data: {json.dumps(chunk_dict)}\n\n"
-                                                    full_reasoning += buffer
-                                                    buffer = ""
-                                                break  # 等待更多内容
+                                    # 只转发标签内的思考内容，标签外的内容丢弃
+                                    _, reasoning_part = reasoner_parser.feed(delta.get("content") or "")
+                                    if reasoning_part:
+                                        chunk_dict["choices"][0]["delta"] = {
+                                            "reasoning_content": reasoning_part,
+                                            "content": ""
+                                        }
+                                        yield f"data: {json.dumps(chunk_dict)}\n\n"
+                                        full_reasoning += reasoning_part
                         else:
                             # 流式调用推理模型
                             reasoner_stream = await reasoner_client.chat.completions.create(
@@ -1778,13 +1611,16 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                         # 在推理结束后添加完整推理内容到消息
                         request.messages[-1]['content'] += f"\n\n可参考的推理过程：{full_reasoning}"
                     msg = await images_add_in_messages(request.messages, images,settings)
+                    # 超出模型上下文窗口时按优先级压缩
+                    msg = compact_messages(msg, model, settings, request.max_tokens or settings['max_tokens'], tools)
                     if tools:
-                        response = await client.chat.completions.create(
+                        # 以原始 SSE 行读取上游流，不需要改写的数据块直接转发
+                        response = stream_chat_chunks(
+                            client,
                             model=model,
                             messages=msg,  # 添加图片信息到消息
                             temperature=request.temperature,
                             tools=tools,
-                            stream=True,
                             max_tokens=request.max_tokens or settings['max_tokens'],
                             top_p=request.top_p or settings['top_p'],
                             frequency_penalty=request.frequency_penalty,
@@ -1792,26 +1628,38 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             extra_body = extra_params, # 其他参数
                         )
                     else:
-                        response = await client.chat.completions.create(
+                        # 以原始 SSE 行读取上游流，不需要改写的数据块直接转发
+                        response = stream_chat_chunks(
+                            client,
                             model=model,
                             messages=msg,  # 添加图片信息到消息
                             temperature=request.temperature,
-                            stream=True,
                             max_tokens=request.max_tokens or settings['max_tokens'],
                             top_p=request.top_p or settings['top_p'],
                             frequency_penalty=request.frequency_penalty,
                             presence_penalty=request.presence_penalty,
                             extra_body = extra_params, # 其他参数
                         )
+                    # 每一轮都是新的回复，不能沿用上一轮的标签状态
+                    think_parser = ThinkTagParser(open_tag, close_tag)
                     tool_calls = []
-                    async for chunk in response:
-                        if not chunk.choices:
+                    async for raw_chunk, chunk_data in response:
+                        if not chunk_data.get("choices"):
                             continue
+                        if not (tool_calls or think_parser.busy):
+                            fast_delta = passthrough_delta(chunk_data)
+                            if fast_delta is not None:
+                                yield f"data: {raw_chunk}\n\n"
+                                if not fast_delta.get("reasoning_content"):
+                                    full_content += fast_delta.get("content") or ""
+                                continue
+                        chunk = to_chunk(chunk_data)
                         if chunk.choices:
                             choice = chunk.choices[0]
                             if choice.delta.tool_calls:  # function_calling
-                                for idx, tool_call in enumerate(choice.delta.tool_calls):
-                                    tool = choice.delta.tool_calls[idx]
+                                for position, tool in enumerate(choice.delta.tool_calls):
+                                    # 同一轮的多个工具调用按 index 区分，各自的参数分多块流式返回
+                                    idx = tool.index if tool.index is not None else position
                                     if len(tool_calls) <= idx:
                                         tool_calls.append(tool)
                                         continue
@@ -1835,58 +1683,21 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                                     yield f"data: {json.dumps(chunk_dict)}\n\n"
                                     continue
                                 
-                                # 处理内容
-                                current_content = delta["content"]
-                                buffer = current_content
-                                
-                                while buffer:
-                                    if not in_reasoning:
-                                        # 寻找开始标签
-                                        start_pos = buffer.find(open_tag)
-                                        if start_pos != -1:
-                                            # 处理开始标签前的内容
-                                            content_buffer.append(buffer[:start_pos])
-                                            buffer = buffer[start_pos+len(open_tag):]
-                                            in_reasoning = True
-                                        else:
-                                            content_buffer.append(buffer)
-                                            buffer = ""
-                                    else:
-                                        # 寻找结束标签
-                                        end_pos = buffer.find(close_tag)
-                                        if end_pos != -1:
-                                            # 处理思考内容
-                                            reasoning_buffer.append(buffer[:end_pos])
-                                            buffer = buffer[end_pos+len(close_tag):]
-                                            in_reasoning = False
-                                        else:
-                                            reasoning_buffer.append(buffer)
-                                            buffer = ""
-                                
-                                # 构造新的delta内容
-                                new_content = "".join(content_buffer)
-                                new_reasoning = "".join(reasoning_buffer)
-                                
-                                # 更新chunk内容
-                                delta["content"] = new_content.strip("\x00")  # 保留未完成内容
-                                delta["reasoning_content"] = new_reasoning.strip("\x00") or None
-                                
-                                # 重置缓冲区但保留未完成部分
-                                if in_reasoning:
-                                    content_buffer = [new_content.split(open_tag)[-1]] 
-                                else:
-                                    content_buffer = []
-                                reasoning_buffer = []
-                                
+                                # 拆分 <think> 标签内外的内容，跨数据块的半截标签由解析器暂存
+                                new_content, new_reasoning = think_parser.feed(delta["content"])
+                                delta["content"] = new_content
+                                delta["reasoning_content"] = new_reasoning or None
+
                                 yield f"data: {json.dumps(chunk_dict)}\n\n"
-                                full_content += delta.get("content", "")
+                                full_content += new_content
                     # 最终flush未完成内容
-                    if content_buffer or reasoning_buffer:
+                    tail_content, tail_reasoning = think_parser.flush()
+                    if tail_content or tail_reasoning:
                         final_chunk = {
                             "choices": [{
                                 "delta": {
-                                    "content": "".join(content_buffer),
-                                    "reasoning_content": "".join(reasoning_buffer)
+                                    "content": tail_content,
+                                    "reasoning_content": tail_reasoning
                                 }
                             }]
                         }
@@ -1925,7 +1736,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             search_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n❌{await t("task_error")}\n\n",
+                                        "tool_content": f"\n\n❌{t("task_error")}\n\n",
                                     }
                                 }]
                             }
@@ -1934,7 +1745,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             search_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n✅{await t("task_done")}\n\n",
+                                        "tool_content": f"\n\n✅{t("task_done")}\n\n",
                                     }
                                 }]
                             }
@@ -1944,7 +1755,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             search_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n❎{await t("task_not_done")}\n\n",
+                                        "tool_content": f"\n\n❎{t("task_not_done")}\n\n",
                                     }
                                 }]
                             }
@@ -1969,7 +1780,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             search_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n❓{await t("task_need_more_info")}\n\n"
+                                        "tool_content": f"\n\n❓{t("task_need_more_info")}\n\n"
                                     }
                                 }]
                             }
@@ -1980,7 +1791,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             search_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n🔍{await t("enter_search_stage")}\n\n"
+                                        "tool_content": f"\n\n🔍{t("enter_search_stage")}\n\n"
                                     }
                                 }]
                             }
@@ -2004,7 +1815,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             search_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n🔍{await t("need_more_search")}\n\n"
+                                        "tool_content": f"\n\n🔍{t("need_more_search")}\n\n"
                                     }
                                 }]
                             }
@@ -2029,7 +1840,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                             search_chunk = {
                                 "choices": [{
                                     "delta": {
-                                        "tool_content": f"\n\n⭐{await t("enter_answer_stage")}\n\n"
+                                        "tool_content": f"\n\n⭐{t("enter_answer_stage")}\n\n"
                                     }
                                 }]
                             }
@@ -2084,6 +1895,9 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                 yield f"data: {json.dumps(error_chunk)}\n\n"
                 yield "data: [DONE]\n\n"  # 确保最终结束
                 return
+            finally:
+                # 出错或客户端断开时停止还在进行的预处理步骤
+                preprocess.cancel()
         
         return StreamingResponse(
             stream_generator(user_prompt, DRS_STAGE),
@@ -2094,7 +1908,13 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
                 "Connection": "keep-alive",
             }
         )
+    except asyncio.CancelledError:
+        if preprocess is not None:
+            preprocess.cancel()
+        raise
     except Exception as e:
+        if preprocess is not None:
+            preprocess.cancel()
         # 如果e.status_code存在，则使用它作为HTTP状态码，否则使用500
         return JSONResponse(
             status_code=getattr(e, "status_code", 500),
@@ -2104,17 +1924,7 @@ async def generate_stream_response(client,reasoner_client, request: ChatRequest,
 async def generate_complete_response(client,reasoner_client, request: ChatRequest, settings: dict,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search):
     global mcp_client_list
     DRS_STAGE = 1 # 1: 明确用户需求阶段 2: 查询搜索阶段 3: 生成结果阶段
-    from py.load_files import get_files_content,file_tool,image_tool
     from py.web_search import (
-        DDGsearch_async, 
-        searxng_async, 
-        Tavily_search_async,
-        Bing_search_async,
-        Google_search_async,
-        Brave_search_async,
-        Exa_search_async,
-        Serper_search_async,
-        bochaai_search_async,
         duckduckgo_tool, 
         searxng_tool, 
         tavily_tool, 
@@ -2127,13 +1937,10 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
         jina_crawler_tool, 
         Crawl4Ai_tool
     )
-    from py.know_base import kb_tool,query_knowledge_base,rerank_knowledge_base
-    from py.agent_tool import get_agent_tool
-    from py.a2a_tool import get_a2a_tool
-    from py.llm_tool import get_llm_tool
-    from py.pollinations import pollinations_image_tool,openai_image_tool,siliconflow_image_tool
-    from py.code_interpreter import e2b_code_tool,local_run_code_tool
+    from py.know_base import kb_tool,rerank_knowledge_base
     m0 = None
+    memory_config = None
+    memoryId = None
     if settings["memorySettings"]["is_memory"]:
         memoryId = settings["memorySettings"]["selectedMemory"]
         cur_memory = None
@@ -2171,121 +1978,29 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                     }
                 }
             }
-            m0 = Memory.from_config(config)
-    images = await images_in_messages(request.messages,fastapi_base_url)
+            memory_config = config
+    # 图片步骤读取原始的内容列表，message_without_images 会把它替换成文本
+    image_messages = [dict(message) for message in request.messages]
     request.messages = await message_without_images(request.messages)
     open_tag = "<think>"
     close_tag = "</think>"
-    tools = request.tools or []
-    tools = request.tools or []
-    if mcp_client_list:
-        for server_name, mcp_client in mcp_client_list.items():
-            if server_name in settings['mcpServers']:
-                if 'disabled' not in settings['mcpServers'][server_name]:
-                    settings['mcpServers'][server_name]['disabled'] = False
-                if settings['mcpServers'][server_name]['disabled'] == False and settings['mcpServers'][server_name]['processingStatus'] == 'ready':
-                    function = await mcp_client.get_openai_functions()
-                    if function:
-                        tools.extend(function)
-    get_llm_tool_fuction = await get_llm_tool(settings)
-    if get_llm_tool_fuction:
-        tools.append(get_llm_tool_fuction)
-    get_agent_tool_fuction = await get_agent_tool(settings)
-    if get_agent_tool_fuction:
-        tools.append(get_agent_tool_fuction)
-    get_a2a_tool_fuction = await get_a2a_tool(settings)
-    if get_a2a_tool_fuction:
-        tools.append(get_a2a_tool_fuction)
-    if settings['text2imgSettings']['enabled']:
-        if settings['text2imgSettings']['engine'] == 'pollinations':
-            tools.append(pollinations_image_tool)
-        elif settings['text2imgSettings']['engine'] == 'openai':
-            if settings['text2imgSettings']['vendor'] == 'siliconflow':
-                tools.append(siliconflow_image_tool)
-            else:
-                tools.append(openai_image_tool)
-    if settings['tools']['getFile']['enabled']:
-        tools.append(file_tool)
-        tools.append(image_tool)
-    if settings["codeSettings"]['enabled']:
-        if settings["codeSettings"]["engine"] == "e2b":
-            tools.append(e2b_code_tool)
-        elif settings["codeSettings"]["engine"] == "sandbox":
-            tools.append(local_run_code_tool)
-    if settings["custom_http"]:
-        for custom_http in settings["custom_http"]:
-            if custom_http["enabled"]:
-                if custom_http['body'] == "":
-                    custom_http['body'] = "{}"
-                custom_http_tool = {
-                    "type": "function",
-                    "function": {
-                        "name": f"custom_http_{custom_http['name']}",
-                        "description": f"{custom_http['description']}",
-                        "parameters": json.loads(custom_http['body']),
-                    },
-                }
-                tools.append(custom_http_tool)
-    if settings["workflows"]:
-        for workflow in settings["workflows"]:
-            if workflow["enabled"]:
-                comfyui_properties = {}
-                comfyui_required = []
-                if workflow["text_input"] is not None:
-                    comfyui_properties["text_input"] = {
-                        "description": "第一个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
-                        "type": "string"
-                    }
-                    comfyui_required.append("text_input")
-                if workflow["text_input_2"] is not None:
-                    comfyui_properties["text_input_2"] = {
-                        "description": "第二个文字输入，需要输入的提示词，用于生成图片或者视频，如果无特别提示，默认为英文",
-                        "type": "string"
-                    }
-                    comfyui_required.append("text_input_2")
-                if workflow["image_input"] is not None:
-                    comfyui_properties["image_input"] = {
-                        "description": "第一个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
-                        "type": "string"
-                    }
-                    comfyui_required.append("image_input")
-                if workflow["image_input_2"] is not None:
-                    comfyui_properties["image_input_2"] = {
-                        "description": "第二个图片输入，需要输入的图片，必须是图片URL，可以是外部链接，也可以是服务器内部的URL，例如：https://www.example.com/xxx.png  或者  http://127.0.0.1:3456/xxx.jpg",
-                        "type": "string"
-                    }
-                    comfyui_required.append("image_input_2")
-                comfyui_parameters = {
-                    "type": "object",
-                    "properties": comfyui_properties,
-                    "required": comfyui_required
-                }
-                comfyui_tool = {
-                    "type": "function",
-                    "function": {
-                        "name": f"comfyui_{workflow['unique_filename']}",
-                        "description": f"{workflow['description']}+\n如果要输入图片提示词或者修改提示词，尽可能使用英语。\n返回的图片结果，请将图片的URL放入![image]()这样的markdown语法中，用户才能看到图片。如果是视频，请将视频的URL放入<video controls> <source src=''></video>的中src中，用户才能看到视频。如果有多个结果，则请用换行符分隔开这几个图片或者视频，用户才能看到多个结果。",
-                        "parameters": comfyui_parameters,
-                    },
-                }
-                tools.append(comfyui_tool)
+    # 图片、工具、文件、记忆、知识库和联网搜索同时开始，下面按原来的顺序取结果
+    preprocess = start_preprocess(request, settings, fastapi_base_url, request.messages[-1]['content'], image_messages,
+                                  memory_config, memoryId, get_kb_list(settings), enable_web_search)
     search_not_done = False
     search_task = ""
     try:
+        images = await preprocess.result("images")
+        tools = [*(request.tools or []), *await preprocess.result("tools")]
         model = settings['model']
         extra_params = settings['extra_params']
-        # 移除extra_params这个list中"name"不包含非空白符的键值对
+        # 跳过extra_params这个list中"name"不包含非空白符的键值对，并转换为字典
         if extra_params:
-            for extra_param in extra_params:
-                if not extra_param['name'].strip():
-                    extra_params.remove(extra_param)
-            # 列表转换为字典
-            extra_params = {item['name']: item['value'] for item in extra_params}
+            extra_params = {item['name']: item['value'] for item in extra_params if item['name'].strip()}
         else:
             extra_params = {}
         if request.fileLinks:
-            # 异步获取文件内容
-            files_content = await get_files_content(request.fileLinks)
+            files_content = await preprocess.result("files")
             system_message = f"\n\n相关文件内容：{files_content}"
             
             # 修复字符串拼接错误
@@ -2293,7 +2008,6 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                 request.messages[0]['content'] += system_message
             else:
                 request.messages.insert(0, {'role': 'system', 'content': system_message})
-        kb_list = []
         user_prompt = request.messages[-1]['content']
         if settings["memorySettings"]["is_memory"]:
             lore_content = ""
@@ -2307,7 +2021,7 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                 for lore in cur_memory["lorebook"]:
                     if lore["name"] != "" and (lore["name"] in user_prompt or lore["name"] in assistant_reply):
                         lore_content = lore_content + "\n\n" + f"{lore['name']}：{lore['value']}"
-            global cur_random 
+            # 每个记忆当前的随机设定保存在共享存储中，多进程时后续对话同样能沿用
             # 如果request.messages中不包含assistant回复，说明是首次提问，触发随机设定
             if not assistant_reply:
                 # 如果 cur_memory 中有 random 条目
@@ -2316,14 +2030,13 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                     random_entry = random.choice(cur_memory["random"])
                     if random_entry.get("value"):
                         lore_content = lore_content + "\n\n" + f"{random_entry['value']}"
-                        cur_random.append({"id":memoryId,"value":random_entry["value"]})
+                        await shared_store.set("cur_random", memoryId, random_entry["value"])
                         print("新随机设定：",{"id":memoryId,"value":random_entry["value"]})
             else:
-                for item in cur_random:
-                    if item["id"] == memoryId:
-                        lore_content = lore_content + "\n\n" + f"{item['value']}"
-                        print("沿用随机设定：",{"id":memoryId,"value":item['value']})  
-                        break 
+                random_value = await shared_store.get("cur_random", memoryId)
+                if random_value is not None:
+                    lore_content = lore_content + "\n\n" + f"{random_value}"
+                    print("沿用随机设定：",{"id":memoryId,"value":random_value})
             if cur_memory["basic_character"]:
                 print("添加角色设定：\n\n" + cur_memory["basic_character"] + "\n\n角色设定结束\n\n")
                 if request.messages and request.messages[0]['role'] == 'system':
@@ -2336,32 +2049,18 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                     request.messages[0]['content'] += "世界观设定：\n\n" + lore_content + "\n\n世界观设定结束\n\n"
                 else:
                     request.messages.insert(0, {'role': 'system', 'content': "世界观设定：\n\n" + lore_content + "\n\n世界观设定结束\n\n"})
+            m0 = await preprocess.result("memory")
             if m0:
-                memoryLimit = settings["memorySettings"]["memoryLimit"]
-                try:
-                    relevant_memories = m0.search(query=user_prompt, user_id=memoryId, limit=memoryLimit)
-                    relevant_memories = json.dumps(relevant_memories, ensure_ascii=False)
-                except Exception as e:
-                    print("m0.search error:",e)
-                    relevant_memories = ""
+                relevant_memories = await preprocess.result("memory_search")
                 if request.messages and request.messages[0]['role'] == 'system':
                     print("添加相关记忆：\n\n" + relevant_memories + "\n\n相关结束\n\n")
                     request.messages[0]['content'] += "之前的相关记忆：\n\n" + relevant_memories + "\n\n相关结束\n\n"
                 else:
                     request.messages.insert(0, {'role': 'system', 'content': "之前的相关记忆：\n\n" + relevant_memories + "\n\n相关结束\n\n"})     
-        if settings["knowledgeBases"]:
-            for kb in settings["knowledgeBases"]:
-                if kb["enabled"] and kb["processingStatus"] == "completed":
-                    kb_list.append({"kb_id":kb["id"],"name": kb["name"],"introduction":kb["introduction"]})
+        kb_list = get_kb_list(settings)
         if settings["KBSettings"]["when"] == "before_thinking" or settings["KBSettings"]["when"] == "both":
             if kb_list:
-                all_kb_content = []
-                # 用query_knowledge_base函数查询kb_list中所有的知识库
-                for kb in kb_list:
-                    kb_content = await query_knowledge_base(kb["kb_id"],user_prompt)
-                    all_kb_content.extend(kb_content)
-                    if settings["KBSettings"]["is_rerank"]:
-                        all_kb_content = await rerank_knowledge_base(user_prompt,all_kb_content)
+                all_kb_content = await preprocess.result("knowledge_base", [])
                 if all_kb_content:
                     kb_message = f"\n\n可参考的知识库内容：{all_kb_content}"
                     request.messages[-1]['content'] += f"{kb_message}\n\n用户：{user_prompt}"
@@ -2377,24 +2076,7 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
         request = await tools_change_messages(request, settings)
         if settings['webSearch']['enabled'] or enable_web_search:
             if settings['webSearch']['when'] == 'before_thinking' or settings['webSearch']['when'] == 'both':
-                if settings['webSearch']['engine'] == 'duckduckgo':
-                    results = await DDGsearch_async(user_prompt)
-                elif settings['webSearch']['engine'] == 'searxng':
-                    results = await searxng_async(user_prompt)
-                elif settings['webSearch']['engine'] == 'tavily':
-                    results = await Tavily_search_async(user_prompt)
-                elif settings['webSearch']['engine'] == 'bing':
-                    results = await Bing_search_async(user_prompt)
-                elif settings['webSearch']['engine'] == 'google':
-                    results = await Google_search_async(user_prompt)
-                elif settings['webSearch']['engine'] == 'brave':
-                    results = await Brave_search_async(user_prompt)
-                elif settings['webSearch']['engine'] == 'exa':
-                    results = await Exa_search_async(user_prompt)
-                elif settings['webSearch']['engine'] == 'serper':
-                    results = await Serper_search_async(user_prompt)
-                elif settings['webSearch']['engine'] == 'bochaai':
-                    results = await bochaai_search_async(user_prompt)
+                results = await preprocess.result("web_search")
                 if results:
                     request.messages[-1]['content'] += f"\n\n联网搜索结果：{results}"
             if settings['webSearch']['when'] == 'after_thinking' or settings['webSearch']['when'] == 'both':
@@ -2423,9 +2105,10 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                     tools.append(Crawl4Ai_tool)
         if kb_list:
             tools.append(kb_tool)
+        await preprocess.wait()
         if settings['tools']['deepsearch']['enabled'] or enable_deep_research: 
-            deepsearch_messages = copy.deepcopy(request.messages)
-            deepsearch_messages[-1]['content'] += "\n\n将用户提出的问题或给出的当前任务拆分成多个步骤，每一个步骤用一句简短的话概括即可，无需回答或执行这些内容，直接返回总结即可，但不能省略问题或任务的细节。如果用户输入的只是闲聊或者不包含任务和问题，直接把用户输入重复输出一遍即可。如果是非常简单的问题，也可以只给出一个步骤即可。一般情况下都是需要拆分成多个步骤的。"
+            deepsearch_messages = MessageOverlay(request.messages)
+            deepsearch_messages.edit(-1)['content'] += "\n\n将用户提出的问题或给出的当前任务拆分成多个步骤，每一个步骤用一句简短的话概括即可，无需回答或执行这些内容，直接返回总结即可，但不能省略问题或任务的细节。如果用户输入的只是闲聊或者不包含任务和问题，直接把用户输入重复输出一遍即可。如果是非常简单的问题，也可以只给出一个步骤即可。一般情况下都是需要拆分成多个步骤的。"
             response = await client.chat.completions.create(
                 model=model,
                 messages=deepsearch_messages,
@@ -2436,19 +2119,20 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
             user_prompt = response.choices[0].message.content
             request.messages[-1]['content'] += f"\n\n如果用户没有提出问题或者任务，直接闲聊即可，如果用户提出了问题或者任务，任务描述不清晰或者你需要进一步了解用户的真实需求，你可以暂时不完成任务，而是分析需要让用户进一步明确哪些需求。"
         if settings['reasoner']['enabled'] or enable_thinking:
-            reasoner_messages = copy.deepcopy(request.messages)
+            reasoner_messages = MessageOverlay(request.messages)
             if settings['tools']['deepsearch']['enabled'] or enable_deep_research: 
                 drs_msg = get_drs_stage(DRS_STAGE)
                 if drs_msg:
-                    reasoner_messages[-1]['content'] += f"\n\n{drs_msg}\n\n"
-                reasoner_messages[-1]['content'] += f"\n\n可参考的步骤：{user_prompt}\n\n"
+                    reasoner_messages.edit(-1)['content'] += f"\n\n{drs_msg}\n\n"
+                reasoner_messages.edit(-1)['content'] += f"\n\n可参考的步骤：{user_prompt}\n\n"
             if tools:
-                reasoner_messages[-1]['content'] += f"可用工具：{json.dumps(tools)}"
+                reasoner_messages.edit(-1)['content'] += f"可用工具：{json.dumps(tools)}"
             for modelProvider in settings['modelProviders']: 
                 if modelProvider['id'] == settings['reasoner']['selectedProvider']:
                     vendor = modelProvider['vendor']
                     break
-            msg = await images_add_in_messages(reasoner_messages, images,settings)    
+            msg = await images_add_in_messages(reasoner_messages, images,settings)
+            msg = compact_messages(msg, settings['reasoner']['model'], settings, settings['max_tokens'])
             if vendor == 'Ollama':
                 reasoner_response = await reasoner_client.chat.completions.create(
                     model=settings['reasoner']['model'],
@@ -2459,12 +2143,7 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                 # 将推理结果中的思考内容提取出来
                 reasoning_content = reasoner_response.model_dump()['choices'][0]['message']['content']
                 # open_tag和close_tag之间的内容
-                start_index = reasoning_content.find(open_tag) + len(open_tag)
-                end_index = reasoning_content.find(close_tag)
-                if start_index != -1 and end_index != -1:
-                    reasoning_content = reasoning_content[start_index:end_index]
-                else:
-                    reasoning_content = ""
+                _, reasoning_content = ThinkTagParser.split(reasoning_content, open_tag, close_tag)
                 request.messages[-1]['content'] = request.messages[-1]['content'] + "\n\n可参考的推理过程：" + reasoning_content
             else:
                 reasoner_response = await reasoner_client.chat.completions.create(
@@ -2481,6 +2160,8 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
             if drs_msg:
                 request.messages[-1]['content'] += f"\n\n{drs_msg}\n\n"
         msg = await images_add_in_messages(request.messages, images,settings)
+        # 超出模型上下文窗口时按优先级压缩
+        msg = compact_messages(msg, model, settings, request.max_tokens or settings['max_tokens'], tools)
         if tools:
             response = await client.chat.completions.create(
                 model=model,
@@ -2600,7 +2281,7 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                         "content": drs_msg,
                     }
                 )
-        reasoner_messages = copy.deepcopy(request.messages)
+        reasoner_messages = MessageOverlay(request.messages)
         while response.choices[0].message.tool_calls or search_not_done:
             if response.choices[0].message.tool_calls:
                 assistant_message = response.choices[0].message
@@ -2670,12 +2351,13 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
             if settings['reasoner']['enabled'] or enable_thinking:
 
                 if tools:
-                    reasoner_messages[-1]['content'] += f"可用工具：{json.dumps(tools)}"
+                    reasoner_messages.edit(-1)['content'] += f"可用工具：{json.dumps(tools)}"
                 for modelProvider in settings['modelProviders']: 
                     if modelProvider['id'] == settings['reasoner']['selectedProvider']:
                         vendor = modelProvider['vendor']
                         break
                 msg = await images_add_in_messages(reasoner_messages, images,settings)
+                msg = compact_messages(msg, settings['reasoner']['model'], settings, settings['max_tokens'])
                 if vendor == 'Ollama':
                     reasoner_response = await reasoner_client.chat.completions.create(
                         model=settings['reasoner']['model'],
@@ -2686,12 +2368,7 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                     # 将推理结果中的思考内容提取出来
                     reasoning_content = reasoner_response.model_dump()['choices'][0]['message']['content']
                     # open_tag和close_tag之间的内容
-                    start_index = reasoning_content.find(open_tag) + len(open_tag)
-                    end_index = reasoning_content.find(close_tag)
-                    if start_index != -1 and end_index != -1:
-                        reasoning_content = reasoning_content[start_index:end_index]
-                    else:
-                        reasoning_content = ""
+                    _, reasoning_content = ThinkTagParser.split(reasoning_content, open_tag, close_tag)
                     request.messages[-1]['content'] = request.messages[-1]['content'] + "\n\n可参考的推理过程：" + reasoning_content
                 else:
                     reasoner_response = await reasoner_client.chat.completions.create(
@@ -2703,6 +2380,8 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
                     )
                     request.messages[-1]['content'] = request.messages[-1]['content'] + "\n\n可参考的推理过程：" + reasoner_response.model_dump()['choices'][0]['message']['reasoning_content']
             msg = await images_add_in_messages(request.messages, images,settings)
+            # 超出模型上下文窗口时按优先级压缩
+            msg = compact_messages(msg, model, settings, request.max_tokens or settings['max_tokens'], tools)
             if tools:
                 response = await client.chat.completions.create(
                     model=model,
@@ -2825,13 +2504,12 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
        # 处理响应内容
         response_dict = response.model_dump()
         content = response_dict["choices"][0]['message']['content']
-        if open_tag in content and close_tag in content:
-            reasoning_content = re.search(fr'{open_tag}(.*?)\{close_tag}', content, re.DOTALL)
-            if reasoning_content:
-                # 存储到 reasoning_content 字段
-                response_dict["choices"][0]['message']['reasoning_content'] = reasoning_content.group(1).strip()
-                # 移除原内容中的标签部分
-                response_dict["choices"][0]['message']['content'] = re.sub(fr'{open_tag}(.*?)\{close_tag}', '', content, flags=re.DOTALL).strip()
+        if content and open_tag in content and close_tag in content:
+            content, reasoning_content = ThinkTagParser.split(content, open_tag, close_tag)
+            # 存储到 reasoning_content 字段
+            response_dict["choices"][0]['message']['reasoning_content'] = reasoning_content.strip()
+            # 移除原内容中的标签部分
+            response_dict["choices"][0]['message']['content'] = content.strip()
         if settings['reasoner']['enabled'] or enable_thinking:
             response_dict["choices"][0]['message']['reasoning_content'] = reasoner_response.model_dump()['choices'][0]['message']['reasoning_content']
         if m0:
@@ -2857,9 +2535,12 @@ async def generate_complete_response(client,reasoner_client, request: ChatReques
             asyncio.create_task(add_async())
         return JSONResponse(content=response_dict)
     except Exception as e:
+        # 预处理步骤抛出的普通异常没有 message / code 属性
         return JSONResponse(
-            content={"error": {"message": e.message, "type": "api_error", "code": e.code}}
+            content={"error": {"message": getattr(e, "message", str(e)), "type": "api_error", "code": getattr(e, "code", 500)}}
         )
+    finally:
+        preprocess.cancel()
 
 # 在现有路由后添加以下代码
 @app.get("/v1/models")
@@ -2984,8 +2665,8 @@ class ProviderModelRequest(BaseModel):
 @app.post("/v1/providers/models")
 async def fetch_provider_models(request: ProviderModelRequest):
     try:
-        # 使用传入的provider配置创建AsyncOpenAI客户端
-        client = AsyncOpenAI(api_key=request.api_key, base_url=request.url)
+        # 使用传入的provider配置获取共享的AsyncOpenAI客户端
+        client = client_pool.get_client(request.api_key, request.url)
         # 获取模型列表
         model_list = await client.models.list()
         # 提取模型ID并返回
@@ -2994,6 +2675,189 @@ async def fetch_provider_models(request: ProviderModelRequest):
         # 处理异常，返回错误信息
         raise HTTPException(status_code=500, detail=str(e))
 
+# 智能体配置文件缓存：文件未修改时复用同一个只读配置对象，工具目录缓存也因此可以命中
+agent_settings_cache = {}
+
+def load_agent_settings(config_path: str) -> dict:
+    mtime = os.stat(config_path).st_mtime_ns
+    cached = agent_settings_cache.get(config_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(config_path, 'r' , encoding='utf-8') as f:
+        agent_settings = json.load(f)
+    agent_settings_cache[config_path] = (mtime, agent_settings)
+    return agent_settings
+
+# 配置快照 -> {智能体 id 或名称: 智能体条目}，按名称查找时不再每次遍历
+agent_profiles = {}
+
+def resolve_agent(model: str, current_settings: dict):
+    """返回 (智能体条目, 智能体配置)，找不到时返回 (None, None)；配置文件按修改时间缓存"""
+    entry = agent_profiles.get(id(current_settings))
+    if entry is None or entry[0] is not current_settings:
+        agent_profiles.clear()
+        entry = agent_profiles[id(current_settings)] = (current_settings, {})
+    profiles = entry[1]
+    agentSettings = profiles.get(model)
+    if agentSettings is None:
+        agentSettings = current_settings['agents'].get(model, {})
+        if not agentSettings:
+            for agentId , agentConfig in current_settings['agents'].items():
+                if agentConfig['name'] == model:
+                    agentSettings = agentConfig
+                    break
+        if not agentSettings:
+            return None, None
+        profiles[model] = agentSettings
+    if not agentSettings['config_path']:
+        return agentSettings, None
+    return agentSettings, load_agent_settings(agentSettings['config_path'])
+
+def insert_system_prompt(messages: list, system_prompt: str):
+    """将 system_prompt 插入到 messages[0].content 中"""
+    if not system_prompt:
+        return
+    if messages[0]['role'] == 'system':
+        messages[0]['content'] = system_prompt + "\n\n" + messages[0]['content']
+    else:
+        messages.insert(0, {'role': 'system', 'content': system_prompt})
+
+# 当前请求的对外地址，进程内调用的子智能体生成的文件链接沿用父请求的地址
+current_base_url = contextvars.ContextVar("current_base_url", default=None)
+
+STREAM_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+}
+
+async def chat_cache_key(request: ChatRequest, model: str, settings: dict):
+    """请求可以使用响应缓存时返回缓存键，否则返回 None；需要在 generate_* 修改 request.messages 之前调用"""
+    if (not response_cache.is_cacheable(request.cache)
+            # 异步工具结果和记忆写入依赖每次实际执行
+            or request.asyncToolsID or settings['memorySettings']['is_memory']
+            # 联网搜索、知识库和时间注入的内容随时间变化，服务端工具有副作用，命中缓存会跳过它们
+            or request.enable_web_search or settings['webSearch']['enabled']
+            or get_kb_list(settings) or settings['tools']['time']['enabled']
+            or await tool_catalog.get_tools(settings, mcp_client_list)):
+        response_cache.stats.bypassed += 1
+        return None
+    return make_key({
+        "model": model,
+        "settings": response_cache.settings_fingerprint(settings),
+        "messages": request.messages,
+        "tools": request.tools,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+        "max_tokens": request.max_tokens,
+        "frequency_penalty": request.frequency_penalty,
+        "presence_penalty": request.presence_penalty,
+        "fileLinks": request.fileLinks,
+        "enable_thinking": request.enable_thinking,
+        "enable_deep_research": request.enable_deep_research,
+        "enable_web_search": request.enable_web_search,
+        "stream": request.stream,
+    })
+
+async def cached_chat_response(cache_key):
+    if cache_key is None:
+        return None
+    entry = await response_cache.get(cache_key)
+    if entry is None:
+        return None
+    kind, payload = entry
+    if kind == "stream":
+        return StreamingResponse(
+            response_cache.replay(payload),
+            media_type="text/event-stream",
+            headers={**STREAM_HEADERS, "X-Cache": "HIT"},
+        )
+    return JSONResponse(content=payload, headers={"X-Cache": "HIT"})
+
+async def store_chat_response(cache_key, response):
+    """流式响应在正常结束后写入缓存，非流式响应成功时直接写入"""
+    if cache_key is None:
+        return response
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = response_cache.record_stream(cache_key, response.body_iterator)
+    elif isinstance(response, JSONResponse) and response.status_code == 200:
+        payload = json.loads(response.body)
+        if "error" not in payload:
+            await response_cache.put(cache_key, "json", payload)
+    return response
+
+def request_priority(fastapi_request: Request):
+    """
+    请求头指定的优先级；FastApiMCP 通过 ASGI 转发的 MCP 调用（主机名 apiserver）按批量任务处理。
+    带内部凭据的智能体子调用返回 None 不排队：父请求正占着同一上游的名额，再排队在并发已满时会互相等待。
+    """
+    if is_internal_call(fastapi_request.headers.get(INTERNAL_HEADER)):
+        return None
+    priority = fastapi_request.headers.get(PRIORITY_HEADER)
+    if priority:
+        return priority.lower()
+    if fastapi_request.url.hostname == "apiserver":
+        return "batch"
+    return "interactive"
+
+def release_after_response(ticket, response):
+    """流式响应在流结束（或客户端断开）后释放准入名额，其他响应立即释放"""
+    if ticket is None:
+        return response
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = request_scheduler.hold(ticket, response.body_iterator)
+        # 流还没开始迭代客户端就断开时，生成器的 finally 不会执行，由后台任务兜底
+        previous = response.background
+        async def release():
+            request_scheduler.release(ticket)
+            if previous is not None:
+                await previous()
+        response.background = BackgroundTask(release)
+    else:
+        request_scheduler.release(ticket)
+    return response
+
+async def run_chat(client, reasoner_client, request: ChatRequest, settings: dict, model: str, fastapi_base_url: str, priority: str = None):
+    """响应缓存 -> 准入排队 -> 生成回复 -> 写入缓存；priority 为 None 时不排队（进程内的子调用占用父请求的名额）"""
+    current_base_url.set(fastapi_base_url)
+    enable_thinking = request.enable_thinking or False
+    enable_deep_research = request.enable_deep_research or False
+    enable_web_search = request.enable_web_search or False
+    async_tools_id = request.asyncToolsID or None
+    cache_key = await chat_cache_key(request, model, settings)
+    cached = await cached_chat_response(cache_key)
+    if cached is not None:
+        return cached
+    try:
+        # 按上游排队：预估提示词 token 数加上回复的上限
+        ticket = None
+        if priority is not None:
+            tokens = sum(message_tokens(message) for message in request.messages) + (request.max_tokens or settings['max_tokens'])
+            ticket = await request_scheduler.acquire(settings['base_url'] or "https://api.openai.com/v1", priority, tokens)
+    except SchedulerRejected as e:
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"message": str(e), "type": "rate_limit", "code": 429}},
+            headers={"Retry-After": str(int(e.retry_after + 0.999))},
+        )
+    try:
+        if request.stream:
+            response = await generate_stream_response(client,reasoner_client, request, settings,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search,async_tools_id)
+        else:
+            response = await generate_complete_response(client,reasoner_client, request, settings,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search)
+        return release_after_response(ticket, await store_chat_response(cache_key, response))
+    except asyncio.CancelledError:
+        # 处理客户端中断连接的情况
+        print("Client disconnected")
+        request_scheduler.release(ticket)
+        raise
+    except Exception as e:
+        request_scheduler.release(ticket)
+        return JSONResponse(
+            status_code=500,
+            content={"error": {"message": str(e), "type": "server_error", "code": 500}}
+        )
+
 @app.post("/v1/chat/completions", operation_id="chat_with_agent_party")
 async def chat_endpoint(request: ChatRequest,fastapi_request: Request):
     """
@@ -3004,93 +2868,91 @@ async def chat_endpoint(request: ChatRequest,fastapi_request: Request):
     enable_thinking: 默认为False，是否启用思考模式
     enable_deep_research: 默认为False，是否启用深度研究模式
     enable_web_search: 默认为False，是否启用网络搜索
+    cache: 可选项，True 时使用响应缓存（联网搜索、知识库、时间工具或服务端工具开启时除外），False 时不使用，未指定时看 responseCache.cacheAll
     """
-    fastapi_base_url = str(fastapi_request.base_url)
-    global client, settings,reasoner_client,mcp_client_list
+    global client, settings, settings_version, reasoner_client, mcp_client_list
     model = request.model or 'super-model' # 默认使用 'super-model'
-    enable_thinking = request.enable_thinking or False
-    enable_deep_research = request.enable_deep_research or False
-    enable_web_search = request.enable_web_search or False
-    async_tools_id = request.asyncToolsID or None
     if model == 'super-model':
         current_settings = await load_settings()
-        # 动态更新客户端配置
-        if (current_settings['api_key'] != settings['api_key'] 
-            or current_settings['base_url'] != settings['base_url']):
-            client = AsyncOpenAI(
-                api_key=current_settings['api_key'],
-                base_url=current_settings['base_url'] or "https://api.openai.com/v1",
-            )
-        if (current_settings['reasoner']['api_key'] != settings['reasoner']['api_key'] 
-            or current_settings['reasoner']['base_url'] != settings['reasoner']['base_url']):
-            reasoner_client = AsyncOpenAI(
-                api_key=current_settings['reasoner']['api_key'],
-                base_url=current_settings['reasoner']['base_url'] or "https://api.openai.com/v1",
-            )
-        # 将"system_prompt"插入到request.messages[0].content中
-        if current_settings['system_prompt']:
-            if request.messages[0]['role'] == 'system':
-                request.messages[0]['content'] = current_settings['system_prompt'] + "\n\n" + request.messages[0]['content']
-            else:
-                request.messages.insert(0, {'role': 'system', 'content': current_settings['system_prompt']})
-        if current_settings != settings:
+        current_version = get_settings_version()
+        # 配置版本变化时才动态更新客户端配置
+        if current_version != settings_version:
+            if (current_settings['api_key'] != settings['api_key'] 
+                or current_settings['base_url'] != settings['base_url']):
+                client = client_pool.get_client(current_settings['api_key'], current_settings['base_url'])
+            if (current_settings['reasoner']['api_key'] != settings['reasoner']['api_key'] 
+                or current_settings['reasoner']['base_url'] != settings['reasoner']['base_url']):
+                reasoner_client = client_pool.get_client(current_settings['reasoner']['api_key'], current_settings['reasoner']['base_url'])
+            if not shared_store.is_owner:
+                await sync_remote_mcp_clients(current_settings)
             settings = current_settings
-        try:
-            if request.stream:
-                return await generate_stream_response(client,reasoner_client, request, settings,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search,async_tools_id)
-            return await generate_complete_response(client,reasoner_client, request, settings,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search)
-        except asyncio.CancelledError:
-            # 处理客户端中断连接的情况
-            print("Client disconnected")
-            raise
-        except Exception as e:
-            return JSONResponse(
-                status_code=500,
-                content={"error": {"message": str(e), "type": "server_error", "code": 500}}
-            )
+            settings_version = current_version
+            response_cache.configure(current_settings.get('responseCache'))
+            request_scheduler.configure(current_settings.get('scheduler'))
+        insert_system_prompt(request.messages, current_settings['system_prompt'])
+        return await run_chat(client,reasoner_client, request, settings, model, str(fastapi_request.base_url), request_priority(fastapi_request))
     else:
         current_settings = await load_settings()
-        agentSettings = current_settings['agents'].get(model, {})
-        if not agentSettings:
-            for agentId , agentConfig in current_settings['agents'].items():
-                if current_settings['agents'][agentId]['name'] == model:
-                    agentSettings = current_settings['agents'][agentId]
-                    break
-        if not agentSettings:
+        response_cache.configure(current_settings.get('responseCache'))
+        request_scheduler.configure(current_settings.get('scheduler'))
+        agentSettings, agent_settings = resolve_agent(model, current_settings)
+        if not agent_settings:
             return JSONResponse(
                 status_code=404,
                 content={"error": {"message": f"Agent {model} not found", "type": "not_found", "code": 404}}
             )
-        if agentSettings['config_path']:
-            with open(agentSettings['config_path'], 'r' , encoding='utf-8') as f:
-                agent_settings = json.load(f)
-            # 将"system_prompt"插入到request.messages[0].content中
-            if agentSettings['system_prompt']:
-                if request.messages[0]['role'] == 'system':
-                    request.messages[0]['content'] = agentSettings['system_prompt'] + "\n\n" + request.messages[0]['content']
-                else:
-                    request.messages.insert(0, {'role': 'system', 'content': agentSettings['system_prompt']})
-        agent_client = AsyncOpenAI(
-            api_key=agent_settings['api_key'],
-            base_url=agent_settings['base_url'] or "https://api.openai.com/v1",
-        )
-        agent_reasoner_client = AsyncOpenAI(
-            api_key=agent_settings['reasoner']['api_key'],
-            base_url=agent_settings['reasoner']['base_url'] or "https://api.openai.com/v1",
-        )
-        try:
-            if request.stream:
-                return await generate_stream_response(agent_client,agent_reasoner_client, request, agent_settings,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search,async_tools_id)
-            return await generate_complete_response(agent_client,agent_reasoner_client, request, agent_settings,fastapi_base_url,enable_thinking,enable_deep_research,enable_web_search)
-        except asyncio.CancelledError:
-            # 处理客户端中断连接的情况
-            print("Client disconnected")
-            raise
-        except Exception as e:
-            return JSONResponse(
-                status_code=500,
-                content={"error": {"message": str(e), "type": "server_error", "code": 500}}
-            )
+        insert_system_prompt(request.messages, agentSettings['system_prompt'])
+        # 同一上游的智能体共享客户端与连接池
+        agent_client = client_pool.get_client(agent_settings['api_key'], agent_settings['base_url'])
+        agent_reasoner_client = client_pool.get_client(agent_settings['reasoner']['api_key'], agent_settings['reasoner']['base_url'])
+        return await run_chat(agent_client,agent_reasoner_client, request, agent_settings, model, str(fastapi_request.base_url), request_priority(fastapi_request))
+
+async def invoke_agent(agent_id: str, messages: List[Dict], stream: bool = False, **options):
+    """
+    进程内调用智能体：直接执行聊天流程，不经过 HTTP 回环和 chat_endpoint。
+    stream=False 时返回 OpenAI 格式的响应字典；stream=True 时返回异步生成器，逐个产出流式数据块（已解析的字典）。
+    在父请求的任务中 await / 迭代，父请求被取消时子调用随之取消；子调用不再排队，占用父请求的准入名额。
+    options 为 ChatRequest 的其他字段（temperature、max_tokens、cache……）。
+    """
+    current_settings = await load_settings()
+    agentSettings, agent_settings = resolve_agent(agent_id, current_settings)
+    if not agent_settings:
+        raise ValueError(f"Agent {agent_id} not found")
+    # 不修改调用方的消息列表
+    messages = [dict(message) for message in messages]
+    insert_system_prompt(messages, agentSettings['system_prompt'])
+    request = ChatRequest(messages=messages, model=agent_id, stream=stream, **options)
+    agent_client = client_pool.get_client(agent_settings['api_key'], agent_settings['base_url'])
+    agent_reasoner_client = client_pool.get_client(agent_settings['reasoner']['api_key'], agent_settings['reasoner']['base_url'])
+    fastapi_base_url = current_base_url.get() or f"http://127.0.0.1:{PORT}/"
+    response = await run_chat(agent_client, agent_reasoner_client, request, agent_settings, agent_id, fastapi_base_url)
+    if not stream or not isinstance(response, StreamingResponse):
+        result = json.loads(response.body)
+        if "error" in result:
+            error = result["error"]
+            raise RuntimeError(error.get("message", error) if isinstance(error, dict) else error)
+        if stream:
+            raise RuntimeError("Agent returned a non-streaming response")
+        return result
+    return iter_sse_chunks(response.body_iterator)
+
+async def iter_sse_chunks(chunks):
+    """把 SSE 数据块解析成字典，遇到 [DONE] 结束；提前退出或被取消时关闭上游生成器"""
+    try:
+        async for chunk in chunks:
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode("utf-8")
+            for line in chunk.splitlines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data.strip() == "[DONE]":
+                    return
+                yield json.loads(data)
+    finally:
+        await chunks.aclose()
+
+set_agent_runner(invoke_agent)
 
 
 # 存储活跃的ASR WebSocket连接
@@ -3103,6 +2965,8 @@ def convert_audio_to_pcm16(audio_bytes: bytes, target_sample_rate: int = 16000)
     """
     将音频数据转换为PCM16格式，采样率16kHz
     """
+    from scipy.io import wavfile
+    import numpy as np
     try:
         # 创建临时文件
         with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
@@ -3150,6 +3014,7 @@ async def funasr_recognize(audio_data: bytes, funasr_settings: dict,ws: WebSocke
     """
     使用FunASR进行语音识别
     """
+    import websockets
     try:
         # 获取FunASR服务器地址
         funasr_url = funasr_settings.get('funasr_ws_url', 'ws://localhost:10095')
@@ -3293,6 +3158,7 @@ def hotwords_to_json(input_str):
 # ASR WebSocket处理
 @app.websocket("/asr_ws")
 async def asr_websocket_endpoint(websocket: WebSocket):
+    import websockets
     await websocket.accept()
     
     # 生成唯一的连接ID
@@ -3433,9 +3299,10 @@ async def asr_websocket_endpoint(websocket: WebSocket):
                             audio_file = BytesIO(audio_bytes)
                             audio_file.name = f"audio.{audio_format}"
                             
-                            client = AsyncOpenAI(
-                                api_key=asr_settings.get('api_key', ''),
-                                base_url=asr_settings.get('base_url', '') or "https://api.openai.com/v1"
+                            client = client_pool.get_client(
+                                asr_settings.get('api_key', ''),
+                                asr_settings.get('base_url', ''),
+                                asr_settings.get('vendor'),
                             )
                             response = await client.audio.transcriptions.create(
                                 file=audio_file,
@@ -3492,6 +3359,7 @@ async def handle_funasr_response(funasr_websocket,
     """
     处理 FunASR 服务器的响应，并将结果转发给客户端
     """
+    import websockets
     try:
         async for message in funasr_websocket:
             try:
@@ -3563,8 +3431,10 @@ class TTSConnectionManager:
             self.vrm_connections.remove(websocket)
             logging.info(f"VRM interface disconnected. Total: {len(self.vrm_connections)}")
     
-    async def broadcast_to_vrm(self, message: dict):
-        """广播消息到所有VRM连接"""
+    async def broadcast_to_vrm(self, message: dict, relay: bool = True):
+        """广播消息到所有VRM连接（多进程时VRM界面可能连在其他 worker 上，同时转发过去）"""
+        if relay:
+            await shared_store.publish("tts.vrm", message)
         if self.vrm_connections:
             message_str = json.dumps(message)
             disconnected = []
@@ -3579,8 +3449,10 @@ class TTSConnectionManager:
             for conn in disconnected:
                 self.disconnect_vrm(conn)
     
-    async def send_to_main(self, message: dict):
+    async def send_to_main(self, message: dict, relay: bool = True):
         """发送消息到主界面"""
+        if relay:
+            await shared_store.publish("tts.main", message)
         if self.main_connections:
             message_str = json.dumps(message)
             disconnected = []
@@ -3689,6 +3561,41 @@ async def vrm_websocket_endpoint(websocket: WebSocket):
         tts_manager.disconnect_vrm(websocket)
 
 
+@app.get("/tools/stats")
+async def get_tool_stats():
+    """每个工具的调用次数、错误数和延迟直方图"""
+    return tool_registry.get_stats()
+
+@app.get("/context/stats")
+async def get_context_stats():
+    """提示词 token 统计，以及最近几次超出上下文预算时的压缩记录"""
+    return context_stats.to_dict()
+
+@app.get("/clients/stats")
+async def get_client_stats():
+    """上游客户端池统计：客户端数量、打开的连接数以及连接复用率"""
+    return client_pool.to_dict()
+
+@app.get("/cache/stats")
+async def get_response_cache_stats():
+    """响应缓存命中率：内存命中、磁盘命中、未命中以及不满足缓存条件而跳过的请求"""
+    return response_cache.to_dict()
+
+@app.get("/scheduler/stats")
+async def get_scheduler_stats():
+    """准入控制统计：各上游的并发数、队列深度、最近一分钟的 token 数，以及各优先级的排队耗时"""
+    return request_scheduler.to_dict()
+
+@app.get("/preprocess/stats")
+async def get_preprocess_stats():
+    """聊天请求预处理各步骤（图片、工具、文件、记忆、知识库、联网搜索）的耗时直方图"""
+    return preprocess_stats.to_dict()
+
+@app.get("/settings_broadcast/status")
+async def get_settings_broadcast_status():
+    """配置推送的计数：延迟、发送字节数、完整/差量消息数、断开的连接数"""
+    return settings_broadcaster.get_stats()
+
 @app.get("/tts/status")
 async def get_tts_status():
     """获取当前TTS连接状态"""
@@ -3729,6 +3636,7 @@ async def text_to_speech(request: Request):
             
             # 创建生成器函数用于流式传输
             async def generate_audio():
+                import edge_tts
                 communicate = edge_tts.Communicate(text, full_voice_name, rate=rate_text)
                 async for chunk in communicate.stream():
                     if chunk["type"] == "audio":
@@ -3814,8 +3722,7 @@ async def text_to_speech(request: Request):
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"服务器内部错误: {str(e)}"})
 
-# 添加状态存储
-mcp_status = {}
+# 状态保存在共享存储的 mcp_status 命名空间中
 @app.post("/create_mcp")
 async def create_mcp_endpoint(request: Request, background_tasks: BackgroundTasks):
     data = await request.json()
@@ -3830,25 +3737,44 @@ async def create_mcp_endpoint(request: Request, background_tasks: BackgroundTask
     return {"success": True, "message": "MCP服务器初始化已开始"}
 @app.get("/mcp_status/{mcp_id}")
 async def get_mcp_status(mcp_id: str):
-    status = mcp_status.get(mcp_id, "not_found")
+    status = await shared_store.get("mcp_status", mcp_id, "not_found")
     return {"mcp_id": mcp_id, "status": status}
 async def process_mcp(mcp_id: str):
     global mcp_client_list
-    mcp_status[mcp_id] = "initializing"
+    await shared_store.set("mcp_status", mcp_id, "initializing")
     try:
         # 获取对应服务器的配置
         cur_settings = await load_settings()
         server_config = cur_settings['mcpServers'][mcp_id]
         
         # 执行初始化逻辑
-        mcp_client_list[mcp_id] = McpClient()    
+        mcp_client_list[mcp_id] = McpClient()
+        mcp_client_list[mcp_id].on_tools_changed = partial(shared_store.publish_nowait, "mcp.tools_changed", mcp_id)
         await asyncio.wait_for(mcp_client_list[mcp_id].initialize(mcp_id, server_config), timeout=6)
-        mcp_status[mcp_id] = "ready"
+        await shared_store.set("mcp_status", mcp_id, "ready")
         mcp_client_list[mcp_id].disabled = False
         
     except Exception as e:
         mcp_client_list[mcp_id].disabled = True
-        mcp_status[mcp_id] = f"failed: {str(e)}"
+        await shared_store.set("mcp_status", mcp_id, f"failed: {str(e)}")
+
+@app.get("/_owner/mcp/{server_name}/functions", include_in_schema=False)
+async def owner_mcp_functions(server_name: str):
+    """主 worker 内部接口：供其他 worker 的 RemoteMcpClient 获取工具列表"""
+    mcp_client = mcp_client_list.get(server_name)
+    if mcp_client is None:
+        return []
+    return await mcp_client.get_openai_functions()
+
+@app.post("/_owner/mcp/{server_name}/call", include_in_schema=False)
+async def owner_mcp_call(server_name: str, request: Request):
+    """主 worker 内部接口：供其他 worker 的 RemoteMcpClient 调用工具"""
+    data = await request.json()
+    mcp_client = mcp_client_list.get(server_name)
+    if mcp_client is None:
+        raise HTTPException(status_code=404, detail="Server not found")
+    result = await mcp_client.call_tool(data["name"], data.get("arguments", {}))
+    return result.model_dump(mode="json") if result is not None else None
 
 @app.delete("/remove_mcp")
 async def remove_mcp_server(request: Request):
@@ -3861,7 +3787,7 @@ async def remove_mcp_server(request: Request):
             raise HTTPException(status_code=400, detail="No server names provided")
 
         # 移除指定的MCP服务器
-        current_settings = await load_settings()
+        current_settings = copy.deepcopy(await load_settings())
         if server_name in current_settings['mcpServers']:
             del current_settings['mcpServers'][server_name]
             await save_settings(current_settings)
@@ -4255,9 +4181,9 @@ async def delete_vrm_model(filename: str):
 @app.get("/update_storage")
 async def update_storage_endpoint(request: Request):
     settings = await load_settings()
-    textFiles = settings.get("textFiles") or []
-    imageFiles = settings.get("imageFiles") or []
-    videoFiles = settings.get("videoFiles") or []
+    textFiles = list(settings.get("textFiles") or [])
+    imageFiles = list(settings.get("imageFiles") or [])
+    videoFiles = list(settings.get("videoFiles") or [])
     # 检查UPLOAD_FILES_DIR目录中的文件，根据ALLOWED_EXTENSIONS、ALLOWED_IMAGE_EXTENSIONS、ALLOWED_VIDEO_EXTENSIONS分类，如果不存在于textFiles、imageFiles、videoFiles中则添加进去
     # 三个列表的元素是字典，包含"unique_filename"和"original_filename"两个键
     
@@ -4310,28 +4236,42 @@ async def remove_kb(kb_id):
     # 删除KB_DIR/kb_id目录
     kb_dir = os.path.join(KB_DIR, str(kb_id))
     if os.path.exists(kb_dir):
+        # 先释放缓存的检索器，Windows 下仍被内存映射的索引文件无法删除
+        from py.know_base import retriever_cache
+        retriever_cache.invalidate(kb_id)
         shutil.rmtree(kb_dir)
     else:
         print(f"KB directory {kb_dir} does not exist.")
     return
 
-# 添加状态存储
-kb_status = {}
+# 状态保存在共享存储的 kb_status 命名空间中
 @app.get("/kb_status/{kb_id}")
 async def get_kb_status(kb_id):
-    status = kb_status.get(kb_id, "not_found")
+    status = await shared_store.get("kb_status", str(kb_id), "not_found")
     print (f"kb_status: {kb_id} - {status}")
-    return {"kb_id": kb_id, "status": status}
+    # progress：嵌入阶段的进度（done/total、chunks_per_sec、eta_seconds、retries）
+    progress = await shared_store.get("kb_progress", str(kb_id))
+    return {"kb_id": kb_id, "status": status, "progress": progress}
+
+@app.get("/kb/stats")
+async def get_kb_stats():
+    """知识库检索器缓存的命中率、估算内存占用和加载耗时，以及嵌入缓存的命中率和条目数"""
+    from py.know_base import retriever_cache
+    from py.embedding_cache import embedding_cache
+    return {"retrievers": retriever_cache.to_dict(), "embeddings": embedding_cache.to_dict()}
 
 # 修改 process_kb
 async def process_kb(kb_id):
-    kb_status[kb_id] = "processing"
+    await shared_store.set("kb_status", str(kb_id), "processing")
+    await shared_store.pop("kb_progress", str(kb_id))
+    async def on_progress(progress):
+        await shared_store.set("kb_progress", str(kb_id), progress)
     try:
         from py.know_base import process_knowledge_base
-        await process_knowledge_base(kb_id)
-        kb_status[kb_id] = "completed"
+        await process_knowledge_base(kb_id, on_progress)
+        await shared_store.set("kb_status", str(kb_id), "completed")
     except Exception as e:
-        kb_status[kb_id] = f"failed: {str(e)}"
+        await shared_store.set("kb_status", str(kb_id), f"failed: {str(e)}")
 
 @app.post("/create_sticker_pack")
 async def create_sticker_pack(
@@ -4428,13 +4368,20 @@ class QQBotConfig(BaseModel):
     reasoningVisible: bool
     quickRestart: bool
 
-# 全局机器人管理器
-qq_bot_manager = QQBotManager()
+# 全局机器人管理器，首次启动机器人时才导入 botpy / PIL
+qq_bot_manager = None
+
+def get_qq_bot_manager():
+    global qq_bot_manager
+    if qq_bot_manager is None:
+        from py.qq_bot_manager import QQBotManager
+        qq_bot_manager = QQBotManager()
+    return qq_bot_manager
 
 @app.post("/start_qq_bot")
 async def start_qq_bot(config: QQBotConfig):
     try:
-        qq_bot_manager.start_bot(config)
+        get_qq_bot_manager().start_bot(config)
         return {
             "success": True,
             "message": "QQ机器人已成功启动",
@@ -4454,7 +4401,8 @@ async def start_qq_bot(config: QQBotConfig):
 @app.post("/stop_qq_bot")
 async def stop_qq_bot():
     try:
-        qq_bot_manager.stop_bot()
+        if qq_bot_manager is not None:
+            qq_bot_manager.stop_bot()
         return {"success": True, "message": "QQ机器人已停止"}
     except Exception as e:
         return JSONResponse(
@@ -4464,6 +4412,10 @@ async def stop_qq_bot():
 
 @app.get("/qq_bot_status")
 async def qq_bot_status():
+    if qq_bot_manager is None:
+        # 机器人从未启动过，无需为查询状态加载 botpy
+        from py.qq_bot_status import build_status
+        return build_status()
     status = qq_bot_manager.get_status()
     # 如果有启动错误，在状态中包含错误信息
     if status.get("startup_error") and not status.get("is_running"):
@@ -4474,9 +4426,10 @@ async def qq_bot_status():
 async def reload_qq_bot(config: QQBotConfig):
     try:
         # 先停止再启动
-        qq_bot_manager.stop_bot()
+        manager = get_qq_bot_manager()
+        manager.stop_bot()
         await asyncio.sleep(1)  # 等待完全停止
-        qq_bot_manager.start_bot(config)
+        manager.start_bot(config)
         
         return {
             "success": True,
@@ -4572,16 +4525,19 @@ settings_lock = asyncio.Lock()
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    active_connections.append(websocket)
+    settings_broadcaster.connect(websocket)
 
     try:
         async with settings_lock:  # 读取时加锁
             current_settings = await load_settings()
-        await websocket.send_json({"type": "settings", "data": current_settings})
+        await settings_broadcaster.send_snapshot(websocket, current_settings, get_settings_version())
         while True:
             data = await websocket.receive_json()
             if data.get("type") == "ping":
                 await websocket.send_json({"type": "pong"})
+            elif data.get("type") == "settings_ack":
+                # 客户端确认已应用的配置版本，之后只推送差量
+                settings_broadcaster.ack(websocket, data.get("version", -1))
             elif data.get("type") == "save_settings":
                 await save_settings(data.get("data", {}))
                 # 发送确认消息（携带相同 correlationId）
@@ -4590,11 +4546,24 @@ async def websocket_endpoint(websocket: WebSocket):
                     "correlationId": data.get("correlationId"),
                     "success": True
                 })
+            elif data.get("type") == "patch_settings":
+                # 局部更新：data 为 JSON-Patch 风格的操作列表
+                try:
+                    await patch_settings(data.get("data", []))
+                    success = True
+                except (KeyError, IndexError, ValueError, TypeError) as e:
+                    logger.error(f"Patch settings failed: {e}")
+                    success = False
+                await websocket.send_json({
+                    "type": "settings_saved",
+                    "correlationId": data.get("correlationId"),
+                    "success": success
+                })
             elif data.get("type") == "get_settings":
                 settings = await load_settings()
-                await websocket.send_json({"type": "settings", "data": settings})
+                await settings_broadcaster.send_snapshot(websocket, settings, get_settings_version())
             elif data.get("type") == "save_agent":
-                current_settings = await load_settings()
+                current_settings = copy.deepcopy(await load_settings())
                 
                 # 生成智能体ID和配置路径
                 agent_id = str(shortuuid.ShortUUID().random(length=8))
@@ -4614,14 +4583,11 @@ async def websocket_endpoint(websocket: WebSocket):
                 await save_settings(current_settings)
                 
                 # 广播更新后的配置
-                await websocket.send_json({
-                    "type": "settings",
-                    "data": current_settings
-                })
+                await settings_broadcaster.send_snapshot(websocket, await load_settings(), get_settings_version())
     except Exception as e:
         print(f"WebSocket error: {e}")
     finally:
-        active_connections.remove(websocket)
+        settings_broadcaster.disconnect(websocket)
 
 mcp = FastApiMCP(
     app,
@@ -4639,9 +4605,20 @@ app.mount("/", StaticFiles(directory=os.path.join(base_path, "static"), html=Tru
 # 简化main函数
 if __name__ == "__main__":
     import uvicorn
-
-    uvicorn.run(
-        app,
-        host=HOST,
-        port=PORT
-    )
\ No newline at end of file
+    import multiprocessing
+    multiprocessing.freeze_support()
+
+    if args.workers > 1:
+        # 多进程模式：状态保存在 py/shared_state 的共享存储中，MCP 连接和QQ机器人由主 worker 持有
+        uvicorn.run(
+            "server:app",
+            host=HOST,
+            port=PORT,
+            workers=args.workers
+        )
+    else:
+        uvicorn.run(
+            app,
+            host=HOST,
+            port=PORT
+        )
\ No newline at end of file
@@ -40,6 +40,10 @@ const md = window.markdownit({
 // 添加更复杂的临时占位符
 const LATEX_PLACEHOLDER_PREFIX = 'LATEX_PLACEHOLDER_';
 let latexPlaceholderCounter = 0;
+// 上次保存到后端的各配置分区（JSON字符串），用于只发送变化的分区
+let savedSettingsSections = null;
+// 最近一次从后端收到的完整配置及其版本，用于合并差量推送
+let lastSettingsSnapshot = null;
 
 const ALLOWED_EXTENSIONS = [
 // 办公文档
@@ -1014,11 +1018,29 @@ let vue_methods = {
           return;
         }
 
+      // 差量推送：合并到上次的完整配置后按完整配置处理，版本对不上时重新拉取
+      if (data.type === 'settings_delta') {
+        if (!lastSettingsSnapshot || lastSettingsSnapshot.version !== data.base_version) {
+          this.ws.send(JSON.stringify({ type: 'get_settings' }));
+          return;
+        }
+        const merged = { ...lastSettingsSnapshot.data, ...data.data };
+        for (const name of data.removed || []) {
+          delete merged[name];
+        }
+        data = { type: 'settings', version: data.version, data: merged };
+      }
+
       if (data.type === 'pong') {
         // 可以在这里处理 pong 回复，比如记录状态
         console.log('Received pong from server.');
       } 
       else if (data.type === 'settings') {
+          savedSettingsSections = null;
+          if (data.version !== undefined) {
+            lastSettingsSnapshot = { version: data.version, data: data.data };
+            this.ws.send(JSON.stringify({ type: 'settings_ack', version: data.version }));
+          }
           this.isdocker = data.data.isdocker || false;
           this.settings = {
             model: data.data.model || '',
@@ -1076,6 +1098,8 @@ let vue_methods = {
         } 
         else if (data.type === 'settings_saved') {
           if (!data.success) {
+            // 保存失败时下一次改为发送完整配置
+            savedSettingsSections = null;
             showNotification(this.t('settings_save_failed'), 'error');
           }
         }
@@ -1617,12 +1641,34 @@ let vue_methods = {
           custom_http: this.customHttpTools,
         };
         const correlationId = uuid.v4();
-        // 发送保存请求
-        this.ws.send(JSON.stringify({
-          type: 'save_settings',
-          data: payload,
-          correlationId: correlationId // 添加唯一请求 ID
-        }));
+        // 计算变化的配置分区，首次保存发送完整配置，之后只发送局部更新
+        const sections = {};
+        const operations = [];
+        for (const [key, value] of Object.entries(payload)) {
+          sections[key] = JSON.stringify(value);
+          if (savedSettingsSections && savedSettingsSections[key] !== sections[key]) {
+            operations.push({ op: 'replace', path: `/${key}`, value: value === undefined ? null : value });
+          }
+        }
+        if (savedSettingsSections) {
+          if (operations.length === 0) {
+            resolve();
+            return;
+          }
+          this.ws.send(JSON.stringify({
+            type: 'patch_settings',
+            data: operations,
+            correlationId: correlationId
+          }));
+        } else {
+          // 发送保存请求
+          this.ws.send(JSON.stringify({
+            type: 'save_settings',
+            data: payload,
+            correlationId: correlationId // 添加唯一请求 ID
+          }));
+        }
+        savedSettingsSections = sections;
         // 设置响应监听器
         const handler = (event) => {
           const response = JSON.parse(event.data);